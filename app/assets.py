@@ -0,0 +1,151 @@
+import argparse
+import gzip
+import logging
+import os
+import re
+import time
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from .media import STATIC_DIR
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_DIRS = ("js", "css")
+COMPRESSIBLE = {".js", ".css", ".html", ".svg", ".json", ".ico", ".txt"}
+# Preference order when a client accepts several
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# name.<content hash>.ext, as emitted by the frontend build
+HASHED_RE = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+SERVE_SOURCE_MAPS = os.getenv("ENV") == "development"
+
+
+def compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    result = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        logger.warning("Модуль brotli не установлен, .br не создаются")
+    else:
+        result[".br"] = lambda data: brotli.compress(data, quality=11)
+    return result
+
+
+def bundle_files(root: Path) -> Iterator[Path]:
+    for directory in BUNDLE_DIRS:
+        for path in sorted((root / directory).glob("*")):
+            # Source maps are for development only and never shipped compressed
+            if path.is_file() and path.suffix in COMPRESSIBLE:
+                yield path
+    index = root / "index.html"
+    if index.exists():
+        yield index
+
+
+def build(root: Path = STATIC_DIR) -> Tuple[int, int, int]:
+    started = time.perf_counter()
+    written = skipped = saved = 0
+    variants = compressors()
+    for path in bundle_files(root):
+        data = None
+        source_mtime = path.stat().st_mtime
+        for suffix, compress in variants.items():
+            target = path.with_name(path.name + suffix)
+            if target.exists() and target.stat().st_mtime >= source_mtime:
+                skipped += 1
+                continue
+            data = data if data is not None else path.read_bytes()
+            compressed = compress(data)
+            if len(compressed) >= len(data):
+                target.unlink(missing_ok=True)
+                continue
+            tmp = target.with_name(f".{target.name}.tmp")
+            tmp.write_bytes(compressed)
+            # Same mtime as the source keeps ETag/Last-Modified stable across rebuilds
+            os.utime(tmp, (source_mtime, source_mtime))
+            tmp.replace(target)
+            written += 1
+            saved += len(data) - len(compressed)
+
+    for directory in BUNDLE_DIRS:
+        for _, suffix in ENCODINGS:
+            for stale in (root / directory).glob(f"*{suffix}"):
+                if not stale.with_name(stale.name[:-len(suffix)]).exists():
+                    stale.unlink()
+
+    logger.info(
+        "Статика сжата за %.1f с: записано %s, актуальных %s, экономия %s КБ",
+        time.perf_counter() - started, written, skipped, saved // 1024,
+    )
+    return written, skipped, saved
+
+
+def accepted_encodings(headers: Headers) -> List[str]:
+    accepted = []
+    for item in headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.strip()
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.append(name.strip().lower())
+    return accepted
+
+
+def cache_control(path: str) -> str:
+    # Hashed names change with content, everything else must be revalidated
+    return IMMUTABLE if HASHED_RE.search(path) else REVALIDATE
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # Variants are only reachable through negotiation, a direct hit would lack Content-Encoding
+        if path.endswith((".br", ".gz")) or (path.endswith(".map") and not SERVE_SOURCE_MAPS):
+            return Response(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        headers = {"Cache-Control": cache_control(str(full_path)), "Vary": "Accept-Encoding"}
+        path = str(full_path)
+        accepted = accepted_encodings(request_headers)
+        for name, suffix in ENCODINGS:
+            if name in accepted:
+                try:
+                    stat_result = os.stat(path + suffix)
+                except FileNotFoundError:
+                    continue
+                path += suffix
+                headers["Content-Encoding"] = name
+                break
+
+        # The media type comes from the original name, not from .br / .gz
+        response = FileResponse(
+            path,
+            status_code=status_code,
+            stat_result=stat_result,
+            headers=headers,
+            media_type=guess_type(str(full_path))[0] or "text/plain",
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompress the frontend bundle with gzip and brotli")
+    parser.add_argument("--root", type=Path, default=STATIC_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build(args.root)
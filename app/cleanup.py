@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, select, text
+
+from . import crud, database, media, models
+
+logger = logging.getLogger(__name__)
+
+DELETION_BATCH_SIZE = int(os.getenv("MEDIA_DELETION_BATCH_SIZE", "100"))
+GC_BATCH_SIZE = int(os.getenv("MEDIA_GC_BATCH_SIZE", "1000"))
+GC_GRACE_SECONDS = int(os.getenv("MEDIA_GC_GRACE_SECONDS", str(24 * 60 * 60)))
+GC_INTERVAL_SECONDS = int(os.getenv("MEDIA_GC_INTERVAL_SECONDS", str(60 * 60)))
+# Same idea as MIGRATION_LOCK_ID: any fixed key shared by every process running GC on this database
+GC_LOCK_ID = 7_346_102
+
+_BLOB_NAME_RE = re.compile(r"^([0-9a-f]{64})(\.|$)")
+
+
+class DeletionQueue:
+    def __init__(self, batch_size: int = DELETION_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker and not self._worker.done():
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._worker = loop.create_task(self._run())
+
+    def enqueue(self, urls: Iterable[str]):
+        urls = list(urls)
+        if not urls:
+            return
+        self._ensure_worker()
+        for url in urls:
+            self._queue.put_nowait(url)
+
+    async def join(self):
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    async def stop(self):
+        await self.join()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _remove(self, urls: List[str]):
+        by_sha256 = {}
+        plain = []
+        for url in urls:
+            match = _BLOB_NAME_RE.match(url.rsplit("/", 1)[-1])
+            if match:
+                by_sha256.setdefault(match.group(1), []).append(url)
+            else:
+                plain.append(url)
+        if not by_sha256:
+            await media.remove_files(plain)
+            return
+
+        async with database.AsyncSessionLocal() as db:
+            # The same content may have been uploaded again since the blob was released
+            await crud.lock_blobs(db, by_sha256)
+            result = await db.execute(
+                select(models.MediaBlob.sha256).where(models.MediaBlob.sha256.in_(by_sha256))
+            )
+            live = set(result.scalars())
+            await media.remove_files(
+                plain + [url for sha256, blob_urls in by_sha256.items() if sha256 not in live for url in blob_urls]
+            )
+            await db.commit()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._remove(batch)
+            except Exception:
+                logger.exception("Failed to remove %d media files", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+deletion_queue = DeletionQueue()
+
+
+def _scan_media_root(root: Path, batch_size: int, older_than: float) -> Iterator[List[Path]]:
+    batch = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            try:
+                if path.stat().st_mtime > older_than:
+                    continue
+            except FileNotFoundError:
+                continue
+            batch.append(path)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def _unreferenced(db, paths: List[Path]) -> List[str]:
+    root = media.MEDIA_ROOT
+    urls = {f"{media.MEDIA_URL_PREFIX}/{path.relative_to(root).as_posix()}": path for path in paths}
+
+    by_sha256 = {}
+    legacy = []
+    for url, path in urls.items():
+        match = _BLOB_NAME_RE.match(path.name)
+        if match:
+            by_sha256.setdefault(match.group(1), []).append(url)
+        else:
+            legacy.append(url)
+
+    known = set()
+    if by_sha256:
+        result = await db.execute(
+            select(models.MediaBlob.sha256).where(models.MediaBlob.sha256.in_(by_sha256))
+        )
+        for sha256 in result.scalars():
+            known.update(by_sha256[sha256])
+    if legacy:
+        result = await db.execute(select(models.Media.url).where(models.Media.url.in_(legacy)))
+        known.update(result.scalars())
+
+    return [url for url in urls if url not in known]
+
+
+async def collect_garbage(
+        batch_size: int = GC_BATCH_SIZE,
+        grace_seconds: int = GC_GRACE_SECONDS,
+) -> Optional[dict]:
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+    stats = {"unattached_media": 0, "orphaned_files": 0}
+
+    # Every worker schedules GC; one run at a time is enough. The lock lives in its own
+    # transaction, so the batches below can commit and a crashed run cannot leak it
+    async with database.AsyncSessionLocal() as lock:
+        if not await lock.scalar(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": GC_LOCK_ID}):
+            logger.info("Media GC skipped: another process is running it")
+            return None
+        await _collect(cutoff, batch_size, grace_seconds, stats)
+
+    logger.info("Media GC finished: %s", stats)
+    return stats
+
+
+async def _collect(cutoff: datetime, batch_size: int, grace_seconds: int, stats: dict):
+    async with database.AsyncSessionLocal() as db:
+        # Uploads that were never attached to a tweet within the grace period
+        while True:
+            stale_ids = (
+                select(models.Media.id)
+                .where(models.Media.tweet_id.is_(None), models.Media.created_at < cutoff)
+                .limit(batch_size)
+            )
+            result = await db.execute(
+                delete(models.Media)
+                .where(models.Media.id.in_(stale_ids))
+                .returning(models.Media.url, models.Media.sha256)
+            )
+            rows = result.all()
+            if not rows:
+                break
+            released = await crud.release_media(db, rows)
+            await db.commit()
+            deletion_queue.enqueue(released)
+            stats["unattached_media"] += len(rows)
+        await deletion_queue.join()
+
+        # Files on disk that no row points at any more
+        scanner = _scan_media_root(media.MEDIA_ROOT, batch_size, time.time() - grace_seconds)
+        while paths := await run_in_threadpool(next, scanner, None):
+            orphaned = await _unreferenced(db, paths)
+            deletion_queue.enqueue(orphaned)
+            stats["orphaned_files"] += len(orphaned)
+
+    await deletion_queue.join()
+
+
+async def run_periodic_gc(interval: int = GC_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await collect_garbage()
+        except Exception:
+            logger.exception("Media GC failed")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(collect_garbage())
@@ -1,15 +1,28 @@
-from typing import List
+import os
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
 from fastapi import Header, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import delete, select
-from sqlalchemy.orm import joinedload, selectinload
-from . import models, schemas
+from sqlalchemy import bindparam, delete, event, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+from . import events, follows, media, models, schemas, search, tags, timeline
+from .cache import LRUCache
+from .pagination import DEFAULT_LIMIT, decode_cursor, encode_cursor
+from .response_cache import FEED, response_cache, user_entity
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# Invalidation only reaches the worker that made the change, other workers serve
+# a renamed or deleted user for up to this long
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "10"))
+
+principal_cache = LRUCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
 
 async def create_tweet(
         db: AsyncSession,
@@ -24,6 +37,12 @@ async def create_tweet(
     )
 
     db.add(db_tweet)
+    await db.flush()
+    await timeline.fan_out_tweet(db, db_tweet)
+    await tags.index_tweets(db, [(db_tweet.id, db_tweet.tweet_data, db_tweet.created_at)])
+    await events.event_hub.publish({"type": events.TWEET_CREATED, "tweet_id": db_tweet.id, "author_id": user_id}, db)
+    # Last before commit: the shared version row stays locked only for the commit itself
+    await response_cache.bump(FEED, db=db)
     await db.commit()
     await db.refresh(db_tweet)
     return db_tweet
@@ -35,6 +54,52 @@ async def get_api_key(api_key: str = Header(..., alias="api-key")) -> str:
     return api_key
 
 
+async def get_principal(db: AsyncSession, api_key: str) -> Optional[schemas.UserBase]:
+    principal = principal_cache.get(api_key)
+    if principal is not None:
+        return principal
+
+    result = await db.execute(
+        select(models.User.id, models.User.name).where(models.User.api_key == api_key)
+    )
+    row = result.first()
+    if row is None:
+        return None
+
+    principal = schemas.UserBase(id=row.id, name=row.name)
+    principal_cache.set(api_key, principal)
+    return principal
+
+
+async def get_stream_principal(db: AsyncSession, token: str) -> Optional[schemas.UserBase]:
+    user_id = events.stream_token_user(token)
+    if user_id is None:
+        return None
+    result = await db.execute(
+        select(models.User.id, models.User.name, models.User.api_key).where(models.User.id == user_id)
+    )
+    row = result.first()
+    if row is None or not events.stream_token_valid(token, row.api_key):
+        return None
+    return schemas.UserBase(id=row.id, name=row.name)
+
+
+def invalidate_principal(user_id: int):
+    # Scanned rather than indexed by id: a second map would evict independently
+    # and could lose the key of a still cached principal
+    principal_cache.invalidate_where(lambda principal: principal.id == user_id)
+
+
+def clear_principals():
+    principal_cache.clear()
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target):
+    invalidate_principal(target.id)
+
+
 async def get_media_by_ids(
         db: AsyncSession,
         media_ids: List[int],
@@ -48,7 +113,79 @@ async def get_media_by_ids(
     return list(result.scalars().all())
 
 
-async def delete_tweet(db: AsyncSession, tweet_id: int, user_id: int):
+# Ordered, so a batch never waits on a lock while holding one another batch needs first
+LOCK_BLOBS = text("""
+    SELECT pg_advisory_xact_lock(key) FROM (
+        SELECT hashtextextended(sha256, 0) AS key FROM unnest(CAST(:sha256s AS text[])) AS sha256 ORDER BY 1
+    ) AS keys
+""")
+
+
+async def lock_blobs(db: AsyncSession, sha256s: Iterable[str]):
+    # Held until commit: placing a blob's files and their deferred deletion never interleave
+    await db.execute(LOCK_BLOBS, {"sha256s": sorted(set(sha256s))})
+
+
+async def create_media(db: AsyncSession, stored: media.StoredFile) -> Tuple[models.Media, bool]:
+    await lock_blobs(db, [stored.sha256])
+    result = await db.execute(
+        insert(models.MediaBlob)
+        .values(
+            sha256=stored.sha256,
+            url=media.blob_url(stored.sha256, stored.suffix),
+            size=stored.size,
+            ref_count=1,
+        )
+        .on_conflict_do_update(
+            index_elements=["sha256"],
+            set_={"ref_count": models.MediaBlob.ref_count + 1},
+        )
+        .returning(models.MediaBlob.url, models.MediaBlob.ref_count)
+    )
+    url, ref_count = result.one()
+    db_media = models.Media(url=url, sha256=stored.sha256)
+    db.add(db_media)
+    await db.flush()
+
+    # The file is in place before commit; a failed commit leaves an orphan, never a dangling row
+    await media.place_upload(stored, url)
+    await db.commit()
+    await db.refresh(db_media)
+    return db_media, ref_count == 1
+
+
+async def release_media(db: AsyncSession, media_rows) -> List[str]:
+    released = [row.url for row in media_rows if row.sha256 is None]
+    references = Counter(row.sha256 for row in media_rows if row.sha256 is not None)
+    if not references:
+        return released
+
+    blobs = models.MediaBlob.__table__
+    await db.execute(
+        update(blobs)
+        .where(blobs.c.sha256 == bindparam("blob_sha256"))
+        .values(ref_count=blobs.c.ref_count - bindparam("blob_refs")),
+        [{"blob_sha256": sha256, "blob_refs": refs} for sha256, refs in references.items()],
+    )
+    result = await db.execute(
+        delete(models.MediaBlob)
+        .where(
+            models.MediaBlob.sha256.in_(references),
+            models.MediaBlob.ref_count <= 0
+        )
+        .returning(models.MediaBlob.url, models.MediaBlob.thumbnail_url, models.MediaBlob.web_url)
+    )
+    for row in result:
+        released.extend(url for url in row if url)
+    return released
+
+
+async def delete_tweet(db: AsyncSession, tweet_id: int, user_id: int) -> List[str]:
+    media_rows = (await db.execute(
+        select(models.Media.url, models.Media.sha256)
+        .where(models.Media.tweet_id == tweet_id)
+    )).all()
+
     result = await db.execute(
         delete(models.Tweet)
         .where(
@@ -62,8 +199,11 @@ async def delete_tweet(db: AsyncSession, tweet_id: int, user_id: int):
     if not deleted_id:
         raise HTTPException(status_code=404, detail="Tweet not found or already removed")
 
+    released = await release_media(db, media_rows)
+    await events.event_hub.publish({"type": events.TWEET_DELETED, "tweet_id": tweet_id, "author_id": user_id}, db)
+    await response_cache.bump(FEED, db=db)
     await db.commit()
-    return {"status": "success"}
+    return released
 
 
 async def get_tweet(db: AsyncSession, tweet_id: int):
@@ -73,140 +213,222 @@ async def get_tweet(db: AsyncSession, tweet_id: int):
     return result.scalars().first()
 
 
-async def get_tweets(db: AsyncSession):
-    result = await db.execute(
+def _feed_query():
+    return (
         select(models.Tweet).
-        options(selectinload(models.Tweet.media),
+        options(selectinload(models.Tweet.media).joinedload(models.Media.blob),
                 selectinload(models.Tweet.author)).
-        order_by(models.Tweet.created_at.desc())
+        execution_options(populate_existing=True)
+    )
+
+
+async def _likes_by_tweet(db: AsyncSession, tweet_ids: List[int]) -> Dict[int, List[dict]]:
+    # Plain rows, not Like/User objects: recent tweets carry hundreds of likes each,
+    # and building ORM objects for them was most of the cost of a feed page
+    result = await db.execute(
+        select(models.Like.tweet_id, models.Like.user_id, models.User.name)
+        .join(models.User, models.User.id == models.Like.user_id)
+        .where(models.Like.tweet_id.in_(tweet_ids))
+    )
+    likes = {}
+    for tweet_id, user_id, name in result:
+        likes.setdefault(tweet_id, []).append({"user_id": user_id, "name": name})
+    return likes
+
+
+async def _serialize_tweets(db: AsyncSession, tweets: List[models.Tweet]) -> List[dict]:
+    likes = await _likes_by_tweet(db, [tweet.id for tweet in tweets]) if tweets else {}
+    return [_serialize_tweet(tweet, likes.get(tweet.id, [])) for tweet in tweets]
+
+
+def _serialize_tweet(tweet: models.Tweet, likes: List[dict]) -> dict:
+    return {
+        "id": tweet.id,
+        "content": tweet.tweet_data,
+        "attachments": [
+            m.blob.thumbnail_url if m.blob and m.blob.thumbnail_url else m.url
+            for m in tweet.media
+        ] if tweet.media else None,
+        # Screen-sized copy for the full view; the original until the derivative is ready
+        "attachment_web": [
+            m.blob.web_url if m.blob and m.blob.web_url else m.url
+            for m in tweet.media
+        ] if tweet.media else None,
+        "attachment_originals": [m.url for m in tweet.media] if tweet.media else None,
+        "author": {
+            "id": tweet.author_id,
+            "name": tweet.author.name
+        },
+        "likes": likes
+    }
+
+
+async def get_tweets(
+        db: AsyncSession,
+        limit: int = DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+):
+    query = (
+        _feed_query().
+        order_by(models.Tweet.created_at.desc(), models.Tweet.id.desc()).
+        limit(limit + 1)
     )
+    position = decode_cursor(cursor)
+    if position:
+        query = query.where(tuple_(models.Tweet.created_at, models.Tweet.id) < position)
+
+    result = await db.execute(query)
     tweets = result.scalars().all()
-    result = []
+    next_cursor = None
+    if len(tweets) > limit:
+        tweets = tweets[:limit]
+        next_cursor = encode_cursor(tweets[-1].created_at, tweets[-1].id)
+
+    return await _serialize_tweets(db, tweets), next_cursor
+
+
+async def get_tweets_by_ids(db: AsyncSession, tweet_ids: List[int]):
+    if not tweet_ids:
+        return []
+    result = await db.execute(_feed_query().where(models.Tweet.id.in_(tweet_ids)))
+    tweets = {tweet.id: tweet for tweet in result.scalars().all()}
+    return await _serialize_tweets(db, [tweets[tweet_id] for tweet_id in tweet_ids if tweet_id in tweets])
+
+
+async def get_home_timeline(
+        db: AsyncSession,
+        user_id: int,
+        limit: int = DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+):
+    tweet_ids, next_cursor = await timeline.get_timeline_page(db, user_id, limit, cursor)
+    return await get_tweets_by_ids(db, tweet_ids), next_cursor
+
+
+async def get_tweets_by_tag(
+        db: AsyncSession,
+        tag: str,
+        limit: int = DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+):
+    tweet_ids, next_cursor = await tags.get_tag_page(db, tag, limit, cursor)
+    return await get_tweets_by_ids(db, tweet_ids), next_cursor
+
+
+async def get_mentions(
+        db: AsyncSession,
+        user_id: int,
+        limit: int = DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+):
+    tweet_ids, next_cursor = await tags.get_mentions_page(db, user_id, limit, cursor)
+    return await get_tweets_by_ids(db, tweet_ids), next_cursor
+
+
+async def search_tweets(
+        db: AsyncSession,
+        text: str,
+        limit: int = DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+):
+    tweet_ids, highlights, next_cursor = await search.search_page(db, text, limit, cursor)
+    tweets = await get_tweets_by_ids(db, tweet_ids)
     for tweet in tweets:
-        likes_result = await db.execute(
-            select(models.Like).
-            options(joinedload(models.Like.user)).
-            where(models.Like.tweet_id == tweet.id)
-        )
-        likes = likes_result.scalars().all()
-        result.append({
-                    "id": tweet.id,
-                    "content": tweet.tweet_data,
-                    "attachments": [media.url for media in tweet.media] if tweet.media else None,
-                    "author": {
-                        "id": tweet.author_id,
-                        "name": tweet.author.name
-                    },
-                    "likes": [
-                        {
-                            "user_id": like.user_id,
-                            "name": like.user.name
-                        }
-                        for like in likes
-                    ]
-                })
-
-    return result
+        tweet["highlight"] = highlights[tweet["id"]]
+    return tweets, next_cursor
 
 
 async def get_user(db: AsyncSession, **filters):
     query = (
         select(models.User)
-        .options(
-            selectinload(models.User.followers).joinedload(models.Follow.follower),
-            selectinload(models.User.following).joinedload(models.Follow.followed)
-        )
         .filter_by(**filters)
+        .execution_options(populate_existing=True)
     )
     result = await db.execute(query)
     return result.scalars().first()
 
 
 async def add_like(db: AsyncSession, tweet_id: int, user_id: int):
-    existing_like = await db.execute(
-        select(models.Like).where(
-            models.Like.user_id == user_id,
-            models.Like.tweet_id == tweet_id
-        )
+    like_id = await db.scalar(
+        insert(models.Like)
+        .values(user_id=user_id, tweet_id=tweet_id)
+        .on_conflict_do_nothing(index_elements=["user_id", "tweet_id"])
+        .returning(models.Like.id)
     )
-    if existing_like.scalar():
+    if like_id is None:
         raise HTTPException(status_code=400, detail="Like already exists")
 
-    new_like = models.Like(user_id=user_id, tweet_id=tweet_id)
-    db.add(new_like)
+    await events.event_hub.publish({"type": events.LIKE_ADDED, "tweet_id": tweet_id, "user_id": user_id}, db)
+    await response_cache.bump(FEED, db=db)
     await db.commit()
-    await db.refresh(new_like)
-    return {"result": True, "like_id": new_like.id}
+    return {"result": True, "like_id": like_id}
 
 
 async def remove_like(db: AsyncSession, tweet_id: int, user_id: int):
-    result = await db.execute(
-        select(models.Like).where(
+    like_id = await db.scalar(
+        delete(models.Like)
+        .where(
             models.Like.user_id == user_id,
             models.Like.tweet_id == tweet_id
         )
+        .returning(models.Like.id)
     )
-
-    like_to_remove = result.scalar_one_or_none()
-    if not like_to_remove:
+    if like_id is None:
         raise HTTPException(status_code=404, detail="Like not found or already removed")
 
-    await db.delete(like_to_remove)
+    await events.event_hub.publish({"type": events.LIKE_REMOVED, "tweet_id": tweet_id, "user_id": user_id}, db)
+    await response_cache.bump(FEED, db=db)
     await db.commit()
     return {"status": "success"}
 
 
 async def add_follower(db: AsyncSession, follower_id: int, followed_id: int):
-    existing_follower = await db.execute(
-        select(models.Follow).where(
-            models.Follow.follower_id == follower_id,
-            models.Follow.followed_id == followed_id,
-        )
+    follow_id = await db.scalar(
+        insert(models.Follow)
+        .values(follower_id=follower_id, followed_id=followed_id)
+        .on_conflict_do_nothing(index_elements=["follower_id", "followed_id"])
+        .returning(models.Follow.id)
     )
-    if existing_follower.scalar():
+    if follow_id is None:
         raise HTTPException(status_code=400, detail="Follower already exists")
 
-    new_follower = models.Follow(follower_id=follower_id, followed_id=followed_id)
-    db.add(new_follower)
+    await follows.adjust_counts(db, follower_id=follower_id, followed_id=followed_id, delta=1)
+    await timeline.backfill(db, follower_id=follower_id, followed_id=followed_id)
+    await response_cache.bump(user_entity(follower_id), user_entity(followed_id), db=db)
     await db.commit()
-    await db.refresh(new_follower)
-    return new_follower
+    return {"result": True, "follow_id": follow_id}
 
 
 async def remove_follower(db: AsyncSession, follower_id: int, followed_id: int):
-    result = await db.execute(
-        select(models.Follow).where(
+    follow_id = await db.scalar(
+        delete(models.Follow)
+        .where(
             models.Follow.follower_id == follower_id,
             models.Follow.followed_id == followed_id,
         )
+        .returning(models.Follow.id)
     )
-
-    follower_to_remove = result.scalar_one_or_none()
-    if not follower_to_remove:
+    if follow_id is None:
         raise HTTPException(status_code=404, detail="Follower not found or already removed")
 
-    await db.delete(follower_to_remove)
+    await follows.adjust_counts(db, follower_id=follower_id, followed_id=followed_id, delta=-1)
+    await timeline.prune(db, follower_id=follower_id, followed_id=followed_id)
+    await response_cache.bump(user_entity(follower_id), user_entity(followed_id), db=db)
     await db.commit()
     return {"status": "success"}
 
 
-async def get_user_response(user):
+async def get_user_response(db: AsyncSession, user):
+    followers, _ = await follows.get_followers_page(db, user.id, limit=follows.PREVIEW_SIZE)
+    following, _ = await follows.get_following_page(db, user.id, limit=follows.PREVIEW_SIZE)
     return {
         "result": True,
         "user": {
             "id": user.id,
             "name": user.name,
-            "followers": [
-                {
-                    "id": f.follower.id,
-                    "name": f.follower.name
-                } for f in user.followers
-            ],
-            "following": [
-                {
-                    "id": f.followed.id,
-                    "name": f.followed.name
-                } for f in user.following
-            ]
+            "followers_count": user.followers_count,
+            "following_count": user.following_count,
+            "followers": followers,
+            "following": following
         }
     }
@@ -1,14 +1,24 @@
+import logging
+import math
 import os
 import random
+import time
 from datetime import datetime, timezone
 
-from faker import Faker
+from typing import List, Optional
+
+from fastapi import Cookie, Request
 from sqlalchemy import select
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 
+from . import metrics
+
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 DB_USER = os.getenv('POSTGRES_USER', 'postgres')
 DB_PASS = os.getenv('POSTGRES_PASSWORD', 'password')
@@ -16,9 +26,95 @@ DB_NAME = os.getenv('POSTGRES_DB', 'postgres')
 DB_HOST = os.getenv('DB_HOST', 'db')
 DB_PORT = os.getenv('DB_PORT', '5432')
 
-DATABASE_URL = f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+# Off by default: a ping is an extra round trip on every checkout, and DB_POOL_RECYCLE
+# already retires connections before the server or a proxy drops them
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'false').lower() == 'true'
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+
+DB_REPLICA_HOSTS = [host.strip() for host in os.getenv('DB_REPLICA_HOSTS', '').split(',') if host.strip()]
+DB_REPLICA_RETRY_SECONDS = float(os.getenv('DB_REPLICA_RETRY_SECONDS', '30'))
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '5'))
+# Holds the time until which the client's reads go to the primary
+READ_YOUR_WRITES_COOKIE = 'db_rw_until'
+
+
+def database_url(host: str = DB_HOST, port: str = DB_PORT) -> str:
+    return (
+        f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{host}:{port}/{DB_NAME}'
+        f'?prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}'
+    )
+
+
+DATABASE_URL = database_url()
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, seconds: float):
+        self.waits += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        metrics.record_pool_wait(seconds)
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+pool_wait_stats = PoolWaitStats()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        # Only a checkout that queues for a returned connection is a wait;
+        # opening a new connection is connect latency, not pool contention
+        if not self._pool.empty() or self._max_overflow < 0 or self._overflow < self._max_overflow:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait_stats.record(time.perf_counter() - started)
+
+
+def create_engine(url: str = DATABASE_URL):
+    return create_async_engine(
+        url,
+        echo=DB_ECHO,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+def pool_stats(db_engine=None) -> dict:
+    pool = (db_engine or engine).sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "waits": pool_wait_stats.waits,
+        "wait_seconds_total": pool_wait_stats.wait_seconds_total,
+        "wait_seconds_max": pool_wait_stats.wait_seconds_max,
+    }
+
+
+engine = create_engine()
+metrics.registry.register(metrics.Gauge(
+    "db_pool_checked_out", "Connections checked out of the primary pool", lambda: pool_stats()["checked_out"]
+))
+metrics.registry.register(metrics.Gauge(
+    "db_pool_overflow", "Overflow connections of the primary pool", lambda: pool_stats()["overflow"]
+))
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
     class_=AsyncSession,
@@ -28,18 +124,102 @@ AsyncSessionLocal = async_sessionmaker(
 Base = declarative_base()
 
 
-async def get_db():
+def session_factory(bind) -> async_sessionmaker:
+    return async_sessionmaker(bind=bind, class_=AsyncSession, expire_on_commit=False)
+
+
+def _marker_active(marker: Optional[str]) -> bool:
+    try:
+        return bool(marker) and float(marker) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRouter:
+    def __init__(
+            self,
+            primary: async_sessionmaker,
+            replicas: List[async_sessionmaker],
+            retry_seconds: float = DB_REPLICA_RETRY_SECONDS,
+            read_your_writes_seconds: float = DB_READ_YOUR_WRITES_SECONDS,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.retry_seconds = retry_seconds
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self._unhealthy_until = [0.0] * len(replicas)
+        self._next = 0
+
+    def write_marker(self) -> str:
+        return f"{time.time() + self.read_your_writes_seconds:.3f}"
+
+    def mark_unhealthy(self, factory: async_sessionmaker):
+        if factory in self.replicas:
+            self._unhealthy_until[self.replicas.index(factory)] = time.monotonic() + self.retry_seconds
+            logger.warning("Реплика исключена из ротации на %s с", self.retry_seconds)
+
+    def choose(self, write_marker: Optional[str] = None) -> async_sessionmaker:
+        if not self.replicas or _marker_active(write_marker):
+            return self.primary
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+            if self._unhealthy_until[index] <= now:
+                return self.replicas[index]
+        return self.primary
+
+
+replica_router = ReplicaRouter(
+    AsyncSessionLocal,
+    [session_factory(create_engine(database_url(*host.split(':', 1)))) for host in DB_REPLICA_HOSTS],
+)
+
+
+class ReadYourWritesMiddleware:
+    # The marker travels with the client, so its next read reaches the primary whichever worker serves it
+    def __init__(self, app, router: Optional[ReplicaRouter] = None):
+        self.app = app
+        self.router = router or replica_router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.router.replicas:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_marker(message):
+            if message["type"] == "http.response.start" and scope.get("state", {}).get("db_write"):
+                cookie = (
+                    f"{READ_YOUR_WRITES_COOKIE}={self.router.write_marker()}; "
+                    f"Max-Age={math.ceil(self.router.read_your_writes_seconds)}; Path=/; HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_marker)
+
+
+async def get_db(request: Request):
+    request.state.db_write = True
     async with AsyncSessionLocal() as session:
         yield session
 
 
+async def get_read_db(write_marker: Optional[str] = Cookie(None, alias=READ_YOUR_WRITES_COOKIE)):
+    factory = replica_router.choose(write_marker)
+    async with factory() as session:
+        try:
+            yield session
+        except (OperationalError, InterfaceError, OSError):
+            replica_router.mark_unhealthy(factory)
+            raise
+
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
-fake = Faker()
-
 # from . import models
 from . import models
 
@@ -47,6 +227,10 @@ from . import models
 async def init_test_data(db: AsyncSession):
     if await db.scalar(select(models.User).limit(1)):
         return
+    # Only development startup needs Faker, so production workers never import it
+    from faker import Faker
+
+    fake = Faker()
 
     users = [
         models.User(
@@ -71,5 +255,11 @@ async def init_test_data(db: AsyncSession):
             models.Follow(follower_id=user.id, followed_id=target.id)
             for target in to_follow if target.id != user.id
         ])
+    await db.flush()
+    from .follows import recount
+    from .timeline import rebuild
 
+    await recount(db)
+    # The fixtures bypass crud, so nothing has fanned their tweets out yet
+    await rebuild(db)
     await db.commit()
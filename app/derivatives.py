@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import update
+
+from . import database, models
+from .media import media_path
+from .response_cache import FEED, response_cache
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = int(os.getenv("MEDIA_THUMBNAIL_SIZE", "400"))
+WEB_SIZE = int(os.getenv("MEDIA_WEB_SIZE", "1280"))
+WEB_QUALITY = int(os.getenv("MEDIA_WEB_QUALITY", "80"))
+DERIVATIVE_WORKERS = int(os.getenv("MEDIA_DERIVATIVE_WORKERS", "2"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _save(image, target: Path, **options):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.tmp")
+    image.save(tmp, **options)
+    os.replace(tmp, target)
+
+
+def render_derivatives(source: str, thumbnail_target: str, web_target: str) -> bool:
+    # Runs in a worker process; Pillow is only imported there
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    except (UnidentifiedImageError, OSError):
+        return False
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    web = image.copy()
+    web.thumbnail((WEB_SIZE, WEB_SIZE))
+    _save(web, Path(web_target), format="WEBP", quality=WEB_QUALITY)
+
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    _save(thumbnail, Path(thumbnail_target), format="JPEG", quality=WEB_QUALITY, optimize=True)
+    return True
+
+
+def derivative_urls(url: str) -> tuple[str, str]:
+    stem = url.rsplit(".", 1)[0] if "." in Path(url).name else url
+    return f"{stem}.thumb.jpg", f"{stem}.web.webp"
+
+
+async def generate_derivatives(sha256: str, url: str):
+    thumbnail_url, web_url = derivative_urls(url)
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(
+            get_executor(),
+            render_derivatives,
+            str(media_path(url)),
+            str(media_path(thumbnail_url)),
+            str(media_path(web_url)),
+        )
+    except Exception:
+        logger.exception("Derivative generation failed for %s", url)
+        return
+    if not rendered:
+        return
+
+    async with database.AsyncSessionLocal() as session:
+        await session.execute(
+            update(models.MediaBlob)
+            .where(models.MediaBlob.sha256 == sha256)
+            .values(thumbnail_url=thumbnail_url, web_url=web_url)
+        )
+        await response_cache.bump(FEED, db=session)
+        await session.commit()
@@ -0,0 +1,291 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, List, Optional, Set
+
+import asyncpg
+import orjson
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import database, metrics
+
+logger = logging.getLogger(__name__)
+
+# "memory" only reaches clients of this process; "postgres" relays through LISTEN/NOTIFY to every worker
+EVENTS_BROKER = os.getenv("EVENTS_BROKER", "memory")
+EVENTS_CHANNEL = os.getenv("EVENTS_CHANNEL", "feed_events")
+EVENTS_CLIENT_BUFFER = int(os.getenv("EVENTS_CLIENT_BUFFER", "100"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_RECONNECT_SECONDS = float(os.getenv("EVENTS_RECONNECT_SECONDS", "1"))
+EVENTS_RETRY_MS = 3000
+# Lifetime of the stream cookie; after it the client asks for a new one with its api-key
+EVENTS_TOKEN_SECONDS = int(os.getenv("EVENTS_TOKEN_SECONDS", "300"))
+STREAM_TOKEN_COOKIE = "events_token"
+
+TWEET_CREATED = "tweet_created"
+TWEET_DELETED = "tweet_deleted"
+LIKE_ADDED = "like_added"
+LIKE_REMOVED = "like_removed"
+
+Deliver = Callable[[bytes], None]
+
+# Session.info key for events a LocalBroker hands out once the write commits
+PENDING_EVENTS = "pending_events"
+NOTIFY = text("SELECT pg_notify(:channel, :payload)")
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_pending(session: Session):
+    for deliver, payload in session.info.pop(PENDING_EVENTS, ()):
+        deliver(payload)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session: Session):
+    session.info.pop(PENDING_EVENTS, None)
+
+
+def _sign(api_key: str, payload: str) -> str:
+    return hmac.new(api_key.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+# "<user id>.<expiry>.<signature>", signed with the user's own api key: every worker can check it
+# without a shared secret, and replacing the key revokes the tokens issued with it
+def issue_stream_token(user_id: int, api_key: str) -> str:
+    payload = f"{user_id}.{int(time.time()) + EVENTS_TOKEN_SECONDS}"
+    return f"{payload}.{_sign(api_key, payload)}"
+
+
+def stream_token_user(token: str) -> Optional[int]:
+    try:
+        user_id, expires_at, _ = token.split(".")
+        if int(expires_at) < time.time():
+            return None
+        return int(user_id)
+    except ValueError:
+        return None
+
+
+def stream_token_valid(token: str, api_key: str) -> bool:
+    payload, _, signature = token.rpartition(".")
+    return hmac.compare_digest(signature, _sign(api_key, payload))
+
+
+class Subscriber:
+    # Idle clients dominate, so a subscriber is a deque and an Event, nothing per-client runs until data arrives
+    __slots__ = ("buffer", "maxsize", "ready", "dropped")
+
+    def __init__(self, maxsize: int = EVENTS_CLIENT_BUFFER):
+        self.buffer = deque()
+        self.maxsize = maxsize
+        self.ready = asyncio.Event()
+        self.dropped = False
+
+    def push(self, payload: bytes) -> bool:
+        if len(self.buffer) >= self.maxsize:
+            self.dropped = True
+            self.ready.set()
+            return False
+        self.buffer.append(payload)
+        self.ready.set()
+        return True
+
+    def close(self):
+        self.dropped = True
+        self.ready.set()
+
+    async def next_batch(self, timeout: float) -> List[bytes]:
+        if not self.buffer and not self.dropped:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        self.ready.clear()
+        batch = list(self.buffer)
+        self.buffer.clear()
+        return batch
+
+
+class LocalBroker:
+    shared = False
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    def bind(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def publish(self, payload: bytes, db: Optional[AsyncSession] = None):
+        if db is None:
+            self.deliver(payload)
+        else:
+            db.info.setdefault(PENDING_EVENTS, []).append((self.deliver, payload))
+
+    async def stop(self):
+        pass
+
+
+class PostgresBroker:
+    # NOTIFY payloads are capped at 8000 bytes, which is why events carry ids rather than tweet bodies
+    shared = True
+
+    def __init__(self, dsn: str, channel: str = EVENTS_CHANNEL, reconnect_seconds: float = EVENTS_RECONNECT_SECONDS):
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect_seconds = reconnect_seconds
+        self.deliver: Optional[Deliver] = None
+        self.listening = asyncio.Event()
+        self._listener: Optional[asyncio.Task] = None
+
+    def bind(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        self._listener = asyncio.create_task(self._listen())
+
+    def _on_notify(self, connection, pid, channel, payload: str):
+        self.deliver(payload.encode())
+
+    async def _listen(self):
+        # One connection per worker, outside the pool, however many clients are subscribed
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                lost = asyncio.get_running_loop().create_future()
+                connection.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await connection.add_listener(self.channel, self._on_notify)
+                self.listening.set()
+                await lost
+                logger.warning("Соединение LISTEN %s потеряно, переподключаемся", self.channel)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logger.warning("Не удалось подписаться на %s: %s", self.channel, e)
+            finally:
+                self.listening.clear()
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.reconnect_seconds)
+
+    async def publish(self, payload: bytes, db: Optional[AsyncSession] = None):
+        params = {"channel": self.channel, "payload": payload.decode()}
+        if db is not None:
+            # Queued by the write's own transaction: sent on commit, dropped on rollback, no extra round trip
+            await db.execute(NOTIFY, params)
+            return
+        async with database.AsyncSessionLocal() as session:
+            await session.execute(NOTIFY, params)
+            await session.commit()
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+
+class EventHub:
+    def __init__(self, broker, buffer_size: int = EVENTS_CLIENT_BUFFER, heartbeat: float = EVENTS_HEARTBEAT_SECONDS):
+        self.broker = broker
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.subscribers: Set[Subscriber] = set()
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        broker.bind(self.deliver)
+
+    async def start(self):
+        await self.broker.start()
+
+    async def stop(self):
+        await self.broker.stop()
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.buffer_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def deliver(self, payload: bytes):
+        # Every client gets a reference to the same encoded payload
+        slow = [subscriber for subscriber in self.subscribers if not subscriber.push(payload)]
+        self.delivered += len(self.subscribers) - len(slow)
+        for subscriber in slow:
+            # A client that stopped reading is disconnected; EventSource reconnects and refetches the feed
+            self.subscribers.discard(subscriber)
+            self.dropped += 1
+        if slow:
+            logger.warning("Отключено медленных подписчиков: %s", len(slow))
+
+    async def publish(self, event: dict, db: Optional[AsyncSession] = None):
+        # With a session the event belongs to its transaction and reaches clients only if the write commits
+        self.published += 1
+        if db is not None:
+            await self.broker.publish(orjson.dumps(event), db)
+            return
+        try:
+            await self.broker.publish(orjson.dumps(event))
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            # Nothing to roll back here; a missed push only delays clients until their next fetch
+            logger.warning("Событие %s не отправлено: %s", event.get("type"), e)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        subscriber = self.subscribe()
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n".encode()
+            while True:
+                batch = await subscriber.next_batch(self.heartbeat)
+                if subscriber.dropped:
+                    return
+                if batch:
+                    yield b"".join(b"data: " + payload + b"\n\n" for payload in batch)
+                else:
+                    yield b": ping\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        return {
+            "broker": type(self.broker).__name__,
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+
+def broker_dsn() -> str:
+    url = database.engine.url.set(drivername="postgresql").difference_update_query(["prepared_statement_cache_size"])
+    return url.render_as_string(hide_password=False)
+
+
+def make_broker(kind: str = EVENTS_BROKER):
+    if kind == "postgres":
+        return PostgresBroker(broker_dsn())
+    return LocalBroker()
+
+
+event_hub = EventHub(make_broker())
+
+metrics.registry.register(metrics.Gauge(
+    "events_subscribers", "Open event stream connections", lambda: len(event_hub.subscribers)
+))
+metrics.registry.register(metrics.Gauge(
+    "events_dropped_clients", "Event stream clients disconnected for falling behind", lambda: event_hub.dropped
+))
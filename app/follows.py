@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from sqlalchemy import case, func, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import database, models
+from .pagination import decode_id_cursor, encode_id_cursor
+
+logger = logging.getLogger(__name__)
+
+RECOUNT_BATCH_SIZE = int(os.getenv("FOLLOW_RECOUNT_BATCH_SIZE", "10000"))
+# Profiles embed only this many followers / followed users, the rest is paged
+PREVIEW_SIZE = int(os.getenv("FOLLOW_PREVIEW_SIZE", "10"))
+
+# Correlated counts walk the two follows indexes, one user range at a time
+RECOUNT = text("""
+    UPDATE users SET
+        followers_count = (SELECT count(*) FROM follows WHERE follows.followed_id = users.id),
+        following_count = (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)
+    WHERE users.id >= :lo AND users.id < :hi
+""")
+
+
+async def adjust_counts(db: AsyncSession, follower_id: int, followed_id: int, delta: int):
+    # Both rows in one statement; a self-follow touches a single row for both counters
+    await db.execute(
+        update(models.User)
+        .where(models.User.id.in_({follower_id, followed_id}))
+        .values(
+            followers_count=models.User.followers_count + case((models.User.id == followed_id, delta), else_=0),
+            following_count=models.User.following_count + case((models.User.id == follower_id, delta), else_=0),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def recount(db: AsyncSession, lo: int = 0, hi: int = 2 ** 31 - 1):
+    await db.execute(RECOUNT, {"lo": lo, "hi": hi})
+
+
+async def recount_all(batch_size: int = RECOUNT_BATCH_SIZE, sessions: Optional[async_sessionmaker] = None) -> int:
+    # One short transaction per id range, so follow writes are never blocked for long
+    async with (sessions or database.AsyncSessionLocal)() as db:
+        max_id = await db.scalar(select(func.coalesce(func.max(models.User.id), 0)))
+        for lo in range(0, max_id + 1, batch_size):
+            await recount(db, lo, lo + batch_size)
+            await db.commit()
+            logger.info("Счётчики подписок пересчитаны до id %s", min(lo + batch_size, max_id + 1) - 1)
+    return max_id
+
+
+async def _page(db: AsyncSession, key_column, other_column, user_id: int, limit: int, cursor: Optional[str]):
+    query = (
+        select(models.User.id, models.User.name)
+        .join(models.Follow, models.User.id == other_column)
+        .where(key_column == user_id)
+        .order_by(other_column.desc())
+        .limit(limit + 1)
+    )
+    position = decode_id_cursor(cursor)
+    if position is not None:
+        query = query.where(other_column < position)
+
+    rows = (await db.execute(query)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_id_cursor(rows[-1].id)
+    return [{"id": row.id, "name": row.name} for row in rows], next_cursor
+
+
+async def get_followers_page(
+        db: AsyncSession,
+        user_id: int,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    # (followed_id, follower_id) index
+    return await _page(db, models.Follow.followed_id, models.Follow.follower_id, user_id, limit, cursor)
+
+
+async def get_following_page(
+        db: AsyncSession,
+        user_id: int,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    # (follower_id, followed_id) unique constraint
+    return await _page(db, models.Follow.follower_id, models.Follow.followed_id, user_id, limit, cursor)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recount followers_count / following_count from the follows table")
+    parser.add_argument("--batch-size", type=int, default=RECOUNT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(recount_all(args.batch_size))
@@ -1,42 +1,66 @@
+import asyncio
 import os
+import sys
 from contextlib import asynccontextmanager
-from .database import Base, engine, get_db, init_test_data, AsyncSessionLocal
-from . import crud, schemas, models
-from fastapi import APIRouter, Depends, FastAPI, File, HTTPException, status, UploadFile
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from .assets import REVALIDATE, PrecompressedStaticFiles
+from .cleanup import GC_INTERVAL_SECONDS, deletion_queue, run_periodic_gc
+from .database import ReadYourWritesMiddleware, engine, get_db, get_read_db, pool_stats
+from .derivatives import generate_derivatives, shutdown_executor
+from .events import EVENTS_TOKEN_SECONDS, STREAM_TOKEN_COOKIE, event_hub, issue_stream_token
+from .metrics import LOOP_LAG_INTERVAL, MetricsMiddleware, monitor_event_loop, startup
+from .media import MEDIA_ROOT, STATIC_DIR, MediaFiles, discard_upload, receive_upload
+from .pagination import DEFAULT_LIMIT, MAX_LIMIT
+from .response_cache import FEED, response_cache, user_entity
+from . import crud, follows, metrics, schemas
+from fastapi import APIRouter, BackgroundTasks, Cookie, Depends, FastAPI, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-import uuid
-from pathlib import Path
+from typing import Optional
 
 import logging
-import coloredlogs
+import orjson
 
 logger = logging.getLogger(__name__)
-coloredlogs.install(level='INFO', logger=logger)
+if sys.stderr.isatty():
+    # Colours only help on a terminal; containers log to a pipe and skip the import
+    import coloredlogs
+
+    coloredlogs.install(level='INFO', logger=logger)
+
+# app.serve migrates once before starting the workers and turns this off for them
+MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
-    if os.getenv("ENV") == "development":
-        logger.info("Заполнение тестовыми данными")
-        async with AsyncSessionLocal() as session:
-            await init_test_data(session)
-        logger.info("Инициализация БД завершена")
+    if MIGRATE_ON_STARTUP:
+        from .migrate import prepare_database
+
+        await prepare_database(engine)
     else:
-        logger.info("БД уже инициализирована, пропускаем создание таблиц")
+        logger.info("Схема БД подготовлена при запуске сервера")
+    gc_task = asyncio.create_task(run_periodic_gc()) if GC_INTERVAL_SECONDS > 0 else None
+    lag_task = asyncio.create_task(monitor_event_loop()) if LOOP_LAG_INTERVAL > 0 else None
+    await event_hub.start()
+    startup.mark_ready()
     yield
 
+    await event_hub.stop()
+
+    if gc_task:
+        gc_task.cancel()
+    if lag_task:
+        lag_task.cancel()
+    await deletion_queue.stop()
+    shutdown_executor()
     await engine.dispose()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
 
-static_dir = Path(__file__).resolve().parent.parent / "static"
-MEDIA_ROOT = static_dir / "media"
+static_dir = STATIC_DIR
 
 
 @app.get('/favicon.ico', include_in_schema=False)
@@ -44,23 +68,73 @@ async def get_favicon():
     return FileResponse(static_dir / 'favicon.ico')
 
 
+internal_router = APIRouter(include_in_schema=False, dependencies=[Depends(metrics.require_token)])
+
+
+@internal_router.get("/stats/pool")
+async def get_pool_stats():
+    return pool_stats()
+
+
+@internal_router.get("/stats/cache")
+async def get_cache_stats():
+    return response_cache.stats()
+
+
+@internal_router.get("/stats/events")
+async def get_event_stats():
+    return event_hub.stats()
+
+
+@internal_router.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+app.include_router(internal_router)
+
+
 @app.get("/")
 async def read_root():
-    return FileResponse(os.path.join(static_dir, "index.html"))
+    # index.html names the current hashed bundles, so it is never cached without revalidation
+    return FileResponse(os.path.join(static_dir, "index.html"), headers={"Cache-Control": REVALIDATE})
 
 
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
-app.mount("/js", StaticFiles(directory=os.path.join(static_dir, "js")), name="js")
-app.mount("/css", StaticFiles(directory=os.path.join(static_dir, "css")), name="css")
+# Registered before /static so attachment URLs reach it
+app.mount("/static/media", MediaFiles(directory=MEDIA_ROOT, check_dir=False), name="media")
+# Same guard as /js and /css: the bundle is also reachable as /static/js/..., maps and raw variants included
+app.mount("/static", PrecompressedStaticFiles(directory=static_dir), name="static")
+app.mount("/js", PrecompressedStaticFiles(directory=os.path.join(static_dir, "js")), name="js")
+app.mount("/css", PrecompressedStaticFiles(directory=os.path.join(static_dir, "css")), name="css")
 api_router = APIRouter(prefix="/api")
 
 
 @api_router.get("/users/me", response_model=schemas.UserMeResponse)
-async def get_me(api_key: str = Depends(crud.get_api_key), db: AsyncSession = Depends(get_db)):
-    user = await crud.get_user(db, api_key=api_key)
+async def get_me(
+        request: Request,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return await crud.get_user_response(user)
+    return await read_user_profile(request, db, user.id)
+
+
+async def read_user_profile(request: Request, db: AsyncSession, user_id: int):
+    versions = await response_cache.versions([user_entity(user_id)], db)
+    headers, not_modified = await response_cache.conditional(request, "user", {"id": user_id}, versions)
+    if not_modified:
+        return not_modified
+
+    async def build():
+        db_user = await crud.get_user(db, id=user_id)
+        if not db_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return orjson.dumps(await crud.get_user_response(db, db_user))
+
+    body = await response_cache.get_or_build("user", {"id": user_id}, versions, build)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @api_router.post("/tweets", response_model=schemas.CreatedTweet)
@@ -70,7 +144,7 @@ async def create_tweet(
         db: AsyncSession = Depends(get_db)
 ):
 
-    user = await crud.get_user(db, api_key=api_key)
+    user = await crud.get_principal(db, api_key)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -89,17 +163,33 @@ async def create_tweet(
     }
 
 
-@api_router.post("/medias")
-async def upload_media(file: UploadFile = File(...), db: AsyncSession = Depends(get_db)):
+# The body is parsed by receive_upload, File(...) would make FastAPI read all of it first
+UPLOAD_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"],
+        }}},
+    }
+}
+
 
-    file_path = f"static/media/{uuid.uuid4()}_{file.filename}"
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+@api_router.post("/medias", openapi_extra=UPLOAD_SCHEMA)
+async def upload_media(
+        request: Request,
+        background_tasks: BackgroundTasks,
+        db: AsyncSession = Depends(get_db)
+):
 
-    db_media = models.Media(url=file_path)
-    db.add(db_media)
-    await db.commit()
-    await db.refresh(db_media)
+    stored = await receive_upload(request)
+    try:
+        db_media, created = await crud.create_media(db, stored)
+    finally:
+        await discard_upload(stored)
+    if created:
+        background_tasks.add_task(generate_derivatives, db_media.sha256, db_media.url)
     return {
         "result": True,
         "media_id": db_media.id
@@ -107,20 +197,125 @@ async def upload_media(file: UploadFile = File(...), db: AsyncSession = Depends(
 
 
 @api_router.get("/tweets", response_model=schemas.TweetResponse)
-async def read_tweets(api_key: str = Depends(crud.get_api_key), db: AsyncSession = Depends(get_db)):
-    user = await crud.get_user(db, api_key=api_key)
+async def read_tweets(
+        request: Request,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
-    tweets = await crud.get_tweets(db)
-    if not tweets:
-        raise HTTPException(status_code=404, detail="No tweets found")
-    return {
+    params = {"limit": limit, "cursor": cursor}
+    versions = await response_cache.versions([FEED], db)
+    headers, not_modified = await response_cache.conditional(request, "tweets", params, versions)
+    if not_modified:
+        return not_modified
+
+    # The payload is built from trusted rows, so it is encoded once and cached as bytes
+    async def build():
+        tweets, next_cursor = await crud.get_tweets(db, limit=limit, cursor=cursor)
+        if not tweets:
+            raise HTTPException(status_code=404, detail="No tweets found")
+        return orjson.dumps({
+            "result": True,
+            "tweets": tweets,
+            "next_cursor": next_cursor
+        })
+
+    body = await response_cache.get_or_build("tweets", params, versions, build)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@api_router.get("/tweets/search", response_model=schemas.TweetResponse)
+async def search_tweets(
+        q: str = Query(..., min_length=1, max_length=256),
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    tweets, next_cursor = await crud.search_tweets(db, q, limit=limit, cursor=cursor)
+    return ORJSONResponse({
         "result": True,
-        "tweets": tweets
-    }
+        "tweets": tweets,
+        "next_cursor": next_cursor
+    })
+
+
+@api_router.get("/tags/{tag}/tweets", response_model=schemas.TweetResponse)
+async def read_tag_tweets(
+        tag: str,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    tweets, next_cursor = await crud.get_tweets_by_tag(db, tag.lstrip("#"), limit=limit, cursor=cursor)
+    return ORJSONResponse({
+        "result": True,
+        "tweets": tweets,
+        "next_cursor": next_cursor
+    })
+
+
+@api_router.get("/users/{user_id}/mentions", response_model=schemas.TweetResponse)
+async def read_mentions(
+        user_id: int,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    tweets, next_cursor = await crud.get_mentions(db, user_id, limit=limit, cursor=cursor)
+    return ORJSONResponse({
+        "result": True,
+        "tweets": tweets,
+        "next_cursor": next_cursor
+    })
+
+
+@api_router.get("/timeline", response_model=schemas.TweetResponse)
+async def read_timeline(
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    tweets, next_cursor = await crud.get_home_timeline(db, user.id, limit=limit, cursor=cursor)
+    return ORJSONResponse({
+        "result": True,
+        "tweets": tweets,
+        "next_cursor": next_cursor
+    })
 
 
 @api_router.delete("/tweets/{tweet_id}")
@@ -129,50 +324,77 @@ async def delete_tweet(
         api_key: str = Depends(crud.get_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    user = await crud.get_user(db, api_key=api_key)
+    user = await crud.get_principal(db, api_key)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
 
-    try:
-        tweet = await crud.get_tweet(db, tweet_id=tweet_id)
-        if not tweet:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Tweet not found"
-            )
-        if tweet.author_id != user.id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="You can only delete your own tweets"
-            )
-        if tweet.media:
-            for m in tweet.media:
-                filename = Path(m.url).name
-                media_path = MEDIA_ROOT / filename
-                if media_path.exists():
-                    media_path.unlink()
-                else:
-                    logger.info(f'File not found {media_path=}')
-
-        await crud.delete_tweet(db, tweet_id=tweet_id, user_id=user.id)
-        return {"result": True}
-    except HTTPException as e:
-        raise {
-            "result": False,
-            "error_type": e,
-            "error_message": str
-        }
+    tweet = await crud.get_tweet(db, tweet_id=tweet_id)
+    if not tweet:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Tweet not found"
+        )
+    if tweet.author_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You can only delete your own tweets"
+        )
+
+    released = await crud.delete_tweet(db, tweet_id=tweet_id, user_id=user.id)
+    deletion_queue.enqueue(released)
+    return {"result": True}
 
 
 @api_router.get("/users/{user_id}")
-async def get_user(user_id: int, db: AsyncSession = Depends(get_db)):
-    db_user = await crud.get_user(db, id=user_id)
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return await crud.get_user_response(db_user)
+async def get_user(
+        user_id: int,
+        request: Request,
+        db: AsyncSession = Depends(get_read_db)
+):
+    return await read_user_profile(request, db, user_id)
+
+
+async def read_follow_list(request: Request, db: AsyncSession, kind: str, user_id: int, limit: int, cursor):
+    params = {"id": user_id, "limit": limit, "cursor": cursor}
+    versions = await response_cache.versions([user_entity(user_id)], db)
+    headers, not_modified = await response_cache.conditional(request, kind, params, versions)
+    if not_modified:
+        return not_modified
+
+    async def build():
+        if not await crud.get_user(db, id=user_id):
+            raise HTTPException(status_code=404, detail="User not found")
+        read_page = follows.get_followers_page if kind == "followers" else follows.get_following_page
+        users, next_cursor = await read_page(db, user_id, limit=limit, cursor=cursor)
+        return orjson.dumps({"result": True, "users": users, "next_cursor": next_cursor})
+
+    body = await response_cache.get_or_build(kind, params, versions, build)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@api_router.get("/users/{user_id}/followers", response_model=schemas.UserListResponse)
+async def read_followers(
+        user_id: int,
+        request: Request,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_read_db)
+):
+    return await read_follow_list(request, db, "followers", user_id, limit, cursor)
+
+
+@api_router.get("/users/{user_id}/following", response_model=schemas.UserListResponse)
+async def read_following(
+        user_id: int,
+        request: Request,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        db: AsyncSession = Depends(get_read_db)
+):
+    return await read_follow_list(request, db, "following", user_id, limit, cursor)
 
 
 @api_router.post("/tweets/{tweet_id}/likes")
@@ -181,21 +403,13 @@ async def add_like(
         api_key: str = Depends(crud.get_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    user = await crud.get_user(db, api_key=api_key)
+    user = await crud.get_principal(db, api_key)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    try:
-        await crud.add_like(db, tweet_id=tweet_id, user_id=user.id)
-        return {"result": True}
-
-    except HTTPException as e:
-        raise {
-            "result": False,
-            "error_type": e,
-            "error_message": str
-        }
+    await crud.add_like(db, tweet_id=tweet_id, user_id=user.id)
+    return {"result": True}
 
 
 @api_router.delete("/tweets/{tweet_id}/likes")
@@ -204,20 +418,12 @@ async def unlike_tweet(
         api_key: str = Depends(crud.get_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    user = await crud.get_user(db, api_key=api_key)
+    user = await crud.get_principal(db, api_key)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    try:
-        await crud.remove_like(db, tweet_id=tweet_id, user_id=user.id)
-        return {"result": True}
-
-    except HTTPException as e:
-        raise {
-            "result": False,
-            "error_type": e,
-            "error_message": str
-        }
+    await crud.remove_like(db, tweet_id=tweet_id, user_id=user.id)
+    return {"result": True}
 
 
 @api_router.post("/users/{followed_id}/follow")
@@ -226,20 +432,12 @@ async def follow_user(
         api_key: str = Depends(crud.get_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    follower = await crud.get_user(db, api_key=api_key)
+    follower = await crud.get_principal(db, api_key)
     if not follower:
         raise HTTPException(status_code=404, detail="User not found")
 
-    try:
-        await crud.add_follower(db, follower_id=follower.id, followed_id=followed_id)
-        return {"result": True}
-
-    except HTTPException as e:
-        raise {
-            "result": False,
-            "error_type": e,
-            "error_message": str
-        }
+    await crud.add_follower(db, follower_id=follower.id, followed_id=followed_id)
+    return {"result": True}
 
 
 @api_router.delete("/users/{followed_id}/follow")
@@ -248,21 +446,61 @@ async def unfollow(
         api_key: str = Depends(crud.get_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    follower = await crud.get_user(db, api_key=api_key)
+    follower = await crud.get_principal(db, api_key)
 
     if not follower:
         raise HTTPException(status_code=404, detail="User not found")
 
-    try:
-        await crud.remove_follower(db, follower_id=follower.id, followed_id=followed_id)
-        return {"result": True}
-
-    except HTTPException as e:
-        raise {
-            "result": False,
-            "error_type": e,
-            "error_message": str
-        }
+    await crud.remove_follower(db, follower_id=follower.id, followed_id=followed_id)
+    return {"result": True}
+
+
+@api_router.post("/events/token")
+async def create_stream_token(
+        response: Response,
+        api_key: str = Depends(crud.get_api_key),
+        db: AsyncSession = Depends(get_read_db)
+):
+    user = await crud.get_principal(db, api_key)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    # EventSource cannot set headers; a cookie keeps the credential out of URLs and access logs
+    response.set_cookie(
+        STREAM_TOKEN_COOKIE,
+        issue_stream_token(user.id, api_key),
+        max_age=EVENTS_TOKEN_SECONDS,
+        path="/api/events",
+        httponly=True,
+        samesite="strict",
+    )
+    return {"result": True, "expires_in": EVENTS_TOKEN_SECONDS}
+
+
+@api_router.get("/events")
+async def stream_events(
+        api_key: Optional[str] = Header(None, alias="api-key"),
+        stream_token: Optional[str] = Cookie(None, alias=STREAM_TOKEN_COOKIE),
+        db: AsyncSession = Depends(get_read_db)
+):
+    if api_key:
+        user = await crud.get_principal(db, api_key)
+    else:
+        user = await crud.get_stream_principal(db, stream_token or "")
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    # The stream outlives the request, so it must not keep a pooled connection checked out
+    await db.close()
+    return StreamingResponse(
+        event_hub.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 app.include_router(api_router)
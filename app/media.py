@@ -0,0 +1,220 @@
+import hashlib
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+STATIC_DIR = Path(__file__).resolve().parent.parent / "static"
+MEDIA_ROOT = STATIC_DIR / "media"
+MEDIA_URL_PREFIX = "static/media"
+
+MEDIA_MAX_SIZE = int(os.getenv("MEDIA_MAX_SIZE", str(20 * 1024 * 1024)))
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(1024 * 1024)))
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+# Internal nginx location aliased to MEDIA_ROOT; when empty the worker streams the bytes itself
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX", "")
+# Blob names are content hashes, so a URL never changes meaning
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_SUFFIX_RE = re.compile(r"^\.[a-z0-9]{1,10}$")
+
+
+@dataclass
+class StoredFile:
+    temp_path: Path
+    size: int
+    sha256: str
+    suffix: str
+
+
+def blob_relative_path(sha256: str, suffix: str) -> str:
+    # Two levels of 256-way sharding keep every directory small
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{suffix}"
+
+
+def blob_url(sha256: str, suffix: str) -> str:
+    return f"{MEDIA_URL_PREFIX}/{blob_relative_path(sha256, suffix)}"
+
+
+def media_path(url: str) -> Path:
+    return MEDIA_ROOT / url.removeprefix(f"{MEDIA_URL_PREFIX}/")
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File is larger than {MEDIA_MAX_SIZE} bytes"
+    )
+
+
+class _UploadSink:
+    # python-multipart callbacks: the file part is hashed and written as it arrives, other parts are dropped
+    def __init__(self, field: str):
+        self.field = field
+        self.headers = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.active = False
+        self.tmp = None
+        self.filename = ""
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        if options.get(b"name") == self.field.encode() and self.tmp is None:
+            self.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+            # Temp file lives under MEDIA_ROOT so the final rename is atomic
+            self.tmp = tempfile.NamedTemporaryFile(dir=MEDIA_ROOT, prefix=".upload-", delete=False)
+            self.active = True
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self.active:
+            return
+        self.size += end - start
+        if self.size > MEDIA_MAX_SIZE:
+            raise _too_large()
+        chunk = data[start:end]
+        self.digest.update(chunk)
+        self.tmp.write(chunk)
+
+    def on_part_end(self):
+        self.active = False
+
+    def callbacks(self) -> dict:
+        return {name: getattr(self, name) for name in dir(self) if name.startswith("on_")}
+
+    def discard(self):
+        if self.tmp is not None:
+            self.tmp.close()
+            os.unlink(self.tmp.name)
+
+
+async def receive_upload(request: Request, field: str = "file") -> StoredFile:
+    # Starlette's form parsing would spool the whole body before the handler runs, so the body is parsed here
+    limit = MEDIA_MAX_SIZE + MULTIPART_OVERHEAD
+    try:
+        declared = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Content-Length")
+    if declared > limit:
+        raise _too_large()
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected multipart/form-data")
+
+    await run_in_threadpool(MEDIA_ROOT.mkdir, parents=True, exist_ok=True)
+    sink = _UploadSink(field)
+    parser = MultipartParser(options[b"boundary"], sink.callbacks())
+    received = 0
+    buffer = bytearray()
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise _too_large()
+            buffer += chunk
+            # Disk writes happen in the thread pool, one hop per MEDIA_CHUNK_SIZE rather than per network read
+            if len(buffer) >= MEDIA_CHUNK_SIZE:
+                await run_in_threadpool(parser.write, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(parser.write, bytes(buffer))
+        parser.finalize()
+        if sink.tmp is None:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Missing '{field}' file")
+        await run_in_threadpool(sink.tmp.close)
+    except MultipartParseError:
+        await run_in_threadpool(sink.discard)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid multipart body")
+    except BaseException:
+        await run_in_threadpool(sink.discard)
+        raise
+
+    suffix = Path(sink.filename).suffix.lower()
+    if not _SUFFIX_RE.match(suffix):
+        suffix = ""
+    return StoredFile(temp_path=Path(sink.tmp.name), size=sink.size, sha256=sink.digest.hexdigest(), suffix=suffix)
+
+
+def _place(temp_path: Path, url: str):
+    # Always replaced: an existing file may be a copy whose deletion is already queued
+    target = media_path(url)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(temp_path, target)
+
+
+async def place_upload(stored: StoredFile, url: str):
+    await run_in_threadpool(_place, stored.temp_path, url)
+
+
+async def discard_upload(stored: StoredFile):
+    await run_in_threadpool(stored.temp_path.unlink, missing_ok=True)
+
+
+def _remove(urls: Iterable[str]):
+    for url in urls:
+        media_path(url).unlink(missing_ok=True)
+
+
+async def remove_files(urls: Iterable[str]):
+    await run_in_threadpool(_remove, list(urls))
+
+
+class MediaFileResponse(FileResponse):
+    # Every chunk is a thread hop, the 64 KiB default costs more in hops than in copying
+    chunk_size = MEDIA_CHUNK_SIZE
+
+
+class MediaFiles(StaticFiles):
+    def __init__(self, *args, accel_redirect_prefix: str = MEDIA_ACCEL_REDIRECT_PREFIX, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accel_redirect_prefix = accel_redirect_prefix
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # Uploads in progress are dot-files in the same tree
+        if any(part.startswith(".") for part in Path(path).parts):
+            return Response(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        headers = {"Cache-Control": MEDIA_CACHE_CONTROL}
+        media_type = guess_type(str(full_path))[0] or "application/octet-stream"
+        if self.accel_redirect_prefix:
+            # nginx answers Range, ETag and If-Modified-Since from its own stat of the file
+            relative = os.path.relpath(full_path, os.path.realpath(self.directory))
+            headers["X-Accel-Redirect"] = self.accel_redirect_prefix + quote(relative)
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+        response = MediaFileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, headers=headers, media_type=media_type
+        )
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import math
+import os
+import secrets
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fastapi import Header, HTTPException
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the slow-request log; statements are only collected while it is on
+SLOW_REQUEST_SECONDS = float(os.getenv('METRICS_SLOW_REQUEST_SECONDS', '0'))
+LOOP_LAG_INTERVAL = float(os.getenv('METRICS_LOOP_LAG_INTERVAL', '0.5'))
+# Guards /metrics and /stats/*; empty leaves them to the nginx allow list
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def require_token(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=403, detail="Metrics token required")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Gauge:
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.read = read
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {_number(self.read())}"
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Iterable[float], labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.label_names = labels
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels) -> int:
+        series = self.series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+ROUTE_LABELS = ("method", "route", "status")
+
+request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "Request latency by route", LATENCY_BUCKETS, ROUTE_LABELS
+))
+request_queries = registry.register(Histogram(
+    "http_request_db_queries", "SQL statements per request", QUERY_COUNT_BUCKETS, ROUTE_LABELS
+))
+request_db_seconds = registry.register(Histogram(
+    "http_request_db_seconds", "Time spent in SQL per request", LATENCY_BUCKETS, ROUTE_LABELS
+))
+db_queries = registry.register(Counter("db_queries_total", "SQL statements executed"))
+db_seconds = registry.register(Counter("db_query_seconds_total", "Time spent executing SQL"))
+pool_wait_seconds = registry.register(Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled connection", LATENCY_BUCKETS
+))
+loop_lag_seconds = registry.register(Histogram(
+    "event_loop_lag_seconds", "Delay of event loop wake-ups past their deadline", LATENCY_BUCKETS
+))
+
+
+def process_uptime() -> float:
+    # Measured from the kernel's process start, so interpreter start-up and imports are included
+    try:
+        with open("/proc/self/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, AttributeError, ValueError, IndexError):
+        return time.perf_counter() - _IMPORTED_AT
+
+
+_IMPORTED_AT = time.perf_counter()
+
+
+class StartupTimes:
+    def __init__(self):
+        self.ready: Optional[float] = None
+        self.first_request: Optional[float] = None
+
+    def mark_ready(self):
+        self.ready = process_uptime()
+        logger.info("Воркер готов через %.2f с после запуска процесса", self.ready)
+
+    def mark_first_request(self):
+        self.first_request = process_uptime()
+        logger.info("Первый запрос обслужен через %.2f с после запуска процесса", self.first_request)
+
+
+startup = StartupTimes()
+registry.register(Gauge(
+    "process_startup_seconds", "Process start to the end of lifespan start-up", lambda: startup.ready or 0
+))
+registry.register(Gauge(
+    "process_first_request_seconds", "Process start to the first served request", lambda: startup.first_request or 0
+))
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "pool_wait_seconds", "statements")
+
+    def __init__(self, collect_statements: bool = False):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.statements: Optional[List[Tuple[float, str]]] = [] if collect_statements else None
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    db_queries.inc()
+    db_seconds.inc(elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        if stats.statements is not None:
+            stats.statements.append((elapsed, statement))
+
+
+def record_pool_wait(seconds: float):
+    pool_wait_seconds.observe(seconds)
+    stats = current_request.get()
+    if stats is not None:
+        stats.pool_wait_seconds += seconds
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats(collect_statements=SLOW_REQUEST_SECONDS > 0)
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            # Label by route template so path parameters don't explode the series count
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route else "other", status)
+            request_seconds.observe(elapsed, *labels)
+            request_queries.observe(stats.queries, *labels)
+            request_db_seconds.observe(stats.db_seconds, *labels)
+            if SLOW_REQUEST_SECONDS > 0 and elapsed >= SLOW_REQUEST_SECONDS:
+                log_slow_request(scope, status, elapsed, stats)
+            if startup.first_request is None:
+                startup.mark_first_request()
+
+
+def log_slow_request(scope, status: int, elapsed: float, stats: RequestStats):
+    lines = [f"  {seconds * 1000:.1f} мс: {' '.join(statement.split())}" for seconds, statement in stats.statements]
+    logger.warning(
+        "Медленный запрос %s %s -> %s: %.3f с, SQL-запросов %s (%.3f с), ожидание пула %.3f с\n%s",
+        scope["method"], scope["path"], status, elapsed,
+        stats.queries, stats.db_seconds, stats.pool_wait_seconds, "\n".join(lines),
+    )
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        deadline = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - deadline))
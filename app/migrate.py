@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+# Schema that create_all produced before migrations existed
+BASELINE_REVISION = "0001"
+# Any fixed key works, it only has to be the same for every process that migrates this database
+MIGRATION_LOCK_ID = 7_346_101
+MIGRATION_LOCK_POLL_SECONDS = 0.2
+
+
+def alembic_config(connection: Connection = None) -> Config:
+    config = Config(str(ROOT_DIR / "alembic.ini"))
+    config.attributes["configure_logger"] = False
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+def is_current(connection: Connection, config: Config) -> bool:
+    heads = set(ScriptDirectory.from_config(config).get_heads())
+    return set(MigrationContext.configure(connection).get_current_heads()) == heads
+
+
+def upgrade(connection: Connection, revision: str = "head"):
+    config = alembic_config(connection)
+    if revision == "head" and is_current(connection, config):
+        logger.info("Схема БД актуальна, миграции не нужны")
+        return
+
+    inspector = inspect(connection)
+    unversioned = not inspector.has_table("alembic_version") and inspector.has_table("users")
+    # Alembic manages its own transactions, including autocommit blocks for CONCURRENTLY
+    connection.commit()
+
+    if unversioned:
+        logger.info("Помечаем существующую схему как %s", BASELINE_REVISION)
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, revision)
+
+
+async def acquire_migration_lock(connection: AsyncConnection):
+    # Polled rather than blocking: a waiter idling inside a transaction would deadlock
+    # against the holder's CREATE INDEX CONCURRENTLY, which waits for every open transaction
+    while True:
+        locked = await connection.scalar(text("SELECT pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        await connection.commit()
+        if locked:
+            return
+        await asyncio.sleep(MIGRATION_LOCK_POLL_SECONDS)
+
+
+async def migrate(engine: AsyncEngine, revision: str = "head"):
+    # Workers and replicas starting together queue here; whoever comes second finds the schema current
+    async with engine.connect() as connection:
+        await acquire_migration_lock(connection)
+        try:
+            await connection.run_sync(upgrade, revision)
+        finally:
+            await connection.rollback()
+            await connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            await connection.commit()
+
+
+async def prepare_database(engine: AsyncEngine):
+    await migrate(engine)
+    if os.getenv("ENV") == "development":
+        from .database import init_test_data, session_factory
+
+        logger.info("Заполнение тестовыми данными")
+        async with session_factory(engine)() as session:
+            await init_test_data(session)
+        logger.info("Инициализация БД завершена")
+    else:
+        logger.info("БД уже инициализирована, пропускаем создание таблиц")
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate(engine))
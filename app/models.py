@@ -1,5 +1,6 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Boolean, Column, Computed, DateTime, ForeignKey, Index, Integer, Sequence, String, Text, UniqueConstraint, false, func, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, relationship
 from datetime import datetime, timezone
 from .database import Base
 
@@ -10,11 +11,20 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     api_key = Column(String, unique=True, index=True)
     name = Column(String)
+    is_celebrity = Column(Boolean, default=False, server_default=false(), nullable=False)
+    # Maintained by crud on follow / unfollow so profiles never count the follows table
+    followers_count = Column(Integer, default=0, server_default=text("0"), nullable=False)
+    following_count = Column(Integer, default=0, server_default=text("0"), nullable=False)
     tweets = relationship("Tweet", back_populates="author")
     likes = relationship("Like", back_populates="user", cascade="all, delete-orphan")
     followers = relationship("Follow", foreign_keys="Follow.followed_id", back_populates="followed")
     following = relationship("Follow", foreign_keys="Follow.follower_id", back_populates="follower")
 
+    __table_args__ = (
+        # Mentions are resolved by name
+        Index("ix_users_name_lower", func.lower(name)),
+    )
+
 
 class Tweet(Base):
     __tablename__ = "tweets"
@@ -30,7 +40,29 @@ class Tweet(Base):
         cascade="all, delete-orphan",
         passive_deletes=True
     )
-    created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Kept by Postgres itself; deferred so feed queries never drag it along
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed("to_tsvector('simple'::regconfig, COALESCE(tweet_data, ''::text))", persisted=True)
+    ))
+
+    __table_args__ = (
+        Index("ix_tweets_created_at_id", "created_at", "id"),
+        Index("ix_tweets_author_created_at_id", "author_id", "created_at", "id"),
+        Index("ix_tweets_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
+
+class MediaBlob(Base):
+    __tablename__ = "media_blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    url = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    thumbnail_url = Column(String)
+    web_url = Column(String)
 
 
 class Media(Base):
@@ -38,7 +70,14 @@ class Media(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     url = Column(String)
+    sha256 = Column(String(64), ForeignKey("media_blobs.sha256"), index=True)
     tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"))
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), server_default=func.now())
+    blob = relationship("MediaBlob")
+
+    __table_args__ = (
+        Index("ix_medias_tweet_id", "tweet_id"),
+    )
 
 
 class Like(Base):
@@ -50,6 +89,11 @@ class Like(Base):
     user = relationship("User", back_populates="likes")
     tweet = relationship("Tweet", back_populates="likes")
 
+    __table_args__ = (
+        UniqueConstraint("user_id", "tweet_id", name="uq_likes_user_tweet"),
+        Index("ix_likes_tweet_id", "tweet_id"),
+    )
+
 
 class Follow(Base):
     __tablename__ = "follows"
@@ -59,3 +103,66 @@ class Follow(Base):
     followed_id = Column(Integer, ForeignKey("users.id"))
     follower = relationship("User", foreign_keys=[follower_id], back_populates="following")
     followed = relationship("User", foreign_keys=[followed_id], back_populates="followers")
+
+    __table_args__ = (
+        UniqueConstraint("follower_id", "followed_id", name="uq_follows_follower_followed"),
+        Index("ix_follows_followed_follower", "followed_id", "follower_id"),
+    )
+
+
+class TimelineEntry(Base):
+    __tablename__ = "timelines"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True)
+    author_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_timelines_user_created_tweet", "user_id", "created_at", "tweet_id"),
+        Index("ix_timelines_user_author", "user_id", "author_id"),
+        # Deleting a tweet cascades here; without it every delete scans the whole table
+        Index("ix_timelines_tweet_id", "tweet_id"),
+    )
+
+
+class Hashtag(Base):
+    __tablename__ = "hashtags"
+
+    id = Column(Integer, primary_key=True)
+    tag = Column(String(100), nullable=False, unique=True)
+
+
+class TweetHashtag(Base):
+    __tablename__ = "tweet_hashtags"
+
+    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True)
+    hashtag_id = Column(Integer, ForeignKey("hashtags.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_tweet_hashtags_tag_created_tweet", "hashtag_id", "created_at", "tweet_id"),
+    )
+
+
+class Mention(Base):
+    __tablename__ = "mentions"
+
+    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_mentions_user_created_tweet", "user_id", "created_at", "tweet_id"),
+    )
+
+
+class CacheVersion(Base):
+    # Response cache versions shared by all workers, see app.response_cache.PostgresBackend
+    __tablename__ = "cache_versions"
+
+    entity = Column(String, primary_key=True)
+    version = Column(BigInteger, primary_key=True)
+
+
+cache_version_seq = Sequence("cache_version_seq", metadata=Base.metadata)
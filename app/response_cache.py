@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import database
+from .cache import LRUCache
+
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+
+FEED = "feed"
+# Session.info key for bumps of backends that cannot join the write's transaction
+PENDING_BUMPS = "pending_cache_bumps"
+
+
+def user_entity(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_pending(session: Session):
+    for backend, keys in session.info.pop(PENDING_BUMPS, ()):
+        backend.incr_committed(*keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session: Session):
+    session.info.pop(PENDING_BUMPS, None)
+
+
+class MemoryBackend:
+    # Versions live in this process only, so other workers' writes are not seen
+    shared = False
+    transactional = False
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.epoch = uuid.uuid4().hex
+        self.values = LRUCache(maxsize=maxsize, ttl=ttl)
+        # Counters are never evicted, otherwise a version could go back to a cached value
+        self.counters: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.values.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self.values.set(key, value)
+
+    async def get_counters(self, keys: List[str], db: Optional[AsyncSession] = None) -> List[int]:
+        return [self.counters.get(key, 0) for key in keys]
+
+    async def incr(self, *keys: str):
+        self.incr_committed(*keys)
+
+    def incr_committed(self, *keys: str):
+        for key in keys:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def clear(self):
+        self.values.clear()
+        self.counters.clear()
+
+
+class PostgresBackend:
+    # Versions are shared by every worker through Postgres; bodies stay in this process, keyed by those versions
+    shared = True
+    transactional = True
+    epoch = "postgres"
+
+    # An entity's version is the set of its live rows: each commit adds a value no earlier state had
+    SELECT = text("""
+        SELECT entity, array_agg(version ORDER BY version) FROM cache_versions
+        WHERE entity = ANY(:entities) GROUP BY entity
+    """)
+    # Each bump inserts its own row from the sequence instead of updating a shared one, so writes never wait
+    # on each other; older rows go with it unless another bump has them, those are left to the next one
+    BUMP = text("""
+        WITH replaced AS (
+            DELETE FROM cache_versions WHERE ctid IN (
+                SELECT ctid FROM cache_versions WHERE entity = ANY(:entities) FOR UPDATE SKIP LOCKED
+            )
+        )
+        INSERT INTO cache_versions (entity, version)
+        SELECT entity, nextval('cache_version_seq') FROM unnest(CAST(:entities AS text[])) AS entity
+    """)
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.values = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.values.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self.values.set(key, value)
+
+    async def get_counters(self, keys: List[str], db: Optional[AsyncSession] = None) -> List[tuple]:
+        # Read on the session that builds the body: a replica only shows a version once it has replayed the write
+        if db is None:
+            async with database.AsyncSessionLocal() as session:
+                return await self.get_counters(keys, session)
+        found = dict((await db.execute(self.SELECT, {"entities": keys})).all())
+        return [tuple(found.get(key, ())) for key in keys]
+
+    async def incr(self, *keys: str, db: Optional[AsyncSession] = None):
+        if db is not None:
+            await db.execute(self.BUMP, {"entities": sorted(set(keys))})
+            return
+        async with database.AsyncSessionLocal() as session:
+            await self.incr(*keys, db=session)
+            await session.commit()
+
+    def clear(self):
+        self.values.clear()
+
+
+class RedisBackend:
+    shared = True
+    transactional = False
+    epoch = "redis"
+
+    def __init__(self, client):
+        self.client = client
+        self._pending: Set[asyncio.Task] = set()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.set(key, value, ex=max(1, int(ttl)))
+
+    async def get_counters(self, keys: List[str], db: Optional[AsyncSession] = None) -> List[int]:
+        return [int(raw) if raw is not None else 0 for raw in await self.client.mget(keys)]
+
+    async def incr(self, *keys: str):
+        for key in keys:
+            await self.client.incr(key)
+
+    def incr_committed(self, *keys: str):
+        # Commit hooks are synchronous, the increments follow on the loop right after
+        task = asyncio.get_running_loop().create_task(self.incr(*keys))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def clear(self):
+        pass
+
+
+def make_backend(url: str = RESPONSE_CACHE_URL):
+    if url.startswith(("redis://", "rediss://")):
+        import redis.asyncio
+
+        return RedisBackend(redis.asyncio.from_url(url))
+    if url == "memory":
+        return MemoryBackend()
+    return PostgresBackend()
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl: float = RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def bump(self, *entities: str, db: Optional[AsyncSession] = None):
+        # With a session the bump belongs to the write: it lands when the write commits and is lost if it rolls back
+        keys = [f"version:{entity}" for entity in entities]
+        if db is None:
+            await self.backend.incr(*keys)
+        elif self.backend.transactional:
+            await self.backend.incr(*keys, db=db)
+        else:
+            db.info.setdefault(PENDING_BUMPS, []).append((self.backend, keys))
+
+    async def versions(self, entities: Iterable[str], db: Optional[AsyncSession] = None) -> tuple:
+        return tuple(await self.backend.get_counters([f"version:{entity}" for entity in entities], db))
+
+    async def get_or_build(
+            self,
+            endpoint: str,
+            params: dict,
+            versions: tuple,
+            build: Callable[[], Awaitable[bytes]],
+    ) -> bytes:
+        key = f"response:{endpoint}:{sorted(params.items())}:{versions}"
+
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        # One rebuild per key; concurrent misses wait for it instead of hitting the DB
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.builds += 1
+            value = await build()
+            await self.backend.set(key, value, self.ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def etag(self, endpoint: str, params: dict, versions: tuple) -> str:
+        # Only shared versions go in, so every worker answers the same poll with the same tag
+        parts = [self.backend.epoch, endpoint, sorted(params.items()), versions]
+        return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+    async def conditional(
+            self,
+            request: Request,
+            endpoint: str,
+            params: dict,
+            versions: tuple,
+    ) -> Tuple[dict, Optional[Response]]:
+        etag = self.etag(endpoint, params, versions)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if etag in candidates or "*" in candidates:
+                return headers, Response(status_code=304, headers=headers)
+        return headers, None
+
+    def clear(self):
+        self.backend.clear()
+        self._inflight.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache(make_backend())
@@ -28,6 +28,8 @@ class FollowerInfo(BaseModel):
 
 
 class UserById(UserBase):
+    followers_count: int
+    following_count: int
     followers: list[FollowerInfo]
     following: list[FollowerInfo]
 
@@ -37,6 +39,12 @@ class UserMeResponse(BaseModel):
     user: UserById
 
 
+class UserListResponse(BaseModel):
+    result: bool
+    users: list[FollowerInfo]
+    next_cursor: Optional[str] = None
+
+
 class LikeSchema(BaseModel):
     user_id: int
     name: str
@@ -46,10 +54,14 @@ class TweetSchema(BaseModel):
     id: int
     content: str
     attachments: Optional[List[str]]
+    attachment_web: Optional[List[str]] = None
+    attachment_originals: Optional[List[str]] = None
     author: 'UserBase'
     likes: List['LikeSchema']
+    highlight: Optional[str] = None
 
 
 class TweetResponse(BaseModel):
     result: bool
     tweets: list['TweetSchema']
+    next_cursor: Optional[str] = None
@@ -0,0 +1,74 @@
+import html
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import cast, func, select, tuple_
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .pagination import decode_search_cursor, encode_search_cursor
+
+# Must match the configuration of the generated tweets.search_vector column
+SEARCH_CONFIG = "simple"
+# Ranking looks at this many of the newest matches, so common words cost the same as rare ones
+CANDIDATE_LIMIT = int(os.getenv("SEARCH_CANDIDATE_LIMIT", "1000"))
+HEADLINE_OPTIONS = "StartSel=\x02, StopSel=\x03, MaxWords=30, MinWords=10, MaxFragments=2"
+
+
+def render_highlight(headline: str) -> str:
+    # Tweet text is user input: escape it, then turn the match markers into tags
+    return html.escape(headline).replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+async def search_page(
+        db: AsyncSession,
+        text: str,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[int], Dict[int, str], Optional[str]]:
+    position = decode_search_cursor(cursor)
+    query = func.websearch_to_tsquery(cast(SEARCH_CONFIG, REGCONFIG), text)
+
+    candidates = (
+        select(models.Tweet.id, models.Tweet.search_vector)
+        .where(models.Tweet.search_vector.op("@@")(query))
+        .order_by(models.Tweet.created_at.desc(), models.Tweet.id.desc())
+        .limit(CANDIDATE_LIMIT)
+    )
+    if position:
+        # Later pages rank the same window as the first one, however many tweets arrived since
+        candidates = candidates.where(models.Tweet.id <= position[2])
+    candidates = candidates.subquery()
+
+    ranked = select(
+        candidates.c.id,
+        func.ts_rank_cd(candidates.c.search_vector, query).label("rank"),
+        func.max(candidates.c.id).over().label("snapshot_id"),
+    ).subquery()
+    page = select(ranked)
+    if position:
+        page = page.where(tuple_(ranked.c.rank, ranked.c.id) < position[:2])
+    page = page.order_by(ranked.c.rank.desc(), ranked.c.id.desc()).limit(limit + 1).subquery()
+
+    # Headlines are the expensive part, so they are built for the page rows only
+    result = await db.execute(
+        select(
+            page.c.id,
+            page.c.rank,
+            page.c.snapshot_id,
+            func.ts_headline(
+                cast(SEARCH_CONFIG, REGCONFIG), models.Tweet.tweet_data, query, HEADLINE_OPTIONS
+            ).label("headline"),
+        )
+        .join(models.Tweet, models.Tweet.id == page.c.id)
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1].rank, rows[-1].id, rows[-1].snapshot_id)
+    highlights = {row.id: render_highlight(row.headline) for row in rows}
+    return [row.id for row in rows], highlights, next_cursor
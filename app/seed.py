@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import follows, media, tags, timeline
+from .database import session_factory
+from .response_cache import FEED, response_cache, user_entity
+
+logger = logging.getLogger(__name__)
+
+TABLES = "users, tweets, likes, follows, medias, media_blobs, timelines, hashtags, tweet_hashtags, mentions"
+API_KEY_PREFIX = "seed_"
+WORDS = (
+    "python fastapi postgres async query index cache timeline feed tweet follow like "
+    "media photo travel coffee music weekend release deploy bug fix review "
+    "morning evening city sea mountain book film game team launch idea question "
+    "today tomorrow news update benchmark latency throughput worker server client"
+).split()
+
+Rows = Callable[[random.Random, int, int], Iterator[tuple]]
+
+
+@dataclass
+class SeedConfig:
+    users: int = 100_000
+    tweets: int = 1_000_000
+    follows: int = 2_000_000
+    likes: int = 5_000_000
+    media_ratio: float = 0.1
+    # Larger exponents concentrate followers / likes on fewer users / tweets
+    follow_exponent: float = 3.0
+    like_exponent: float = 4.0
+    days: int = 365
+    backfill: int = 50
+    workers: int = 4
+    batch_size: int = 50_000
+    random_seed: int = 0
+
+
+def api_key(user_id: int) -> str:
+    return f"{API_KEY_PREFIX}{user_id}"
+
+
+def skewed(rng: random.Random, n: int, exponent: float) -> int:
+    # Inverse-transform sample in [0, n): rank 0 is the most popular, the tail follows a power law
+    return min(n - 1, int(n * rng.random() ** exponent))
+
+
+def partitions(start: int, stop: int, parts: int) -> List[Tuple[int, int]]:
+    step = max(1, -(-(stop - start) // parts))
+    return [(lo, min(lo + step, stop)) for lo in range(start, stop, step)]
+
+
+def batched(rows: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+class Seeder:
+    def __init__(self, engine: AsyncEngine, config: SeedConfig):
+        self.engine = engine
+        self.config = config
+        self.started_at = datetime.now(timezone.utc) - timedelta(days=config.days)
+        self.tweet_step = timedelta(days=config.days) / max(config.tweets, 1)
+
+    def tweet_created_at(self, tweet_id: int) -> datetime:
+        return self.started_at + self.tweet_step * tweet_id
+
+    def has_media(self, tweet_id: int) -> bool:
+        # Deterministic, so blob and media rows agree without sharing state
+        return (tweet_id * 2654435761) % 10_000 < self.config.media_ratio * 10_000
+
+    def user_rows(self, rng, start, stop):
+        for user_id in range(start, stop):
+            yield user_id, api_key(user_id), f"user{user_id}"
+
+    def tweet_rows(self, rng, start, stop):
+        users = self.config.users
+        for tweet_id in range(start, stop):
+            # Popular accounts also post more
+            author_id = 1 + skewed(rng, users, 1.5)
+            content = " ".join(rng.choices(WORDS, k=rng.randint(3, 25)))
+            if rng.random() < 0.3:
+                # A long tail of topics gives searches rare terms as well as common words
+                content += f" #topic{skewed(rng, 10_000, 2)}"
+            if rng.random() < 0.1:
+                content += f" @user{1 + skewed(rng, users, self.config.follow_exponent)}"
+            yield tweet_id, content, author_id, self.tweet_created_at(tweet_id)
+
+    def media_blob_rows(self, rng, start, stop):
+        for tweet_id in range(start, stop):
+            if self.has_media(tweet_id):
+                sha256 = hashlib.sha256(f"seed-{tweet_id}".encode()).hexdigest()
+                yield sha256, media.blob_url(sha256, ".jpg"), rng.randint(50_000, 3_000_000), 1
+
+    def media_rows(self, rng, start, stop):
+        for tweet_id in range(start, stop):
+            if self.has_media(tweet_id):
+                sha256 = hashlib.sha256(f"seed-{tweet_id}".encode()).hexdigest()
+                yield media.blob_url(sha256, ".jpg"), sha256, tweet_id, self.tweet_created_at(tweet_id)
+
+    def distinct(self, rng: random.Random, count: int, draw: Callable[[], int], exclude: int = None) -> set:
+        chosen = set()
+        # Skewed draws collide often near the head; give up rather than loop forever
+        for _ in range(count * 4):
+            if len(chosen) >= count:
+                break
+            value = draw()
+            if value != exclude:
+                chosen.add(value)
+        return chosen
+
+    def follow_rows(self, rng, start, stop):
+        users, average = self.config.users, self.config.follows / max(self.config.users, 1)
+        for follower_id in range(start, stop):
+            count = min(users - 1, int(rng.expovariate(1 / average))) if average else 0
+            draw = lambda: 1 + skewed(rng, users, self.config.follow_exponent)
+            for followed_id in self.distinct(rng, count, draw, exclude=follower_id):
+                yield follower_id, followed_id
+
+    def like_rows(self, rng, start, stop):
+        tweets, average = self.config.tweets, self.config.likes / max(self.config.users, 1)
+        for user_id in range(start, stop):
+            count = min(tweets, int(rng.expovariate(1 / average))) if average and tweets else 0
+            # Hot tweets are the recent ones at the head of the distribution
+            draw = lambda: tweets - skewed(rng, tweets, self.config.like_exponent)
+            for tweet_id in self.distinct(rng, count, draw):
+                yield user_id, tweet_id
+
+    async def copy(self, table: str, columns: List[str], rows: Rows, start: int, stop: int) -> int:
+        async def worker(index: int, lo: int, hi: int) -> int:
+            rng = random.Random(f"{self.config.random_seed}:{table}:{index}")
+            copied = 0
+            async with self.engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                for batch in batched(rows(rng, lo, hi), self.config.batch_size):
+                    await raw.driver_connection.copy_records_to_table(table, records=batch, columns=columns)
+                    copied += len(batch)
+            return copied
+
+        started = time.perf_counter()
+        bounds = partitions(start, stop, self.config.workers)
+        copied = sum(await asyncio.gather(*[worker(i, lo, hi) for i, (lo, hi) in enumerate(bounds)]))
+        logger.info("%s: %s строк за %.1f с", table, copied, time.perf_counter() - started)
+        return copied
+
+    async def execute(self, statement: str, **params) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(text(statement), params)
+        return result.rowcount
+
+    async def build_timelines(self) -> int:
+        statement = """
+            INSERT INTO timelines (user_id, tweet_id, author_id, created_at)
+            SELECT f.follower_id, t.id, t.author_id, t.created_at
+            FROM follows f
+            JOIN users u ON u.id = f.followed_id AND NOT u.is_celebrity
+            CROSS JOIN LATERAL (
+                SELECT id, author_id, created_at FROM tweets
+                WHERE author_id = f.followed_id
+                ORDER BY created_at DESC, id DESC
+                LIMIT :backfill
+            ) t
+            WHERE f.follower_id >= :lo AND f.follower_id < :hi
+        """
+        started = time.perf_counter()
+        bounds = partitions(1, self.config.users + 1, self.config.workers)
+        inserted = sum(await asyncio.gather(*[
+            self.execute(statement, backfill=self.config.backfill, lo=lo, hi=hi) for lo, hi in bounds
+        ]))
+        logger.info("timelines: %s строк за %.1f с", inserted, time.perf_counter() - started)
+        return inserted
+
+    async def run(self) -> dict:
+        config = self.config
+        users, tweets = (1, config.users + 1), (1, config.tweets + 1)
+        await self.execute(f"TRUNCATE {TABLES} RESTART IDENTITY CASCADE")
+
+        counts = {}
+        counts["users"] = await self.copy("users", ["id", "api_key", "name"], self.user_rows, *users)
+        counts["tweets"] = await self.copy(
+            "tweets", ["id", "tweet_data", "author_id", "created_at"], self.tweet_rows, *tweets
+        )
+        counts["media_blobs"] = await self.copy(
+            "media_blobs", ["sha256", "url", "size", "ref_count"], self.media_blob_rows, *tweets
+        )
+        counts["medias"] = await self.copy(
+            "medias", ["url", "sha256", "tweet_id", "created_at"], self.media_rows, *tweets
+        )
+        counts["follows"] = await self.copy("follows", ["follower_id", "followed_id"], self.follow_rows, *users)
+        counts["likes"] = await self.copy("likes", ["user_id", "tweet_id"], self.like_rows, *users)
+
+        # Ids were copied explicitly, so move the sequences past them
+        for table in ("users", "tweets"):
+            await self.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), GREATEST((SELECT max(id) FROM {table}), 1))"
+            )
+        # COPY bypasses crud, so the counters are filled the way a migration would
+        await asyncio.gather(*[
+            self.execute(follows.RECOUNT.text, lo=lo, hi=hi)
+            for lo, hi in partitions(1, config.users + 1, config.workers)
+        ])
+        await self.execute(
+            "UPDATE users SET is_celebrity = true WHERE followers_count > :threshold",
+            threshold=timeline.CELEBRITY_FOLLOWERS_THRESHOLD,
+        )
+        if config.backfill:
+            counts["timelines"] = await self.build_timelines()
+        # Hashtags and mentions go through the same extraction as live tweets
+        await self.execute("ANALYZE users")
+        await tags.backfill(config.batch_size, sessions=session_factory(self.engine))
+        # A running server keys its cached bodies by versions, TRUNCATE alone would leave them current
+        async with session_factory(self.engine)() as db:
+            await response_cache.bump(FEED, *(user_entity(user_id) for user_id in range(*users)), db=db)
+            await db.commit()
+
+        async with self.engine.connect() as conn:
+            for table in ("tweet_hashtags", "mentions"):
+                counts[table] = await conn.scalar(text(f"SELECT count(*) FROM {table}"))
+
+        async with self.engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text(f"ANALYZE {TABLES}"))
+        return counts
+
+
+async def seed(engine: AsyncEngine, config: SeedConfig) -> dict:
+    started = time.perf_counter()
+    counts = await Seeder(engine, config).run()
+    logger.info("Заполнение завершено за %.1f с: %s", time.perf_counter() - started, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    from .database import engine
+    from .migrate import migrate
+
+    parser = argparse.ArgumentParser(description="Truncate the database and bulk-load synthetic data")
+    for field, default in vars(SeedConfig()).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    async def main():
+        await migrate(engine)
+        await seed(engine, SeedConfig(**vars(args)))
+        await engine.dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
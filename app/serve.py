@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import math
+import os
+import time
+
+import uvicorn
+
+from . import assets, database
+from .events import EVENTS_BROKER
+from .migrate import prepare_database
+from .response_cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# 0 sizes the pool to the cores this container may actually use
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "0"))
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8000"))
+WEB_BACKLOG = int(os.getenv("WEB_BACKLOG", "2048"))
+
+
+def available_cpus() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # A CPU quota (docker --cpus) is not visible in the affinity mask
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+async def prepare():
+    # Runs once in the parent, so workers never race on DDL or on the development fixtures
+    started = time.perf_counter()
+    await prepare_database(database.engine)
+    await database.engine.dispose()
+    logger.info("Подготовка БД заняла %.2f с", time.perf_counter() - started)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    workers = WEB_WORKERS or available_cpus()
+    try:
+        # Cheap when the variants are current; covers a bundle mounted over the one built into the image
+        assets.build()
+    except OSError as e:
+        logger.warning("Не удалось сжать статику: %s", e)
+    asyncio.run(prepare())
+
+    connections = workers * (database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW)
+    logger.info("Воркеров: %s, соединений с БД до %s", workers, connections)
+    if workers > 1 and EVENTS_BROKER == "memory":
+        logger.warning("EVENTS_BROKER=memory: события ленты дойдут только до клиентов того же воркера")
+    if workers > 1 and not response_cache.backend.shared:
+        # Each worker would invalidate only its own copy and keep serving stale feeds and profiles
+        raise SystemExit("RESPONSE_CACHE_URL=memory работает только с одним воркером (WEB_WORKERS=1)")
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+    uvicorn.run(
+        "app.main:app",
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=workers,
+        backlog=WEB_BACKLOG,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+    )
+
+
+if __name__ == "__main__":
+    main()
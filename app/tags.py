@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import database, models
+from .pagination import decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = int(os.getenv("TAGS_BACKFILL_BATCH_SIZE", "5000"))
+MAX_TAG_LENGTH = 100
+
+# Not preceded by a word character, so e-mail addresses and URLs with fragments don't count
+HASHTAG_RE = re.compile(r"(?<!\w)#(\w+)")
+MENTION_RE = re.compile(r"(?<!\w)@(\w+)")
+
+TweetText = Tuple[int, Optional[str], datetime]
+
+
+def extract_hashtags(text: Optional[str]) -> List[str]:
+    tags = (tag.lower() for tag in HASHTAG_RE.findall(text or ""))
+    return list(dict.fromkeys(tag for tag in tags if len(tag) <= MAX_TAG_LENGTH))
+
+
+def extract_mentions(text: Optional[str]) -> List[str]:
+    return list(dict.fromkeys(name.lower() for name in MENTION_RE.findall(text or "")))
+
+
+async def index_tweets(db: AsyncSession, tweets: Iterable[TweetText]):
+    tweet_tags, tweet_mentions = [], []
+    for tweet_id, text, created_at in tweets:
+        tweet_tags.extend((tweet_id, tag, created_at) for tag in extract_hashtags(text))
+        tweet_mentions.extend((tweet_id, name, created_at) for name in extract_mentions(text))
+
+    if tweet_tags:
+        tags = sorted({tag for _, tag, _ in tweet_tags})
+        # DO NOTHING leaves popular tags unlocked; their ids are read back separately
+        await db.execute(
+            insert(models.Hashtag.__table__).on_conflict_do_nothing(index_elements=["tag"]),
+            [{"tag": tag} for tag in tags],
+        )
+        tag_ids = dict((await db.execute(
+            select(models.Hashtag.tag, models.Hashtag.id).where(models.Hashtag.tag.in_(tags))
+        )).all())
+        await db.execute(
+            insert(models.TweetHashtag.__table__).on_conflict_do_nothing(),
+            [
+                {"tweet_id": tweet_id, "hashtag_id": tag_ids[tag], "created_at": created_at}
+                for tweet_id, tag, created_at in tweet_tags
+            ],
+        )
+
+    if tweet_mentions:
+        names = sorted({name for _, name, _ in tweet_mentions})
+        users = (await db.execute(
+            select(func.lower(models.User.name), models.User.id)
+            .where(func.lower(models.User.name).in_(names))
+        )).all()
+        # Names are not unique, so a mention reaches everybody who carries it
+        user_ids = {}
+        for name, user_id in users:
+            user_ids.setdefault(name, []).append(user_id)
+        rows = [
+            {"tweet_id": tweet_id, "user_id": user_id, "created_at": created_at}
+            for tweet_id, name, created_at in tweet_mentions
+            for user_id in user_ids.get(name, [])
+        ]
+        if rows:
+            await db.execute(insert(models.Mention.__table__).on_conflict_do_nothing(), rows)
+
+
+async def _page(db: AsyncSession, table, key_column, key, limit: int, cursor: Optional[str]):
+    query = (
+        select(table.tweet_id, table.created_at)
+        .where(key_column == key)
+        .order_by(table.created_at.desc(), table.tweet_id.desc())
+        .limit(limit + 1)
+    )
+    position = decode_cursor(cursor)
+    if position:
+        query = query.where(tuple_(table.created_at, table.tweet_id) < position)
+
+    rows = (await db.execute(query)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].tweet_id)
+    return [row.tweet_id for row in rows], next_cursor
+
+
+async def get_tag_page(
+        db: AsyncSession,
+        tag: str,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[int], Optional[str]]:
+    hashtag_id = await db.scalar(select(models.Hashtag.id).where(models.Hashtag.tag == tag.lower()))
+    if hashtag_id is None:
+        return [], None
+    return await _page(db, models.TweetHashtag, models.TweetHashtag.hashtag_id, hashtag_id, limit, cursor)
+
+
+async def get_mentions_page(
+        db: AsyncSession,
+        user_id: int,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[int], Optional[str]]:
+    return await _page(db, models.Mention, models.Mention.user_id, user_id, limit, cursor)
+
+
+async def backfill(
+        batch_size: int = BACKFILL_BATCH_SIZE,
+        after_id: int = 0,
+        sessions: Optional[async_sessionmaker] = None,
+) -> int:
+    # Keyset over tweet ids: memory stays flat and an interrupted run resumes with --after-id
+    processed = 0
+    async with (sessions or database.AsyncSessionLocal)() as db:
+        while True:
+            rows = (await db.execute(
+                select(models.Tweet.id, models.Tweet.tweet_data, models.Tweet.created_at)
+                .where(models.Tweet.id > after_id)
+                .order_by(models.Tweet.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            await index_tweets(db, rows)
+            await db.commit()
+            processed += len(rows)
+            after_id = rows[-1].id
+            logger.info("Обработано твитов: %s (последний id %s)", processed, after_id)
+    return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract hashtags and mentions from existing tweets")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--after-id", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(backfill(args.batch_size, args.after_id))
@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func, literal, select, text, tuple_, union, union_all, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import database, models
+from .pagination import decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+CELEBRITY_FOLLOWERS_THRESHOLD = int(os.getenv("TIMELINE_CELEBRITY_THRESHOLD", "10000"))
+BACKFILL_LIMIT = int(os.getenv("TIMELINE_BACKFILL_LIMIT", "200"))
+REBUILD_BATCH_SIZE = int(os.getenv("TIMELINE_REBUILD_BATCH_SIZE", "1000"))
+
+TIMELINE_COLUMNS = ["user_id", "tweet_id", "author_id", "created_at"]
+
+MARK_CELEBRITIES = text("""
+    UPDATE users SET is_celebrity = true
+    WHERE followers_count > :threshold AND NOT is_celebrity
+""")
+# What fan-out and follow backfill would have written for one range of readers:
+# the newest BACKFILL_LIMIT tweets of themselves and of every non-celebrity they follow
+REBUILD = text("""
+    INSERT INTO timelines (user_id, tweet_id, author_id, created_at)
+    SELECT r.user_id, t.id, t.author_id, t.created_at
+    FROM (
+        SELECT id AS user_id, id AS author_id FROM users WHERE id >= :lo AND id < :hi
+        UNION ALL
+        SELECT follower_id, followed_id FROM follows WHERE follower_id >= :lo AND follower_id < :hi
+    ) r
+    JOIN users a ON a.id = r.author_id AND NOT a.is_celebrity
+    CROSS JOIN LATERAL (
+        SELECT id, author_id, created_at FROM tweets
+        WHERE author_id = r.author_id
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+    ) t
+    ON CONFLICT DO NOTHING
+""")
+
+
+async def mark_celebrity(db: AsyncSession, author_id: int) -> bool:
+    followers = await db.scalar(select(models.User.followers_count).where(models.User.id == author_id))
+    if followers <= CELEBRITY_FOLLOWERS_THRESHOLD:
+        return False
+
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == author_id, models.User.is_celebrity.is_(False))
+        .values(is_celebrity=True)
+    )
+    return True
+
+
+async def fan_out_tweet(db: AsyncSession, tweet: models.Tweet):
+    if await mark_celebrity(db, tweet.author_id):
+        return
+
+    tweet_columns = (literal(tweet.id), literal(tweet.author_id), literal(tweet.created_at))
+    recipients = union_all(
+        select(literal(tweet.author_id), *tweet_columns),
+        select(models.Follow.follower_id, *tweet_columns)
+        .where(models.Follow.followed_id == tweet.author_id),
+    )
+    await db.execute(
+        insert(models.TimelineEntry)
+        .from_select(TIMELINE_COLUMNS, recipients)
+        .on_conflict_do_nothing()
+    )
+
+
+async def backfill(db: AsyncSession, follower_id: int, followed_id: int):
+    is_celebrity = await db.scalar(
+        select(models.User.is_celebrity).where(models.User.id == followed_id)
+    )
+    if is_celebrity:
+        return
+
+    recent_tweets = (
+        select(
+            literal(follower_id),
+            models.Tweet.id,
+            models.Tweet.author_id,
+            models.Tweet.created_at,
+        )
+        .where(models.Tweet.author_id == followed_id)
+        .order_by(models.Tweet.created_at.desc(), models.Tweet.id.desc())
+        .limit(BACKFILL_LIMIT)
+    )
+    await db.execute(
+        insert(models.TimelineEntry)
+        .from_select(TIMELINE_COLUMNS, recent_tweets)
+        .on_conflict_do_nothing()
+    )
+
+
+async def prune(db: AsyncSession, follower_id: int, followed_id: int):
+    await db.execute(
+        models.TimelineEntry.__table__.delete().where(
+            models.TimelineEntry.user_id == follower_id,
+            models.TimelineEntry.author_id == followed_id,
+        )
+    )
+
+
+async def get_timeline_page(
+        db: AsyncSession,
+        user_id: int,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Tuple[List[int], Optional[str]]:
+    position = decode_cursor(cursor)
+
+    pushed = (
+        select(models.TimelineEntry.tweet_id.label("id"), models.TimelineEntry.created_at)
+        .where(models.TimelineEntry.user_id == user_id)
+    )
+    # Celebrity tweets are not fanned out on write, so they are pulled on read
+    celebrities = union_all(
+        select(models.User.id)
+        .where(models.User.id == user_id, models.User.is_celebrity.is_(True)),
+        select(models.Follow.followed_id)
+        .join(models.User, models.User.id == models.Follow.followed_id)
+        .where(models.Follow.follower_id == user_id, models.User.is_celebrity.is_(True)),
+    )
+    pulled = (
+        select(models.Tweet.id, models.Tweet.created_at)
+        .where(models.Tweet.author_id.in_(celebrities))
+    )
+    if position:
+        pushed = pushed.where(
+            tuple_(models.TimelineEntry.created_at, models.TimelineEntry.tweet_id) < position
+        )
+        pulled = pulled.where(tuple_(models.Tweet.created_at, models.Tweet.id) < position)
+
+    pushed = pushed.order_by(
+        models.TimelineEntry.created_at.desc(), models.TimelineEntry.tweet_id.desc()
+    ).limit(limit + 1)
+    pulled = pulled.order_by(
+        models.Tweet.created_at.desc(), models.Tweet.id.desc()
+    ).limit(limit + 1)
+
+    page = union(pushed, pulled).subquery()
+    result = await db.execute(
+        select(page.c.id, page.c.created_at)
+        .order_by(page.c.created_at.desc(), page.c.id.desc())
+        .limit(limit + 1)
+    )
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return [row.id for row in rows], next_cursor
+
+
+async def rebuild(db: AsyncSession, lo: int = 0, hi: int = 2 ** 31 - 1):
+    await db.execute(MARK_CELEBRITIES, {"threshold": CELEBRITY_FOLLOWERS_THRESHOLD})
+    await db.execute(REBUILD, {"lo": lo, "hi": hi, "limit": BACKFILL_LIMIT})
+
+
+async def rebuild_all(
+        batch_size: int = REBUILD_BATCH_SIZE,
+        after_id: int = 0,
+        sessions: Optional[async_sessionmaker] = None,
+) -> int:
+    # One reader range per transaction; an interrupted run resumes with --after-id
+    async with (sessions or database.AsyncSessionLocal)() as db:
+        await db.execute(MARK_CELEBRITIES, {"threshold": CELEBRITY_FOLLOWERS_THRESHOLD})
+        await db.commit()
+        max_id = await db.scalar(select(func.coalesce(func.max(models.User.id), 0)))
+        for lo in range(after_id + 1, max_id + 1, batch_size):
+            await db.execute(REBUILD, {"lo": lo, "hi": lo + batch_size, "limit": BACKFILL_LIMIT})
+            await db.commit()
+            logger.info("Ленты заполнены до id %s", min(lo + batch_size, max_id + 1) - 1)
+    return max_id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill timelines from existing follows and tweets")
+    parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH_SIZE)
+    parser.add_argument("--after-id", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(rebuild_all(args.batch_size, args.after_id))
@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import seed as seeder
+
+BENCHMARK_TWEET = "Benchmark tweet"
+
+
+@dataclass
+class Dataset:
+    users: int
+    tweets: int
+
+    def api_key(self, user_id: int) -> str:
+        return seeder.api_key(user_id)
+
+
+async def seed(engine: AsyncEngine, config: seeder.SeedConfig) -> Dataset:
+    counts = await seeder.seed(engine, config)
+    return Dataset(users=counts["users"], tweets=counts["tweets"])
+
+
+async def existing(engine: AsyncEngine) -> Dataset:
+    async with engine.connect() as conn:
+        users = await conn.scalar(
+            text("SELECT count(*) FROM users WHERE api_key LIKE :prefix"),
+            {"prefix": seeder.API_KEY_PREFIX.replace("_", "\\_") + "%"},
+        )
+        # Seeded tweets occupy ids 1..N; tweets posted by earlier runs come after them
+        tweets = await conn.scalar(
+            text("SELECT count(*) FROM tweets WHERE tweet_data <> :posted"), {"posted": BENCHMARK_TWEET}
+        )
+    return Dataset(users=users, tweets=tweets)
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+import uvicorn
+from sqlalchemy import event
+
+from app import media
+from app.database import engine
+from app.main import api_router, app
+from app.migrate import migrate
+from app.seed import WORDS, SeedConfig
+
+from . import dataset
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines" / "endpoints.json"
+
+Request = Tuple[str, str, dict]
+Prepare = Callable[[httpx.AsyncClient, dataset.Dataset], Awaitable[Request]]
+
+
+@dataclass
+class Scenario:
+    method: str
+    path: str
+    prepare: Prepare
+
+
+def random_user(data: dataset.Dataset) -> int:
+    return random.randint(1, data.users)
+
+
+def auth(data: dataset.Dataset, user_id: Optional[int] = None) -> dict:
+    return {"api-key": data.api_key(user_id or random_user(data))}
+
+
+async def create_tweet(client: httpx.AsyncClient, headers: dict) -> int:
+    response = await client.post("/api/tweets", json={"tweet_data": dataset.BENCHMARK_TWEET}, headers=headers)
+    return response.json()["tweet_id"]
+
+
+async def get_me(client, data):
+    return "GET", "/api/users/me", {"headers": auth(data)}
+
+
+async def post_stream_token(client, data):
+    return "POST", "/api/events/token", {"headers": auth(data)}
+
+
+async def get_user(client, data):
+    return "GET", f"/api/users/{random_user(data)}", {}
+
+
+async def get_followers(client, data):
+    # Low ids are the most followed accounts in the seeded graph
+    return "GET", f"/api/users/{random.randint(1, min(100, data.users))}/followers", {}
+
+
+async def get_following(client, data):
+    return "GET", f"/api/users/{random_user(data)}/following", {}
+
+
+async def post_tweet(client, data):
+    return "POST", "/api/tweets", {"headers": auth(data), "json": {"tweet_data": dataset.BENCHMARK_TWEET}}
+
+
+async def post_media(client, data):
+    files = {"file": ("bench.bin", os.urandom(64 * 1024), "application/octet-stream")}
+    return "POST", "/api/medias", {"headers": auth(data), "files": files}
+
+
+async def get_tweets(client, data):
+    return "GET", "/api/tweets", {"headers": auth(data)}
+
+
+async def search_tweets(client, data):
+    params = {"q": random.choice(WORDS)}
+    return "GET", "/api/tweets/search", {"headers": auth(data), "params": params}
+
+
+async def get_tag_tweets(client, data):
+    return "GET", f"/api/tags/topic{random.randint(0, 100)}/tweets", {"headers": auth(data)}
+
+
+async def get_mentions(client, data):
+    return "GET", f"/api/users/{random_user(data)}/mentions", {"headers": auth(data)}
+
+
+async def get_timeline(client, data):
+    return "GET", "/api/timeline", {"headers": auth(data)}
+
+
+async def delete_tweet(client, data):
+    headers = auth(data)
+    tweet_id = await create_tweet(client, headers)
+    return "DELETE", f"/api/tweets/{tweet_id}", {"headers": headers}
+
+
+async def post_like(client, data):
+    headers, tweet_id = auth(data), random.randint(1, data.tweets)
+    # Same as follows: an existing like would turn the request into a 400
+    await client.delete(f"/api/tweets/{tweet_id}/likes", headers=headers)
+    return "POST", f"/api/tweets/{tweet_id}/likes", {"headers": headers}
+
+
+async def delete_like(client, data):
+    headers = auth(data)
+    tweet_id = await create_tweet(client, headers)
+    await client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+    return "DELETE", f"/api/tweets/{tweet_id}/likes", {"headers": headers}
+
+
+def follow_pair(data: dataset.Dataset) -> Tuple[dict, int]:
+    follower_id, followed_id = random.sample(range(1, data.users + 1), 2)
+    return auth(data, follower_id), followed_id
+
+
+async def post_follow(client, data):
+    headers, followed_id = follow_pair(data)
+    # The seeded graph already has many of the pairs, following them again would only measure the 400
+    await client.delete(f"/api/users/{followed_id}/follow", headers=headers)
+    return "POST", f"/api/users/{followed_id}/follow", {"headers": headers}
+
+
+async def delete_follow(client, data):
+    headers, followed_id = follow_pair(data)
+    await client.post(f"/api/users/{followed_id}/follow", headers=headers)
+    return "DELETE", f"/api/users/{followed_id}/follow", {"headers": headers}
+
+
+SCENARIOS = [
+    Scenario("GET", "/api/users/me", get_me),
+    Scenario("GET", "/api/users/{user_id}", get_user),
+    Scenario("GET", "/api/users/{user_id}/followers", get_followers),
+    Scenario("GET", "/api/users/{user_id}/following", get_following),
+    Scenario("POST", "/api/tweets", post_tweet),
+    Scenario("POST", "/api/medias", post_media),
+    Scenario("GET", "/api/tweets", get_tweets),
+    Scenario("GET", "/api/tweets/search", search_tweets),
+    Scenario("GET", "/api/tags/{tag}/tweets", get_tag_tweets),
+    Scenario("GET", "/api/users/{user_id}/mentions", get_mentions),
+    Scenario("GET", "/api/timeline", get_timeline),
+    Scenario("DELETE", "/api/tweets/{tweet_id}", delete_tweet),
+    Scenario("POST", "/api/tweets/{tweet_id}/likes", post_like),
+    Scenario("DELETE", "/api/tweets/{tweet_id}/likes", delete_like),
+    Scenario("POST", "/api/users/{followed_id}/follow", post_follow),
+    Scenario("DELETE", "/api/users/{followed_id}/follow", delete_follow),
+    Scenario("POST", "/api/events/token", post_stream_token),
+]
+# Long-lived streams have no request latency to time; benchmarks/events.py measures them
+STREAMING_ROUTES = {("GET", "/api/events")}
+
+
+def check_coverage():
+    routes = {(method, route.path) for route in api_router.routes for method in route.methods}
+    covered = {(scenario.method, scenario.path) for scenario in SCENARIOS}
+    missing = routes - covered - STREAMING_ROUTES
+    if missing:
+        raise SystemExit(f"No benchmark scenario for: {sorted(missing)}")
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def percentile(latencies, q: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method="inclusive")[q - 1]
+
+
+async def run_scenario(
+        client: httpx.AsyncClient,
+        scenario: Scenario,
+        data: dataset.Dataset,
+        requests: int,
+        concurrency: int,
+        counter: QueryCounter,
+) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def prepare():
+        async with semaphore:
+            return await scenario.prepare(client, data)
+
+    async def one(request: Request):
+        nonlocal errors
+        method, url, kwargs = request
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    # Setup requests (e.g. the tweet a DELETE removes) run before timing starts
+    prepared = await asyncio.gather(*[prepare() for _ in range(requests)])
+
+    queries_before = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*[one(request) for request in prepared])
+    elapsed = time.perf_counter() - started
+    queries = counter.count - queries_before
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_request": queries / requests,
+    }
+
+
+async def run_transport(client: httpx.AsyncClient, data, requests, concurrency, counter) -> Dict[str, dict]:
+    results = {}
+    for scenario in SCENARIOS:
+        name = f"{scenario.method} {scenario.path}"
+        results[name] = await run_scenario(client, scenario, data, requests, concurrency, counter)
+        report_line(name, results[name])
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(data, requests, concurrency, counter) -> Dict[str, dict]:
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    limits = httpx.Limits(max_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            return await run_transport(client, data, requests, concurrency, counter)
+    finally:
+        server.should_exit = True
+        await serving
+
+
+async def run_asgi(data, requests, concurrency, counter) -> Dict[str, dict]:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        return await run_transport(client, data, requests, concurrency, counter)
+
+
+def report_line(name: str, result: dict):
+    print(
+        f"  {name:<40} {result['rps']:>8.1f} rps  p50 {result['p50_ms']:>7.1f}  "
+        f"p95 {result['p95_ms']:>7.1f}  p99 {result['p99_ms']:>7.1f} ms  "
+        f"{result['queries_per_request']:>5.1f} q/req  {result['errors']} errors"
+    )
+
+
+def run_config(args, data: dataset.Dataset) -> dict:
+    return {
+        "users": data.users,
+        "tweets": data.tweets,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "cpus": os.cpu_count(),
+    }
+
+
+def report_diff(results: dict, baseline: dict, config: dict):
+    print("\nChange against baseline:")
+    if baseline.get("config") != config:
+        # Numbers from another dataset, load or machine are not comparable one to one
+        print(f"  note: baseline was made with {baseline.get('config')}, this run is {config}")
+    for transport, endpoints in results.items():
+        for name, result in endpoints.items():
+            previous = baseline.get(transport, {}).get(name)
+            if not previous:
+                continue
+            changes = []
+            for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "queries_per_request"):
+                if previous[metric]:
+                    delta = (result[metric] - previous[metric]) / previous[metric] * 100
+                    changes.append(f"{metric} {delta:+.0f}%")
+            print(f"  {transport:<8} {name:<40} " + "  ".join(changes))
+
+
+async def main(args):
+    check_coverage()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    await migrate(engine)
+    if args.seed:
+        print("Seeding dataset...")
+        config = SeedConfig(users=args.users, tweets=args.tweets, likes=args.likes, follows=args.follows)
+        data = await dataset.seed(engine, config)
+    else:
+        data = await dataset.existing(engine)
+    if not data.users:
+        raise SystemExit("No benchmark dataset found, run with --seed")
+
+    counter = QueryCounter()
+    event.listen(engine.sync_engine, "before_cursor_execute", counter)
+    runners = {"asgi": run_asgi, "uvicorn": run_uvicorn}
+    results = {}
+    with tempfile.TemporaryDirectory() as media_root:
+        media.MEDIA_ROOT = Path(media_root)
+        for transport in args.transport:
+            print(f"\n{transport}: {args.requests} requests per endpoint, concurrency {args.concurrency}")
+            results[transport] = await runners[transport](data, args.requests, args.concurrency, counter)
+    await engine.dispose()
+
+    config = run_config(args, data)
+    if args.baseline.exists():
+        report_diff(results, json.loads(args.baseline.read_text()), config)
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({"config": config, **results}, indent=2, sort_keys=True))
+        print(f"\nBaseline saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput and latency of every API route")
+    parser.add_argument("--seed", action="store_true", help="truncate the database and seed a fresh dataset")
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--tweets", type=int, default=300_000)
+    parser.add_argument("--follows", type=int, default=200_000)
+    parser.add_argument("--likes", type=int, default=500_000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--transport", nargs="+", choices=["asgi", "uvicorn"], default=["asgi", "uvicorn"])
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    asyncio.run(main(parser.parse_args()))
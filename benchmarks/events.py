@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import random
+import resource
+import statistics
+import time
+
+import orjson
+import uvicorn
+
+from app.database import engine
+from app.events import event_hub
+from app.main import app
+from app.migrate import migrate
+
+from . import dataset
+from .endpoints import free_port, percentile
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def raise_file_limit(connections: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Each connection costs a socket on both ends, clients run in this process too
+    wanted = min(hard, connections * 2 + 1024)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    if wanted < connections * 2 + 1024:
+        print(f"Warning: open file limit {hard} is too low for {connections} connections")
+
+
+class Client:
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.latencies = []
+
+    async def connect(self, port: int, api_key: str):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.writer.write(
+            f"GET /api/events?api_key={api_key} HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n".encode()
+        )
+        await self.writer.drain()
+        status = await self.reader.readline()
+        if b" 200 " not in status:
+            raise RuntimeError(f"Stream refused: {status!r}")
+        while not (await self.reader.readline()).startswith(b"retry:"):
+            pass
+
+    async def receive(self, events: int):
+        received = 0
+        while received < events:
+            line = await self.reader.readline()
+            if not line:
+                raise RuntimeError("Stream closed by the server")
+            # Chunked framing lines are skipped, only SSE data lines carry events
+            if line.startswith(b"data: "):
+                sent = orjson.loads(line[6:])["sent"]
+                self.latencies.append(time.perf_counter() - sent)
+                received += 1
+
+    def close(self):
+        self.writer.close()
+
+
+async def main(args):
+    raise_file_limit(args.connections)
+    await migrate(engine)
+    data = await dataset.existing(engine)
+    if not data.users:
+        raise SystemExit("No benchmark dataset found, run benchmarks.endpoints with --seed")
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=port, lifespan="off", log_level="warning", backlog=args.connections
+    ))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    clients = [Client() for _ in range(args.connections)]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client: Client):
+        async with semaphore:
+            await client.connect(port, data.api_key(random.randint(1, data.users)))
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[connect(client) for client in clients])
+        connect_seconds = time.perf_counter() - started
+        # Let the connect burst settle before measuring idle cost
+        await asyncio.sleep(1)
+        rss_idle = rss_mb()
+        print(
+            f"{args.connections} idle streams open in {connect_seconds:.1f} s, "
+            f"subscribers {len(event_hub.subscribers)}, "
+            f"RSS +{rss_idle - rss_before:.0f} MB ({(rss_idle - rss_before) * 1024 / args.connections:.1f} KB "
+            f"per connection, server and client sides together)"
+        )
+
+        receiving = [asyncio.create_task(client.receive(args.events)) for client in clients]
+        fan_out = []
+        for _ in range(args.events):
+            sent = time.perf_counter()
+            await event_hub.publish({"type": "benchmark", "sent": sent})
+            fan_out.append(time.perf_counter() - sent)
+            await asyncio.sleep(args.interval)
+        await asyncio.gather(*receiving)
+
+        latencies = [latency for client in clients for latency in client.latencies]
+        print(
+            f"{args.events} events x {args.connections} clients: "
+            f"publish {statistics.mean(fan_out) * 1000:.1f} ms, delivery p50 {percentile(latencies, 50) * 1000:.1f} "
+            f"p95 {percentile(latencies, 95) * 1000:.1f} p99 {percentile(latencies, 99) * 1000:.1f} ms, "
+            f"dropped {event_hub.dropped}"
+        )
+    finally:
+        for client in clients:
+            if client.writer:
+                client.close()
+        server.should_exit = True
+        await serving
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Idle event stream capacity and fan-out latency of one worker")
+    parser.add_argument("--connections", type=int, default=10_000)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
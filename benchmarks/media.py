@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.staticfiles import StaticFiles
+
+from app.media import MediaFiles
+
+from .endpoints import free_port, percentile
+
+ACCEL_PREFIX = "/_media/"
+MODES = {
+    # Generic mount the attachments were served by before
+    "static": lambda root: StaticFiles(directory=root),
+    "media": lambda root: MediaFiles(directory=root, accel_redirect_prefix=""),
+    # Headers only: without nginx in front this measures what is left for the worker
+    "accel": lambda root: MediaFiles(directory=root, accel_redirect_prefix=ACCEL_PREFIX),
+}
+
+
+def serve(mode: str, root: str, port: int):
+    app = Starlette(routes=[Mount("/static/media", MODES[mode](root))])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def make_files(root: Path, count: int, size: int) -> List[str]:
+    names = []
+    for i in range(count):
+        name = f"{i:02x}/bench-{i}.mp4"
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            for _ in range(size // (1 << 20)):
+                file.write(os.urandom(1 << 20))
+        names.append(name)
+    return names
+
+
+async def download(client: httpx.AsyncClient, url: str, headers: dict) -> int:
+    received = 0
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+        async for chunk in response.aiter_raw():
+            received += len(chunk)
+    return received
+
+
+async def run_scenario(port: int, pid: int, names: List[str], size: int, args, ranged: bool) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one(client: httpx.AsyncClient) -> int:
+        headers = {}
+        if ranged:
+            # Seeking in a video: a short window somewhere in the file
+            start = random.randrange(0, size - args.range_bytes)
+            headers["Range"] = f"bytes={start}-{start + args.range_bytes - 1}"
+        async with semaphore:
+            started = time.perf_counter()
+            received = await download(client, f"/static/media/{random.choice(names)}", headers)
+            latencies.append(time.perf_counter() - started)
+            return received
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=300) as client:
+        cpu_before = cpu_seconds(pid)
+        started = time.perf_counter()
+        received = sum(await asyncio.gather(*[one(client) for _ in range(args.requests)]))
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(pid) - cpu_before
+
+    return {
+        "mb_per_second": received / elapsed / (1 << 20),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "server_cpu_seconds": cpu,
+        "requests_per_second": args.requests / elapsed,
+    }
+
+
+async def wait_until_listening(port: int):
+    for _ in range(200):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise SystemExit("Benchmark server did not start")
+
+
+async def main(args):
+    size = args.size_mb << 20
+    with tempfile.TemporaryDirectory() as root:
+        names = make_files(Path(root), args.files, size)
+        print(
+            f"{args.files} files of {args.size_mb} MB, {args.requests} requests, concurrency {args.concurrency}, "
+            f"ranges of {args.range_bytes >> 10} KB"
+        )
+        for mode in args.mode:
+            port = free_port()
+            server = multiprocessing.Process(target=serve, args=(mode, root, port))
+            server.start()
+            try:
+                await wait_until_listening(port)
+                for ranged in (False, True):
+                    result = await run_scenario(port, server.pid, names, size, args, ranged)
+                    print(
+                        f"  {mode:<7} {'range' if ranged else 'full':<6} "
+                        f"{result['mb_per_second']:>8.1f} MB/s {result['requests_per_second']:>8.1f} rps  "
+                        f"p50 {result['p50_ms']:>8.1f}  p95 {result['p95_ms']:>8.1f} ms  "
+                        f"server CPU {result['server_cpu_seconds']:.2f} s"
+                    )
+            finally:
+                server.terminate()
+                server.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent large media downloads through each serving path")
+    parser.add_argument("--mode", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--range-bytes", type=int, default=1 << 20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+from typing import Awaitable, Callable, List
+
+import httpx
+from sqlalchemy import text
+
+from app import search, seed
+from app.database import AsyncSessionLocal, engine
+from app.main import app
+from app.migrate import migrate
+
+# Common words match a large share of seeded tweets, topics form a long tail
+QUERIES = {
+    "common word": "coffee",
+    "two words": "coffee morning",
+    "phrase": '"release deploy"',
+    "popular topic": "topic1",
+    "rare topic": "topic9876",
+    "negation": "python -java",
+    "no match": "zzzzzz",
+}
+
+
+async def timed(call: Callable[[], Awaitable], iterations: int) -> List[float]:
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)
+
+
+def p95(timings: List[float]) -> float:
+    return timings[max(int(len(timings) * 0.95) - 1, 0)]
+
+
+async def measure(client: httpx.AsyncClient, query: str, iterations: int, limit: int) -> dict:
+    params = {"q": query, "limit": limit}
+    first = (await client.get("/api/tweets/search", params=params)).json()
+
+    # Ranking alone, then the whole request: ranking, tweet assembly and JSON
+    async with AsyncSessionLocal() as db:
+        ranking = await timed(lambda: search.search_page(db, query, limit), iterations)
+    endpoint = await timed(lambda: client.get("/api/tweets/search", params=params), iterations)
+    if first["next_cursor"]:
+        next_page = await timed(
+            lambda: client.get("/api/tweets/search", params={**params, "cursor": first["next_cursor"]}), 1
+        )
+    else:
+        next_page = [0.0]
+    return {
+        "results": len(first["tweets"]),
+        "rank_p50_ms": statistics.median(ranking) * 1000,
+        "p50_ms": statistics.median(endpoint) * 1000,
+        "p95_ms": p95(endpoint) * 1000,
+        "next_page_ms": next_page[0] * 1000,
+    }
+
+
+async def main(args):
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    await migrate(engine)
+    async with engine.connect() as conn:
+        total = await conn.scalar(text("SELECT count(*) FROM tweets"))
+    print(f"Searching {total} tweets, {args.iterations} iterations, page size {args.limit}")
+    print(f"{'query':<16} {'results':>7} {'rank ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'page 2 ms':>10}")
+    headers = {"api-key": seed.api_key(1)}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as client:
+        for name, query in QUERIES.items():
+            result = await measure(client, query, args.iterations, args.limit)
+            print(
+                f"{name:<16} {result['results']:>7} {result['rank_p50_ms']:>8.2f} {result['p50_ms']:>8.2f} "
+                f"{result['p95_ms']:>8.2f} {result['next_page_ms']:>10.2f}"
+            )
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency of GET /api/tweets/search on the current database")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
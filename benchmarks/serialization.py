@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import time
+
+import orjson
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from app import schemas
+
+
+def make_feed(tweets_count: int, likes_per_tweet: int = 5) -> dict:
+    return {
+        "result": True,
+        "tweets": [
+            {
+                "id": i,
+                "content": f"Tweet number {i} with some text to encode",
+                "attachments": [f"static/media/ab/cd/{i:064x}.thumb.jpg"],
+                "attachment_web": [f"static/media/ab/cd/{i:064x}.web.webp"],
+                "attachment_originals": [f"static/media/ab/cd/{i:064x}.jpg"],
+                "author": {"id": i % 1000, "name": f"User {i % 1000}"},
+                "likes": [
+                    {"user_id": j, "name": f"User {j}"}
+                    for j in range(likes_per_tweet)
+                ],
+            }
+            for i in range(tweets_count)
+        ],
+        "next_cursor": None,
+    }
+
+
+async def validated_path(field, payload: dict) -> bytes:
+    content = await serialize_response(field=field, response_content=payload, is_coroutine=True)
+    return JSONResponse(content).body
+
+
+def fast_path(payload: dict) -> bytes:
+    return orjson.dumps(payload)
+
+
+async def measure(func, repeat: int) -> float:
+    started = time.process_time()
+    for _ in range(repeat):
+        result = func()
+        if asyncio.iscoroutine(result):
+            await result
+    return (time.process_time() - started) / repeat
+
+
+async def main(sizes, repeat: int):
+    field = create_model_field(name="Response_read_tweets", type_=schemas.TweetResponse, mode="serialization")
+    print(f"{'tweets':>8} {'validated, ms':>14} {'orjson, ms':>11} {'speedup':>8}")
+    for size in sizes:
+        payload = make_feed(size)
+        assert orjson.loads(fast_path(payload)) == orjson.loads(await validated_path(field, payload))
+
+        slow = await measure(lambda: validated_path(field, payload), repeat)
+        fast = await measure(lambda: fast_path(payload), repeat)
+        print(f"{size:>8} {slow * 1000:>14.2f} {fast * 1000:>11.2f} {slow / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU cost of encoding the feed response")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.repeat))
@@ -0,0 +1,58 @@
+import argparse
+import logging
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from .endpoints import free_port
+
+COMMANDS = {
+    "serve": [sys.executable, "-m", "app.serve"],
+    "uvicorn": [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1"],
+}
+
+
+def time_to_first_request(mode: str, workers: int, timeout: float) -> float:
+    port = free_port()
+    command = COMMANDS[mode] + (["--port", str(port)] if mode == "uvicorn" else [])
+    env = dict(os.environ, WEB_HOST="127.0.0.1", WEB_PORT=str(port), WEB_WORKERS=str(workers))
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise SystemExit(f"{mode} exited with code {process.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise SystemExit(f"{mode} did not answer within {timeout} s")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+
+def main(args):
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    for mode in args.mode:
+        timings = [time_to_first_request(mode, args.workers, args.timeout) for _ in range(args.runs)]
+        print(
+            f"{mode:<8} time to first request: median {statistics.median(timings):.2f} s, "
+            f"min {min(timings):.2f} s, max {max(timings):.2f} s over {args.runs} runs"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wall time from process launch to the first served request")
+    parser.add_argument("--mode", nargs="+", choices=sorted(COMMANDS), default=["serve", "uvicorn"])
+    parser.add_argument("--workers", type=int, default=0, help="app.serve workers, 0 means one per core")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+"""baseline schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("api_key", sa.String()),
+        sa.Column("name", sa.String()),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_api_key", "users", ["api_key"], unique=True)
+
+    op.create_table(
+        "tweets",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("tweet_data", sa.Text()),
+        sa.Column("author_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("created_at", sa.DateTime(timezone=True)),
+    )
+    op.create_index("ix_tweets_id", "tweets", ["id"])
+
+    op.create_table(
+        "medias",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("url", sa.String()),
+        sa.Column("tweet_id", sa.Integer(), sa.ForeignKey("tweets.id", ondelete="CASCADE")),
+    )
+    op.create_index("ix_medias_id", "medias", ["id"])
+
+    op.create_table(
+        "likes",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("tweet_id", sa.Integer(), sa.ForeignKey("tweets.id", ondelete="CASCADE")),
+    )
+    op.create_index("ix_likes_id", "likes", ["id"])
+
+    op.create_table(
+        "follows",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("follower_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("followed_id", sa.Integer(), sa.ForeignKey("users.id")),
+    )
+    op.create_index("ix_follows_id", "follows", ["id"])
+
+
+def downgrade():
+    op.drop_table("follows")
+    op.drop_table("likes")
+    op.drop_table("medias")
+    op.drop_table("tweets")
+    op.drop_table("users")
@@ -0,0 +1,68 @@
+"""timelines, content-addressed media and like/follow uniqueness
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("is_celebrity", sa.Boolean(), server_default=sa.false(), nullable=False),
+    )
+
+    op.create_table(
+        "timelines",
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("tweet_id", sa.Integer(), sa.ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index("ix_timelines_user_created_tweet", "timelines", ["user_id", "created_at", "tweet_id"])
+    op.create_index("ix_timelines_user_author", "timelines", ["user_id", "author_id"])
+    # Existing follows are delivered afterwards by the streaming backfill: python -m app.timeline
+
+    op.create_table(
+        "media_blobs",
+        sa.Column("sha256", sa.String(64), primary_key=True),
+        sa.Column("url", sa.String(), nullable=False),
+        sa.Column("size", sa.BigInteger(), nullable=False),
+        sa.Column("ref_count", sa.Integer(), nullable=False),
+        sa.Column("thumbnail_url", sa.String()),
+        sa.Column("web_url", sa.String()),
+    )
+    op.add_column("medias", sa.Column("sha256", sa.String(64), sa.ForeignKey("media_blobs.sha256")))
+    op.add_column("medias", sa.Column("created_at", sa.DateTime(timezone=True)))
+    op.create_index("ix_medias_sha256", "medias", ["sha256"])
+
+    # Duplicates were possible before the constraints existed; keep the oldest row
+    op.execute(
+        "DELETE FROM likes a USING likes b "
+        "WHERE a.user_id = b.user_id AND a.tweet_id = b.tweet_id AND a.id > b.id"
+    )
+    op.create_unique_constraint("uq_likes_user_tweet", "likes", ["user_id", "tweet_id"])
+    op.execute(
+        "DELETE FROM follows a USING follows b "
+        "WHERE a.follower_id = b.follower_id AND a.followed_id = b.followed_id AND a.id > b.id"
+    )
+    op.create_unique_constraint("uq_follows_follower_followed", "follows", ["follower_id", "followed_id"])
+
+
+def downgrade():
+    op.drop_constraint("uq_follows_follower_followed", "follows", type_="unique")
+    op.drop_constraint("uq_likes_user_tweet", "likes", type_="unique")
+    op.drop_index("ix_medias_sha256", "medias")
+    op.drop_column("medias", "created_at")
+    op.drop_column("medias", "sha256")
+    op.drop_table("media_blobs")
+    op.drop_table("timelines")
+    op.drop_column("users", "is_celebrity")
@@ -0,0 +1,34 @@
+"""indexes for the feed, likes, media and follow reads
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_tweets_created_at_id", "tweets", ["created_at", "id"]),
+    ("ix_tweets_author_created_at_id", "tweets", ["author_id", "created_at", "id"]),
+    ("ix_likes_tweet_id", "likes", ["tweet_id"]),
+    ("ix_medias_tweet_id", "medias", ["tweet_id"]),
+    ("ix_follows_followed_follower", "follows", ["followed_id", "follower_id"]),
+]
+
+
+def upgrade():
+    # CONCURRENTLY cannot run inside a transaction, but it does not block writes
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
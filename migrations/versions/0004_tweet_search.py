@@ -0,0 +1,38 @@
+"""full-text search vector on tweets
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A stored generated column rewrites the table once; Postgres keeps it current afterwards
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "search_vector",
+            TSVECTOR(),
+            sa.Computed("to_tsvector('simple'::regconfig, COALESCE(tweet_data, ''::text))", persisted=True),
+        ),
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_tweets_search_vector", "tweets", ["search_vector"],
+            postgresql_using="gin", postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_tweets_search_vector", table_name="tweets", postgresql_concurrently=True, if_exists=True)
+    op.drop_column("tweets", "search_vector")
@@ -0,0 +1,53 @@
+"""hashtag and mention join tables
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "hashtags",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("tag", sa.String(100), nullable=False, unique=True),
+    )
+    op.create_table(
+        "tweet_hashtags",
+        sa.Column("tweet_id", sa.Integer(), sa.ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("hashtag_id", sa.Integer(), sa.ForeignKey("hashtags.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index(
+        "ix_tweet_hashtags_tag_created_tweet", "tweet_hashtags", ["hashtag_id", "created_at", "tweet_id"]
+    )
+    op.create_table(
+        "mentions",
+        sa.Column("tweet_id", sa.Integer(), sa.ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index("ix_mentions_user_created_tweet", "mentions", ["user_id", "created_at", "tweet_id"])
+
+    # Existing tweets are indexed afterwards by the streaming backfill: python -m app.tags
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_name_lower", "users", [sa.text("lower(name)")],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_name_lower", table_name="users", postgresql_concurrently=True, if_exists=True)
+    op.drop_table("mentions")
+    op.drop_table("tweet_hashtags")
+    op.drop_table("hashtags")
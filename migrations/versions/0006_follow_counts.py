@@ -0,0 +1,42 @@
+"""denormalized follower / following counters on users
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+# Same statement as app.follows.RECOUNT, kept here so the revision does not depend on app code
+RECOUNT = sa.text("""
+    UPDATE users SET
+        followers_count = (SELECT count(*) FROM follows WHERE follows.followed_id = users.id),
+        following_count = (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)
+    WHERE users.id >= :lo AND users.id < :hi
+""")
+
+
+def upgrade():
+    # A constant default is a catalog-only change, no table rewrite
+    op.add_column("users", sa.Column("followers_count", sa.Integer(), server_default="0", nullable=False))
+    op.add_column("users", sa.Column("following_count", sa.Integer(), server_default="0", nullable=False))
+
+    # Each range commits on its own, so a large users table is never locked as a whole.
+    # Follows written by older workers during a rolling deploy are fixed with: python -m app.follows
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        max_id = bind.scalar(sa.text("SELECT coalesce(max(id), 0) FROM users"))
+        for lo in range(0, max_id + 1, BATCH_SIZE):
+            bind.execute(RECOUNT, {"lo": lo, "hi": lo + BATCH_SIZE})
+
+
+def downgrade():
+    op.drop_column("users", "following_count")
+    op.drop_column("users", "followers_count")
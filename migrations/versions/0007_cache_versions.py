@@ -0,0 +1,28 @@
+"""shared response cache versions
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE SEQUENCE IF NOT EXISTS cache_version_seq")
+    op.create_table(
+        "cache_versions",
+        sa.Column("entity", sa.String(), primary_key=True),
+        sa.Column("version", sa.BigInteger(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("cache_versions")
+    op.execute("DROP SEQUENCE IF EXISTS cache_version_seq")
@@ -0,0 +1,35 @@
+"""creation time for media rows uploaded before 0002
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.alter_column("medias", "created_at", server_default=sa.text("now()"))
+
+    # Rows older than 0002 had no created_at and were invisible to the unattached-media GC;
+    # they now get a full grace period from the upgrade before being collected
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        max_id = bind.scalar(sa.text("SELECT coalesce(max(id), 0) FROM medias"))
+        for lo in range(0, max_id + 1, BATCH_SIZE):
+            bind.execute(
+                sa.text("UPDATE medias SET created_at = now() WHERE created_at IS NULL AND id >= :lo AND id < :hi"),
+                {"lo": lo, "hi": lo + BATCH_SIZE},
+            )
+
+
+def downgrade():
+    op.alter_column("medias", "created_at", server_default=None)
@@ -0,0 +1,26 @@
+"""index for the tweet delete cascade into timelines
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CONCURRENTLY cannot run inside a transaction, but it does not block writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_timelines_tweet_id", "timelines", ["tweet_id"], postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_timelines_tweet_id", table_name="timelines", postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,29 @@
+"""cache versions without a row per entity to lock
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Every bump inserts its own row, so concurrent writes no longer wait on the entity's row
+    op.drop_constraint("cache_versions_pkey", "cache_versions", type_="primary")
+    op.create_primary_key("cache_versions_pkey", "cache_versions", ["entity", "version"])
+
+
+def downgrade():
+    op.execute("""
+        DELETE FROM cache_versions AS old
+        USING cache_versions AS newer
+        WHERE newer.entity = old.entity AND newer.version > old.version
+    """)
+    op.drop_constraint("cache_versions_pkey", "cache_versions", type_="primary")
+    op.create_primary_key("cache_versions_pkey", "cache_versions", ["entity"])
@@ -1,7 +1,21 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import time
+
+import orjson
 import pytest
-from httpx import AsyncClient
+from fastapi import Depends, FastAPI
+from httpx import ASGITransport, AsyncClient
+from PIL import Image
+from sqlalchemy import event, func, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import models
+from app import assets, cleanup, crud, database, derivatives, events, follows, media, metrics, models, schemas, tags, timeline
+from app.cache import LRUCache
+from app.main import app
+from app.response_cache import MemoryBackend, PostgresBackend, RedisBackend, ResponseCache, response_cache, user_entity
+from .conftest import TEST_DB_URL
 
 
 # Add user testing
@@ -57,7 +71,8 @@ async def test_delete_tweet(async_client: AsyncClient, test_user):
 
 # Media testing
 @pytest.mark.anyio
-async def test_upload_media(async_client: AsyncClient, test_user, tmp_path):
+async def test_upload_media(async_client: AsyncClient, test_user, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path / "media")
     headers = {"api-key": test_user.api_key}
     test_file = tmp_path / "test_image.jpg"
     test_file.write_bytes(b"fake image data")
@@ -73,6 +88,212 @@ async def test_upload_media(async_client: AsyncClient, test_user, tmp_path):
     data = response.json()
     assert data["result"] is True
     assert "media_id" in data
+
+
+@pytest.mark.anyio
+async def test_upload_media_is_streamed_to_media_root(async_client: AsyncClient, test_user, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    monkeypatch.setattr(media, "MEDIA_CHUNK_SIZE", 4)
+    payload = b"0123456789" * 3
+
+    response = await async_client.post(
+        "/api/medias",
+        files={"file": ("../escape.jpg", payload, "image/jpeg")},
+        headers={"api-key": test_user.api_key}
+    )
+
+    assert response.status_code == 200
+    sha256 = hashlib.sha256(payload).hexdigest()
+    stored = tmp_path / sha256[:2] / sha256[2:4] / f"{sha256}.jpg"
+    assert stored.read_bytes() == payload
+    assert [p.name for p in tmp_path.iterdir()] == [sha256[:2]]
+
+
+@pytest.mark.anyio
+async def test_media_deduplication_and_release(async_client: AsyncClient, test_user, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    headers = {"api-key": test_user.api_key}
+
+    tweet_ids = []
+    for name in ("first.png", "second.png"):
+        upload = await async_client.post(
+            "/api/medias", files={"file": (name, b"same meme", "image/png")}, headers=headers
+        )
+        created = await async_client.post(
+            "/api/tweets",
+            json={"tweet_data": name, "tweet_media_ids": [upload.json()["media_id"]]},
+            headers=headers
+        )
+        tweet_ids.append(created.json()["tweet_id"])
+
+    sha256 = hashlib.sha256(b"same meme").hexdigest()
+    blob = await db_session.get(models.MediaBlob, sha256, populate_existing=True)
+    assert blob.ref_count == 2
+    stored = media.media_path(blob.url)
+    assert stored.exists()
+
+    await async_client.delete(f"/api/tweets/{tweet_ids[0]}", headers=headers)
+    await cleanup.deletion_queue.join()
+    assert stored.exists()
+
+    await async_client.delete(f"/api/tweets/{tweet_ids[1]}", headers=headers)
+    await cleanup.deletion_queue.join()
+    assert not stored.exists()
+    assert await db_session.get(models.MediaBlob, sha256, populate_existing=True) is None
+
+
+@pytest.mark.anyio
+async def test_queued_deletion_spares_reuploaded_blob(async_client: AsyncClient, test_user, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    headers = {"api-key": test_user.api_key}
+    upload = await async_client.post("/api/medias", files={"file": ("a.png", b"again", "image/png")}, headers=headers)
+    created = await async_client.post(
+        "/api/tweets", json={"tweet_data": "Again", "tweet_media_ids": [upload.json()["media_id"]]}, headers=headers
+    )
+    stored = media.media_path(media.blob_url(hashlib.sha256(b"again").hexdigest(), ".png"))
+
+    # Released and queued, but the same bytes come back before the queue gets to the file
+    released = await crud.delete_tweet(db_session, tweet_id=created.json()["tweet_id"], user_id=test_user.id)
+    await async_client.post("/api/medias", files={"file": ("b.png", b"again", "image/png")}, headers=headers)
+    cleanup.deletion_queue.enqueue(released)
+    await cleanup.deletion_queue.join()
+
+    assert stored.read_bytes() == b"again"
+
+
+@pytest.mark.anyio
+async def test_upload_media_generates_thumbnail(async_client: AsyncClient, test_user, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    headers = {"api-key": test_user.api_key}
+    image = io.BytesIO()
+    Image.new("RGB", (1600, 900), "red").save(image, format="PNG")
+
+    upload = await async_client.post(
+        "/api/medias", files={"file": ("photo.png", image.getvalue(), "image/png")}, headers=headers
+    )
+    await async_client.post(
+        "/api/tweets",
+        json={"tweet_data": "With photo", "tweet_media_ids": [upload.json()["media_id"]]},
+        headers=headers
+    )
+
+    db_media = await db_session.get(models.Media, upload.json()["media_id"])
+    blob = await db_session.get(models.MediaBlob, db_media.sha256, populate_existing=True)
+    with Image.open(media.media_path(blob.thumbnail_url)) as thumbnail:
+        assert max(thumbnail.size) == derivatives.THUMBNAIL_SIZE
+    assert media.media_path(blob.web_url).exists()
+
+    tweet = (await async_client.get("/api/tweets", headers=headers)).json()["tweets"][0]
+    assert tweet["attachments"] == [blob.thumbnail_url]
+    assert tweet["attachment_web"] == [blob.web_url]
+    assert tweet["attachment_originals"] == [blob.url]
+
+
+@pytest.mark.anyio
+async def test_media_garbage_collection(async_client: AsyncClient, test_user, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    headers = {"api-key": test_user.api_key}
+
+    kept = await async_client.post("/api/medias", files={"file": ("kept.jpg", b"kept", "image/jpeg")}, headers=headers)
+    await async_client.post(
+        "/api/tweets", json={"tweet_data": "Kept", "tweet_media_ids": [kept.json()["media_id"]]}, headers=headers
+    )
+    unattached = await async_client.post(
+        "/api/medias", files={"file": ("lost.jpg", b"lost", "image/jpeg")}, headers=headers
+    )
+    stray = tmp_path / "stray.jpg"
+    stray.write_bytes(b"stray")
+
+    stats = await cleanup.collect_garbage(batch_size=1, grace_seconds=0)
+
+    assert stats == {"unattached_media": 1, "orphaned_files": 1}
+    assert not stray.exists()
+    kept_media = await db_session.get(models.Media, kept.json()["media_id"])
+    assert media.media_path(kept_media.url).exists()
+    lost = hashlib.sha256(b"lost").hexdigest()
+    assert not media.media_path(media.blob_url(lost, ".jpg")).exists()
+    assert await db_session.get(models.Media, unattached.json()["media_id"], populate_existing=True) is None
+
+
+@pytest.mark.anyio
+async def test_media_garbage_collection_runs_once_at_a_time(engine, db_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    stray = tmp_path / "stray.jpg"
+    stray.write_bytes(b"stray")
+
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": cleanup.GC_LOCK_ID})
+        assert await cleanup.collect_garbage(grace_seconds=0) is None
+        assert stray.exists()
+
+    assert (await cleanup.collect_garbage(grace_seconds=0))["orphaned_files"] == 1
+    assert not stray.exists()
+
+
+@pytest.mark.anyio
+async def test_media_created_at_defaults_in_database(db_session: AsyncSession):
+    # Rows written without the ORM default, like the ones from before created_at existed
+    await db_session.execute(models.Media.__table__.insert().values(url="static/media/legacy.jpg"))
+    created_at = await db_session.scalar(
+        select(models.Media.created_at).where(models.Media.url == "static/media/legacy.jpg")
+    )
+    assert created_at is not None
+
+
+@pytest.mark.anyio
+async def test_upload_media_too_large(async_client: AsyncClient, test_user, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    monkeypatch.setattr(media, "MEDIA_MAX_SIZE", 16)
+
+    response = await async_client.post(
+        "/api/medias",
+        files={"file": ("big.jpg", b"x" * 17, "image/jpeg")},
+        headers={"api-key": test_user.api_key}
+    )
+
+    assert response.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+async def post_raw_upload(chunks, headers):
+    # Straight to the ASGI app, so the test sees how much of the body was actually read
+    read = 0
+    messages = []
+
+    async def receive():
+        nonlocal read
+        if read < len(chunks):
+            read += 1
+            return {"type": "http.request", "body": chunks[read - 1], "more_body": read < len(chunks)}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/api/medias", "raw_path": b"/api/medias", "root_path": "", "query_string": b"",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=limit")] + headers,
+        "server": ("test", 80), "client": ("127.0.0.1", 1),
+    }
+    await app(scope, receive, send)
+    return messages[0]["status"], read
+
+
+@pytest.mark.anyio
+async def test_upload_media_stops_reading_oversized_body(async_client: AsyncClient, tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    monkeypatch.setattr(media, "MEDIA_MAX_SIZE", 1024)
+    head = b'--limit\r\nContent-Disposition: form-data; name="file"; filename="big.jpg"\r\n\r\n'
+    chunks = [head] + [b"x" * 65536] * 80
+
+    status_code, read = await post_raw_upload(chunks, [])
+    assert status_code == 413
+    assert read < 5
+    assert list(tmp_path.iterdir()) == []
+
+    status_code, read = await post_raw_upload(chunks, [(b"content-length", str(80 * 65536).encode())])
+    assert (status_code, read) == (413, 0)
 # =================================================================================
 
 
@@ -87,6 +308,22 @@ async def test_like_tweet(async_client: AsyncClient, test_user):
     response = await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
     assert response.status_code == 200
     assert response.json()["result"] is True
+
+
+@pytest.mark.anyio
+async def test_like_tweet_twice(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    create_response = await async_client.post(
+        "/api/tweets", json={"tweet_data": "Test tweet to like twice"}, headers=headers
+    )
+    tweet_id = create_response.json()["tweet_id"]
+
+    await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+    response = await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+    assert response.status_code == 400
+
+    assert (await async_client.delete(f"/api/tweets/{tweet_id}/likes", headers=headers)).status_code == 200
+    assert (await async_client.delete(f"/api/tweets/{tweet_id}/likes", headers=headers)).status_code == 404
 # =================================================================================
 
 
@@ -115,4 +352,927 @@ async def test_unfollow_user(async_client: AsyncClient, test_user, db_session: A
     response = await async_client.delete(f"/api/users/{new_user.id}/follow", headers=headers)
     assert response.status_code == 200
     assert response.json()["result"] is True
-# =================================================================================
\ No newline at end of file
+
+
+@pytest.mark.anyio
+async def test_follow_user_twice(async_client: AsyncClient, test_user, db_session: AsyncSession):
+    new_user = models.User(name="New User", api_key="new_api_key")
+    db_session.add(new_user)
+    await db_session.commit()
+
+    headers = {"api-key": test_user.api_key}
+    await async_client.post(f"/api/users/{new_user.id}/follow", headers=headers)
+    response = await async_client.post(f"/api/users/{new_user.id}/follow", headers=headers)
+    assert response.status_code == 400
+
+    await async_client.delete(f"/api/users/{new_user.id}/follow", headers=headers)
+    response = await async_client.delete(f"/api/users/{new_user.id}/follow", headers=headers)
+    assert response.status_code == 404
+# =================================================================================
+
+# Feed query budget testing
+async def count_feed_queries(engine, db_session: AsyncSession) -> int:
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        await crud.get_tweets(db_session)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", on_execute)
+    return len(statements)
+
+
+async def seed_feed(db_session: AsyncSession, author, tweets_count: int):
+    likers = [models.User(name=f"Liker {i}", api_key=f"liker_{tweets_count}_{i}") for i in range(3)]
+    tweets = [
+        models.Tweet(
+            tweet_data=f"Tweet {i}",
+            author=author,
+            media=[models.Media(url=f"static/media/{tweets_count}_{i}.jpg")],
+            likes=[models.Like(user=liker) for liker in likers],
+        )
+        for i in range(tweets_count)
+    ]
+    db_session.add_all(likers + tweets)
+    await db_session.commit()
+
+
+@pytest.mark.anyio
+async def test_get_tweets_query_count_is_constant(engine, db_session: AsyncSession, test_user):
+    await seed_feed(db_session, test_user, 2)
+    small_feed_queries = await count_feed_queries(engine, db_session)
+
+    await seed_feed(db_session, test_user, 50)
+    large_feed_queries = await count_feed_queries(engine, db_session)
+
+    assert small_feed_queries == large_feed_queries
+
+
+@pytest.mark.anyio
+async def test_get_tweets_includes_likes(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    create_response = await async_client.post(
+        "/api/tweets", json={"tweet_data": "Liked tweet", "tweet_media_ids": []}, headers=headers
+    )
+    tweet_id = create_response.json()["tweet_id"]
+    await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+
+    response = await async_client.get("/api/tweets", headers=headers)
+    tweet = next(t for t in response.json()["tweets"] if t["id"] == tweet_id)
+    assert tweet["likes"] == [{"user_id": test_user.id, "name": test_user.name}]
+# =================================================================================
+
+
+# Feed pagination testing
+@pytest.mark.anyio
+async def test_get_tweets_cursor_pagination(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    created_ids = []
+    for i in range(5):
+        response = await async_client.post(
+            "/api/tweets", json={"tweet_data": f"Tweet {i}", "tweet_media_ids": []}, headers=headers
+        )
+        created_ids.append(response.json()["tweet_id"])
+
+    seen_ids = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = await async_client.get("/api/tweets", params=params, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["tweets"]) <= 2
+        seen_ids.extend(t["id"] for t in data["tweets"])
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen_ids == list(reversed(created_ids))
+
+
+@pytest.mark.anyio
+async def test_get_tweets_invalid_cursor(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    response = await async_client.get("/api/tweets", params={"cursor": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 400
+# =================================================================================
+
+
+# Home timeline testing
+async def timeline_ids(async_client: AsyncClient, api_key: str):
+    response = await async_client.get("/api/timeline", headers={"api-key": api_key})
+    assert response.status_code == 200
+    return [t["id"] for t in response.json()["tweets"]]
+
+
+@pytest.mark.anyio
+async def test_timeline_fan_out_backfill_and_prune(async_client: AsyncClient, test_user, db_session):
+    author = models.User(name="Author", api_key="author_key")
+    db_session.add(author)
+    await db_session.commit()
+    author_headers = {"api-key": author.api_key}
+
+    early = await async_client.post("/api/tweets", json={"tweet_data": "Before follow"}, headers=author_headers)
+    await async_client.post(f"/api/users/{author.id}/follow", headers={"api-key": test_user.api_key})
+    late = await async_client.post("/api/tweets", json={"tweet_data": "After follow"}, headers=author_headers)
+
+    assert await timeline_ids(async_client, test_user.api_key) == [
+        late.json()["tweet_id"], early.json()["tweet_id"]
+    ]
+
+    await async_client.delete(f"/api/users/{author.id}/follow", headers={"api-key": test_user.api_key})
+    assert await timeline_ids(async_client, test_user.api_key) == []
+
+
+@pytest.mark.anyio
+async def test_timeline_pulls_celebrity_tweets(async_client: AsyncClient, test_user, db_session, monkeypatch):
+    monkeypatch.setattr(timeline, "CELEBRITY_FOLLOWERS_THRESHOLD", 0)
+    celebrity = models.User(name="Celebrity", api_key="celebrity_key")
+    db_session.add(celebrity)
+    await db_session.commit()
+
+    await async_client.post(f"/api/users/{celebrity.id}/follow", headers={"api-key": test_user.api_key})
+    response = await async_client.post(
+        "/api/tweets", json={"tweet_data": "Hello fans"}, headers={"api-key": celebrity.api_key}
+    )
+    tweet_id = response.json()["tweet_id"]
+
+    pushed = await db_session.scalar(
+        select(models.TimelineEntry).where(models.TimelineEntry.tweet_id == tweet_id)
+    )
+    assert pushed is None
+    assert await timeline_ids(async_client, test_user.api_key) == [tweet_id]
+
+
+@pytest.mark.anyio
+async def test_timeline_rebuild_fills_existing_follows(async_client: AsyncClient, test_user, db_session):
+    # Rows written around crud, the way pre-0002 data and the dev fixtures are
+    old = models.Tweet(tweet_data="Old tweet")
+    author = models.User(name="Author", api_key="author_key", tweets=[old])
+    own = models.Tweet(tweet_data="My old tweet", author_id=test_user.id)
+    db_session.add_all([author, own])
+    await db_session.flush()
+    tweet_ids = sorted([old.id, own.id])
+    db_session.add(models.Follow(follower_id=test_user.id, followed_id=author.id))
+    await db_session.commit()
+    assert await timeline_ids(async_client, test_user.api_key) == []
+
+    assert await timeline.rebuild_all(batch_size=1) == author.id
+    await timeline.rebuild_all(batch_size=1)
+
+    assert sorted(await timeline_ids(async_client, test_user.api_key)) == tweet_ids
+    count = await db_session.scalar(select(func.count()).select_from(models.TimelineEntry))
+    assert count == 3
+
+
+@pytest.mark.anyio
+async def test_dev_fixtures_have_timelines(db_session):
+    await database.init_test_data(db_session)
+    follow = (await db_session.execute(select(models.Follow.follower_id, models.Follow.followed_id))).first()
+    authored = select(models.Tweet.id).where(models.Tweet.author_id == follow.followed_id)
+    delivered = select(models.TimelineEntry.tweet_id).where(models.TimelineEntry.user_id == follow.follower_id)
+    assert set((await db_session.scalars(authored)).all()) <= set((await db_session.scalars(delivered)).all())
+# =================================================================================
+
+
+# Principal cache testing
+@pytest.mark.anyio
+async def test_principal_cache_hits_and_invalidation(db_session: AsyncSession, test_user):
+    hits = crud.principal_cache.hits
+
+    principal = await crud.get_principal(db_session, test_user.api_key)
+    assert principal.id == test_user.id
+    assert await crud.get_principal(db_session, test_user.api_key) == principal
+    assert crud.principal_cache.hits == hits + 1
+
+    test_user.name = "Renamed"
+    await db_session.commit()
+    assert (await crud.get_principal(db_session, test_user.api_key)).name == "Renamed"
+
+
+@pytest.mark.anyio
+async def test_principal_cache_unknown_key(db_session: AsyncSession):
+    assert await crud.get_principal(db_session, "missing_key") is None
+    assert "missing_key" not in crud.principal_cache._data
+
+
+@pytest.mark.anyio
+async def test_principal_invalidated_after_many_other_lookups(db_session: AsyncSession, test_user, monkeypatch):
+    monkeypatch.setattr(crud, "principal_cache", LRUCache(maxsize=3, ttl=60))
+    await crud.get_principal(db_session, test_user.api_key)
+    for i in range(2):
+        crud.principal_cache.set(f"other_{i}", schemas.UserBase(id=-i - 1, name="other"))
+
+    test_user.name = "Renamed"
+    await db_session.commit()
+    assert test_user.api_key not in crud.principal_cache._data
+    assert len(crud.principal_cache) == 2
+
+
+def test_lru_cache_eviction_and_ttl(monkeypatch):
+    cache = LRUCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert cache.stats()["evictions"] == 2
+# =================================================================================
+
+
+# Connection pool testing
+@pytest.mark.anyio
+async def test_pool_stats():
+    test_engine = database.create_engine(f"{TEST_DB_URL}?prepared_statement_cache_size=10")
+    waits = database.pool_wait_stats.waits
+    try:
+        async with test_engine.connect() as conn:
+            await conn.execute(text("select 1"))
+            assert database.pool_stats(test_engine)["checked_out"] == 1
+        stats = database.pool_stats(test_engine)
+        assert stats["checked_out"] == 0
+        assert stats["waits"] == waits
+    finally:
+        await test_engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_pool_wait_counts_only_blocked_checkouts(monkeypatch):
+    monkeypatch.setattr(database, "DB_POOL_SIZE", 1)
+    monkeypatch.setattr(database, "DB_MAX_OVERFLOW", 0)
+    test_engine = database.create_engine(TEST_DB_URL)
+    waits = database.pool_wait_stats.waits
+
+    async def checkout():
+        async with test_engine.connect() as conn:
+            await conn.execute(text("select 1"))
+
+    try:
+        async with test_engine.connect() as conn:
+            await conn.execute(text("select 1"))
+            assert database.pool_wait_stats.waits == waits
+            waiter = asyncio.create_task(checkout())
+            await asyncio.sleep(0.1)
+        await waiter
+        assert database.pool_wait_stats.waits == waits + 1
+        assert database.pool_wait_stats.wait_seconds_max >= 0.05
+    finally:
+        await test_engine.dispose()
+# =================================================================================
+
+
+# Replica routing testing
+@pytest.mark.anyio
+async def test_replica_router(engine):
+    primary = database.session_factory(engine)
+    replica_engines = [database.create_engine(TEST_DB_URL) for _ in range(2)]
+    replicas = [database.session_factory(replica_engine) for replica_engine in replica_engines]
+    router = database.ReplicaRouter(primary, replicas, retry_seconds=60, read_your_writes_seconds=60)
+    try:
+        assert [router.choose() for _ in range(4)] == replicas * 2
+
+        router.mark_unhealthy(replicas[0])
+        assert [router.choose() for _ in range(2)] == [replicas[1]] * 2
+
+        assert router.choose(router.write_marker()) is primary
+        assert router.choose(f"{time.time() - 1:.3f}") is replicas[1]
+        assert router.choose("garbage") is replicas[1]
+
+        async with router.choose()() as session:
+            assert await session.scalar(text("select 1")) == 1
+    finally:
+        for replica_engine in replica_engines:
+            await replica_engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_write_marker_follows_client_to_another_worker(engine, monkeypatch):
+    replica_engine = database.create_engine(TEST_DB_URL)
+    router = database.ReplicaRouter(
+        database.session_factory(engine), [database.session_factory(replica_engine)], read_your_writes_seconds=60
+    )
+    monkeypatch.setattr(database, "replica_router", router)
+
+    def worker() -> FastAPI:
+        # Nothing is shared between the two apps except what the client sends back
+        api = FastAPI()
+        api.add_middleware(database.ReadYourWritesMiddleware, router=router)
+
+        @api.post("/write")
+        async def write(db: AsyncSession = Depends(database.get_db)):
+            return {}
+
+        @api.get("/read")
+        async def read(db: AsyncSession = Depends(database.get_read_db)):
+            return {"primary": db.bind is engine}
+
+        return api
+
+    try:
+        async with AsyncClient(transport=ASGITransport(app=worker()), base_url="http://test") as first:
+            assert (await first.get("/read")).json() == {"primary": False}
+            response = await first.post("/write")
+            assert database.READ_YOUR_WRITES_COOKIE in response.headers["set-cookie"]
+            cookies = first.cookies
+        async with AsyncClient(transport=ASGITransport(app=worker()), base_url="http://test", cookies=cookies) as second:
+            assert (await second.get("/read")).json() == {"primary": True}
+    finally:
+        await replica_engine.dispose()
+# =================================================================================
+
+
+# Response cache testing
+@pytest.mark.anyio
+async def test_feed_response_cache_invalidation(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    created = await async_client.post("/api/tweets", json={"tweet_data": "Cached"}, headers=headers)
+    tweet_id = created.json()["tweet_id"]
+
+    await async_client.get("/api/tweets", headers=headers)
+    hits = response_cache.hits
+    await async_client.get("/api/tweets", headers=headers)
+    assert response_cache.hits == hits + 1
+
+    await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+    response = await async_client.get("/api/tweets", headers=headers)
+    assert response_cache.hits == hits + 1
+    assert response.json()["tweets"][0]["likes"][0]["user_id"] == test_user.id
+
+
+@pytest.mark.anyio
+async def test_user_response_cache_invalidation(async_client: AsyncClient, test_user, db_session):
+    other = models.User(name="Other", api_key="other_key")
+    db_session.add(other)
+    await db_session.commit()
+
+    assert (await async_client.get(f"/api/users/{other.id}")).json()["user"]["followers"] == []
+    await async_client.post(f"/api/users/{other.id}/follow", headers={"api-key": test_user.api_key})
+    followers = (await async_client.get(f"/api/users/{other.id}")).json()["user"]["followers"]
+    assert followers == [{"id": test_user.id, "name": test_user.name}]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("backend_factory", [MemoryBackend, lambda: RedisBackend(FakeRedis())])
+async def test_response_cache_single_flight(backend_factory):
+    cache = ResponseCache(backend_factory(), ttl=60)
+    calls = 0
+
+    async def build():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return f"calls={calls}".encode()
+
+    versions = await cache.versions(["feed"])
+    results = await asyncio.gather(*[cache.get_or_build("feed", {}, versions, build) for _ in range(10)])
+    assert results == [b"calls=1"] * 10
+    assert await cache.get_or_build("feed", {}, versions, build) == b"calls=1"
+
+    await cache.bump("feed")
+    assert await cache.get_or_build("feed", {}, await cache.versions(["feed"]), build) == b"calls=2"
+    assert cache.stats()["builds"] == 2
+
+
+@pytest.mark.anyio
+async def test_response_cache_versions_shared_between_workers(db_session: AsyncSession):
+    # Two caches stand in for two worker processes, only the database is shared
+    first, second = ResponseCache(PostgresBackend(), ttl=60), ResponseCache(PostgresBackend(), ttl=60)
+    built = []
+
+    def build(worker):
+        async def run():
+            built.append(worker)
+            return f"{worker}:{len(built)}".encode()
+        return run
+
+    assert await first.get_or_build("feed", {}, await first.versions(["feed"], db_session), build(1)) == b"1:1"
+    assert await second.get_or_build("feed", {}, await second.versions(["feed"], db_session), build(2)) == b"2:2"
+
+    await first.bump("feed", "feed", user_entity(1))
+    versions = await second.versions(["feed"], db_session)
+    assert versions != (0,)
+    assert await second.get_or_build("feed", {}, versions, build(2)) == b"2:3"
+    assert await second.get_or_build("feed", {}, versions, build(2)) == b"2:3"
+    assert first.etag("feed", {}, versions) == second.etag("feed", {}, versions)
+
+
+@pytest.mark.anyio
+async def test_postgres_cache_bumps_do_not_wait_for_each_other(engine, db_session: AsyncSession):
+    cache = ResponseCache(PostgresBackend(), ttl=60)
+    await cache.bump("feed")
+    before = await cache.versions(["feed"])
+
+    async with AsyncSession(engine) as first, AsyncSession(engine) as second:
+        await cache.bump("feed", db=first)
+        # The first write holds the old row, the second one leaves it to it instead of waiting
+        await asyncio.wait_for(cache.bump("feed", db=second), timeout=2)
+        await second.commit()
+        after_second = await cache.versions(["feed"])
+        await first.commit()
+    after_first = await cache.versions(["feed"])
+    assert len({before, after_second, after_first}) == 3
+
+    await cache.bump("feed")
+    assert await db_session.scalar(text("SELECT count(*) FROM cache_versions")) == 1
+# =================================================================================
+
+
+# Conditional GET testing
+@pytest.mark.anyio
+async def test_feed_etag_not_modified(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    created = await async_client.post("/api/tweets", json={"tweet_data": "Polled"}, headers=headers)
+
+    first = await async_client.get("/api/tweets", headers=headers)
+    etag = first.headers["etag"]
+    lookups = response_cache.hits + response_cache.misses
+
+    second = await async_client.get("/api/tweets", headers={**headers, "If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.content == b""
+    assert response_cache.hits + response_cache.misses == lookups
+
+    await async_client.post(f"/api/tweets/{created.json()['tweet_id']}/likes", headers=headers)
+    third = await async_client.get("/api/tweets", headers={**headers, "If-None-Match": etag})
+    assert third.status_code == 200
+    assert third.headers["etag"] != etag
+
+
+@pytest.mark.anyio
+async def test_user_etag_not_modified(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    etag = (await async_client.get("/api/users/me", headers=headers)).headers["etag"]
+
+    response = await async_client.get(f"/api/users/{test_user.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+@pytest.mark.anyio
+async def test_etag_matches_on_another_worker(async_client: AsyncClient, test_user, monkeypatch):
+    headers = {"api-key": test_user.api_key}
+    await async_client.post("/api/tweets", json={"tweet_data": "Polled"}, headers=headers)
+    etag = (await async_client.get("/api/tweets", headers=headers)).headers["etag"]
+
+    # A fresh backend is what a poll landing on another worker sees
+    monkeypatch.setattr(response_cache, "backend", PostgresBackend())
+    response = await async_client.get("/api/tweets", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+# =================================================================================
+
+
+# Metrics testing
+@pytest.mark.anyio
+async def test_internal_endpoints_require_token(async_client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "secret")
+    for path in ("/metrics", "/stats/pool", "/stats/cache", "/stats/events"):
+        assert (await async_client.get(path)).status_code == 403
+        assert (await async_client.get(path, headers={"Authorization": "Bearer wrong"})).status_code == 403
+        assert (await async_client.get(path, headers={"Authorization": "Bearer secret"})).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_metrics_record_route_latency_and_queries(async_client: AsyncClient, test_user):
+    labels = ("GET", "/api/users/{user_id}", 200)
+    requests_before = metrics.request_seconds.count(*labels)
+
+    response = await async_client.get(f"/api/users/{test_user.id}")
+    assert response.status_code == 200
+    assert metrics.request_seconds.count(*labels) == requests_before + 1
+    counts, _ = metrics.request_queries.series[labels]
+    assert sum(counts[1:]) > 0
+
+    scrape = await async_client.get("/metrics")
+    assert scrape.headers["content-type"].startswith("text/plain")
+    body = scrape.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/users/{user_id}",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/users/{user_id}",status="200",le="+Inf"}' in body
+    assert "db_queries_total " in body
+    assert "db_pool_checked_out " in body
+
+
+@pytest.mark.anyio
+async def test_slow_request_log_lists_queries(async_client: AsyncClient, test_user, monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_SECONDS", 1e-9)
+    with caplog.at_level("WARNING", logger="app.metrics"):
+        await async_client.get(f"/api/users/{test_user.id}")
+
+    record = next(r for r in caplog.records if r.name == "app.metrics")
+    assert f"/api/users/{test_user.id}" in record.getMessage()
+    assert "SELECT users.id" in record.getMessage()
+# =================================================================================
+
+
+# Search testing
+@pytest.mark.anyio
+async def test_search_tweets_ranked_with_highlights(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    for text in ["coffee", "coffee and more coffee", "tea only", "<b>coffee</b> & cake"]:
+        await async_client.post("/api/tweets", json={"tweet_data": text}, headers=headers)
+
+    response = await async_client.get("/api/tweets/search", params={"q": "coffee"}, headers=headers)
+    assert response.status_code == 200
+    tweets = response.json()["tweets"]
+    assert [t["content"] for t in tweets][0] == "coffee and more coffee"
+    assert {t["content"] for t in tweets} == {"coffee", "coffee and more coffee", "<b>coffee</b> & cake"}
+    highlights = {t["content"]: t["highlight"] for t in tweets}
+    assert highlights["coffee and more coffee"] == "<mark>coffee</mark> and more <mark>coffee</mark>"
+    # User markup never reaches the highlight unescaped
+    assert "<b>" not in highlights["<b>coffee</b> & cake"]
+    assert "&amp; cake" in highlights["<b>coffee</b> & cake"]
+    assert tweets[0]["author"]["name"] == test_user.name
+
+
+@pytest.mark.anyio
+async def test_search_tweets_pagination(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    for i in range(5):
+        await async_client.post("/api/tweets", json={"tweet_data": "search " * (i + 1)}, headers=headers)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"q": "search", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        body = (await async_client.get("/api/tweets/search", params=params, headers=headers)).json()
+        seen.extend(t["content"].count("search") for t in body["tweets"])
+        # Tweets posted while paging stay out of the pages already being walked
+        await async_client.post("/api/tweets", json={"tweet_data": "search " * 10}, headers=headers)
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert seen == [5, 4, 3, 2, 1]
+
+    missing = await async_client.get("/api/tweets/search", params={"q": "nothing"}, headers=headers)
+    assert missing.json()["tweets"] == []
+    bad = await async_client.get("/api/tweets/search", params={"q": "search", "cursor": "x"}, headers=headers)
+    assert bad.status_code == 400
+# =================================================================================
+
+
+# Hashtags and mentions testing
+def test_extract_hashtags_and_mentions():
+    text = "#Python and #python, #тест; mail me@example.com, thanks @Alice @bob!"
+    assert tags.extract_hashtags(text) == ["python", "тест"]
+    assert tags.extract_mentions(text) == ["alice", "bob"]
+
+
+@pytest.mark.anyio
+async def test_tweets_by_tag_and_mentions(async_client: AsyncClient, db_session: AsyncSession, test_user):
+    alice = models.User(name="Alice", api_key="alice_key")
+    db_session.add(alice)
+    await db_session.commit()
+    headers = {"api-key": test_user.api_key}
+    for i in range(3):
+        await async_client.post("/api/tweets", json={"tweet_data": f"#Coffee number {i} @alice"}, headers=headers)
+    await async_client.post("/api/tweets", json={"tweet_data": "#tea @nobody"}, headers=headers)
+
+    first = (await async_client.get("/api/tags/coffee/tweets", params={"limit": 2}, headers=headers)).json()
+    assert [t["content"] for t in first["tweets"]] == ["#Coffee number 2 @alice", "#Coffee number 1 @alice"]
+    rest = (await async_client.get(
+        "/api/tags/%23COFFEE/tweets", params={"limit": 2, "cursor": first["next_cursor"]}, headers=headers
+    )).json()
+    assert [t["content"] for t in rest["tweets"]] == ["#Coffee number 0 @alice"]
+    assert rest["next_cursor"] is None
+
+    mentions = (await async_client.get(f"/api/users/{alice.id}/mentions", headers=headers)).json()
+    assert len(mentions["tweets"]) == 3
+    unknown = (await async_client.get("/api/tags/missing/tweets", headers=headers)).json()
+    assert unknown["tweets"] == []
+
+
+@pytest.mark.anyio
+async def test_tags_backfill_streams_existing_tweets(db_session: AsyncSession, test_user):
+    db_session.add_all([
+        models.Tweet(tweet_data=f"old #backlog tweet {i}", author_id=test_user.id) for i in range(7)
+    ])
+    await db_session.commit()
+
+    assert await tags.backfill(batch_size=3) == 7
+    # Running it again changes nothing
+    assert await tags.backfill(batch_size=3) == 7
+    tweet_ids, _ = await tags.get_tag_page(db_session, "backlog", limit=10)
+    assert len(tweet_ids) == 7
+# =================================================================================
+
+
+# Events testing
+@pytest.mark.anyio
+async def test_event_stream_requires_api_key(async_client: AsyncClient, test_user):
+    response = await async_client.get("/api/events", headers={"api-key": "wrong"})
+    assert response.status_code == 401
+    # The key is no longer accepted in the query string, where access logs would keep it
+    response = await async_client.get("/api/events", params={"api_key": test_user.api_key})
+    assert response.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_stream_token_cookie(async_client: AsyncClient, db_session: AsyncSession, test_user, monkeypatch):
+    response = await async_client.post("/api/events/token", headers={"api-key": test_user.api_key})
+    assert response.status_code == 200
+    assert "Path=/api/events" in response.headers["set-cookie"]
+    assert "HttpOnly" in response.headers["set-cookie"]
+    token = response.cookies[events.STREAM_TOKEN_COOKIE]
+    assert test_user.api_key not in token
+    assert (await crud.get_stream_principal(db_session, token)).id == test_user.id
+
+    user_id, expires_at, signature = token.split(".")
+    assert await crud.get_stream_principal(db_session, f"{user_id}.{int(expires_at) + 60}.{signature}") is None
+    assert await crud.get_stream_principal(db_session, "garbage") is None
+
+    monkeypatch.setattr(events, "EVENTS_TOKEN_SECONDS", -1)
+    expired = events.issue_stream_token(test_user.id, test_user.api_key)
+    assert await crud.get_stream_principal(db_session, expired) is None
+
+
+@pytest.mark.anyio
+async def test_writes_publish_events(async_client: AsyncClient, test_user):
+    headers = {"api-key": test_user.api_key}
+    subscriber = events.event_hub.subscribe()
+    try:
+        tweet_id = (await async_client.post("/api/tweets", json={"tweet_data": "live"}, headers=headers)).json()["tweet_id"]
+        await async_client.post(f"/api/tweets/{tweet_id}/likes", headers=headers)
+        await async_client.delete(f"/api/tweets/{tweet_id}/likes", headers=headers)
+        await async_client.delete(f"/api/tweets/{tweet_id}", headers=headers)
+        received = [orjson.loads(payload) for payload in await subscriber.next_batch(timeout=1)]
+    finally:
+        events.event_hub.unsubscribe(subscriber)
+
+    assert [event["type"] for event in received] == [
+        events.TWEET_CREATED, events.LIKE_ADDED, events.LIKE_REMOVED, events.TWEET_DELETED
+    ]
+    assert received[0] == {"type": events.TWEET_CREATED, "tweet_id": tweet_id, "author_id": test_user.id}
+    assert received[1]["user_id"] == test_user.id
+
+
+@pytest.mark.anyio
+async def test_event_hub_drops_slow_consumers():
+    hub = events.EventHub(events.LocalBroker(), buffer_size=2, heartbeat=0.01)
+    stream = hub.stream()
+    assert (await stream.__anext__()).startswith(b"retry:")
+    assert await stream.__anext__() == b": ping\n\n"
+
+    slow = hub.subscribe()
+    await hub.publish({"n": 1})
+    await hub.publish({"n": 2})
+    assert await stream.__anext__() == b'data: {"n":1}\n\ndata: {"n":2}\n\n'
+    await hub.publish({"n": 3})
+
+    assert slow.dropped and slow not in hub.subscribers
+    assert hub.stats()["dropped"] == 1
+    assert await stream.__anext__() == b'data: {"n":3}\n\n'
+    await hub.stop()
+    with pytest.raises(StopAsyncIteration):
+        await stream.__anext__()
+    assert not hub.subscribers
+
+
+@pytest.mark.anyio
+async def test_events_follow_the_write_transaction(db_session: AsyncSession):
+    hub = events.EventHub(events.LocalBroker())
+    cache = ResponseCache(MemoryBackend(), ttl=60)
+    subscriber = hub.subscribe()
+
+    await db_session.execute(text("SELECT 1"))
+    await hub.publish({"n": 1}, db_session)
+    await cache.bump("feed", db=db_session)
+    await db_session.rollback()
+    await hub.publish({"n": 2}, db_session)
+    await cache.bump("feed", db=db_session)
+    assert not subscriber.buffer and await cache.versions(["feed"]) == (0,)
+
+    await db_session.commit()
+    assert await subscriber.next_batch(timeout=1) == [b'{"n":2}']
+    assert await cache.versions(["feed"]) == (1,)
+
+
+@pytest.mark.anyio
+async def test_postgres_broker_relays_between_workers(db_session: AsyncSession):
+    dsn = TEST_DB_URL.replace("+asyncpg", "")
+    sender = events.EventHub(events.PostgresBroker(dsn, channel="test_events"))
+    receiver = events.EventHub(events.PostgresBroker(dsn, channel="test_events"))
+    await receiver.start()
+    try:
+        await asyncio.wait_for(receiver.broker.listening.wait(), timeout=5)
+        subscriber = receiver.subscribe()
+        await sender.publish({"type": events.TWEET_CREATED, "tweet_id": 1})
+        assert await subscriber.next_batch(timeout=5) == [b'{"type":"tweet_created","tweet_id":1}']
+
+        # NOTIFY inside a write's transaction is sent on commit only
+        await sender.publish({"tweet_id": 2}, db_session)
+        await db_session.rollback()
+        await sender.publish({"tweet_id": 3}, db_session)
+        await db_session.commit()
+        assert await subscriber.next_batch(timeout=5) == [b'{"tweet_id":3}']
+    finally:
+        await receiver.stop()
+        await sender.stop()
+# =================================================================================
+
+
+# Static assets testing
+@pytest.fixture
+def bundle(tmp_path):
+    (tmp_path / "js").mkdir()
+    (tmp_path / "css").mkdir()
+    script = b"console.log('feed');\n" * 200
+    (tmp_path / "js" / "app.0123abcd.js").write_bytes(script)
+    (tmp_path / "js" / "app.0123abcd.js.map").write_bytes(b"{}")
+    (tmp_path / "js" / "plain.js").write_bytes(script)
+    (tmp_path / "css" / "app.89abcdef.css").write_bytes(b"body { color: red; }\n" * 100)
+    (tmp_path / "index.html").write_bytes(b"<html>" + b"<p>feed</p>" * 100 + b"</html>")
+    return tmp_path, script
+
+
+def test_assets_build_precompresses_bundle(bundle):
+    root, script = bundle
+    written, skipped, _ = assets.build(root)
+    assert (written, skipped) == (8, 0)
+    assert gzip.decompress((root / "js" / "app.0123abcd.js.gz").read_bytes()) == script
+    assert (root / "js" / "app.0123abcd.js.br").exists()
+    assert not (root / "js" / "app.0123abcd.js.map.gz").exists()
+
+    # Up-to-date variants are kept, orphans of removed bundle files are deleted
+    (root / "js" / "plain.js").unlink()
+    assert assets.build(root)[:2] == (0, 6)
+    assert not (root / "js" / "plain.js.gz").exists()
+
+
+@pytest.mark.anyio
+async def test_precompressed_static_files_negotiate_encoding(bundle):
+    root, script = bundle
+    assets.build(root)
+    static_app = FastAPI()
+    static_app.mount("/js", assets.PrecompressedStaticFiles(directory=root / "js"))
+
+    async with AsyncClient(transport=ASGITransport(app=static_app), base_url="http://test") as client:
+        brotli_response = await client.get("/js/app.0123abcd.js", headers={"Accept-Encoding": "gzip, br"})
+        gzip_response = await client.get("/js/app.0123abcd.js", headers={"Accept-Encoding": "gzip, br;q=0"})
+        identity = await client.get("/js/app.0123abcd.js", headers={"Accept-Encoding": "identity"})
+        unhashed = await client.get("/js/plain.js", headers={"Accept-Encoding": "gzip"})
+        not_modified = await client.get(
+            "/js/app.0123abcd.js",
+            headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_response.headers["etag"]},
+        )
+        source_map = await client.get("/js/app.0123abcd.js.map")
+        variant = await client.get("/js/app.0123abcd.js.gz")
+
+    assert brotli_response.headers["content-encoding"] == "br"
+    assert gzip_response.headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in identity.headers
+    assert brotli_response.content == gzip_response.content == identity.content == script
+    assert brotli_response.headers["content-type"].startswith("text/javascript")
+    assert brotli_response.headers["cache-control"] == assets.IMMUTABLE
+    assert brotli_response.headers["vary"] == "Accept-Encoding"
+    assert unhashed.headers["cache-control"] == assets.REVALIDATE
+    assert not_modified.status_code == 304
+    assert source_map.status_code == 404
+    assert variant.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_static_mount_hides_source_maps(async_client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(assets, "SERVE_SOURCE_MAPS", False)
+    source_map = next((media.STATIC_DIR / "js").glob("*.js.map"))
+    bundle = source_map.name[:-len(".map")]
+
+    assert (await async_client.get(f"/static/js/{source_map.name}")).status_code == 404
+    assert (await async_client.get(f"/static/js/{bundle}.gz")).status_code == 404
+    assert (await async_client.get(f"/static/js/{bundle}.br")).status_code == 404
+    response = await async_client.get(f"/static/js/{bundle}")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == assets.IMMUTABLE
+# =================================================================================
+
+
+# Media serving testing
+@pytest.fixture
+def media_app(tmp_path):
+    (tmp_path / "ab" / "cd").mkdir(parents=True)
+    (tmp_path / "ab" / "cd" / "clip.mp4").write_bytes(bytes(range(256)) * 1024)
+    (tmp_path / ".upload-123").write_bytes(b"partial")
+
+    def build(prefix: str = ""):
+        served = FastAPI()
+        served.mount("/static/media", media.MediaFiles(directory=tmp_path, accel_redirect_prefix=prefix))
+        return AsyncClient(transport=ASGITransport(app=served), base_url="http://test")
+
+    return build
+
+
+@pytest.mark.anyio
+async def test_media_files_support_ranges_and_revalidation(media_app):
+    async with media_app() as client:
+        full = await client.get("/static/media/ab/cd/clip.mp4")
+        ranged = await client.get("/static/media/ab/cd/clip.mp4", headers={"Range": "bytes=1000-1999"})
+        revalidated = await client.get("/static/media/ab/cd/clip.mp4", headers={"If-None-Match": full.headers["etag"]})
+        since = await client.get(
+            "/static/media/ab/cd/clip.mp4", headers={"If-Modified-Since": full.headers["last-modified"]}
+        )
+        partial_upload = await client.get("/static/media/.upload-123")
+
+    assert full.status_code == 200
+    assert full.headers["content-type"] == "video/mp4"
+    assert full.headers["cache-control"] == media.MEDIA_CACHE_CONTROL
+    assert full.headers["accept-ranges"] == "bytes"
+    assert ranged.status_code == 206
+    assert ranged.headers["content-range"] == f"bytes 1000-1999/{256 * 1024}"
+    assert ranged.content == full.content[1000:2000]
+    assert revalidated.status_code == 304
+    assert since.status_code == 304
+    assert partial_upload.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_media_files_offload_to_nginx(media_app):
+    async with media_app("/_media/") as client:
+        response = await client.get("/static/media/ab/cd/clip.mp4", headers={"Range": "bytes=0-9"})
+        missing = await client.get("/static/media/ab/cd/missing.mp4")
+
+    # nginx applies the Range itself, the worker only names the file
+    assert response.status_code == 200
+    assert response.headers["x-accel-redirect"] == "/_media/ab/cd/clip.mp4"
+    assert response.headers["cache-control"] == media.MEDIA_CACHE_CONTROL
+    assert response.headers["content-type"] == "video/mp4"
+    assert response.content == b""
+    assert missing.status_code == 404
+# =================================================================================
+
+
+# Follow lists testing
+@pytest.mark.anyio
+async def test_follow_counts_follow_and_unfollow(async_client: AsyncClient, test_user, db_session: AsyncSession):
+    other = models.User(name="Counted", api_key="counted_key")
+    db_session.add(other)
+    await db_session.commit()
+    headers = {"api-key": test_user.api_key}
+
+    await async_client.post(f"/api/users/{other.id}/follow", headers=headers)
+    profile = (await async_client.get(f"/api/users/{other.id}")).json()["user"]
+    me = (await async_client.get("/api/users/me", headers=headers)).json()["user"]
+    assert profile["followers_count"] == 1
+    assert me["following_count"] == 1
+    assert me["following"] == [{"id": other.id, "name": other.name}]
+
+    await async_client.delete(f"/api/users/{other.id}/follow", headers=headers)
+    profile = (await async_client.get(f"/api/users/{other.id}")).json()["user"]
+    me = (await async_client.get("/api/users/me", headers=headers)).json()["user"]
+    assert (profile["followers_count"], profile["followers"]) == (0, [])
+    assert (me["following_count"], me["following"]) == (0, [])
+
+
+@pytest.mark.anyio
+async def test_follow_lists_paginate(async_client: AsyncClient, test_user, db_session: AsyncSession, monkeypatch):
+    monkeypatch.setattr(follows, "PREVIEW_SIZE", 2)
+    fans = [models.User(name=f"Fan {i}", api_key=f"fan_key_{i}") for i in range(5)]
+    db_session.add_all(fans)
+    await db_session.commit()
+    for fan in fans:
+        await async_client.post(f"/api/users/{test_user.id}/follow", headers={"api-key": fan.api_key})
+
+    profile = (await async_client.get(f"/api/users/{test_user.id}")).json()["user"]
+    assert profile["followers_count"] == 5
+    assert [user["id"] for user in profile["followers"]] == [fans[4].id, fans[3].id]
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = (await async_client.get(f"/api/users/{test_user.id}/followers", params=params)).json()
+        seen += [user["id"] for user in page["users"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert seen == [fan.id for fan in reversed(fans)]
+
+    following = (await async_client.get(f"/api/users/{fans[0].id}/following")).json()
+    assert following["users"] == [{"id": test_user.id, "name": test_user.name}]
+    assert following["next_cursor"] is None
+    assert (await async_client.get("/api/users/999999/followers")).status_code == 404
+    assert (await async_client.get(f"/api/users/{test_user.id}/followers?cursor=bad")).status_code == 400
+# =================================================================================
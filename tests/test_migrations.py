@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import Base
+from app.migrate import alembic_config, is_current, migrate
+from .conftest import TEST_DB_URL
+
+SCHEMA = "migration_check"
+
+
+@pytest.fixture
+async def schema_engine(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    isolated = create_async_engine(TEST_DB_URL, connect_args={"server_settings": {"search_path": SCHEMA}})
+    yield isolated
+    await isolated.dispose()
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+def schema_diff(connection):
+    return compare_metadata(MigrationContext.configure(connection), Base.metadata)
+
+
+@pytest.mark.anyio
+async def test_migrations_match_models(schema_engine):
+    await migrate(schema_engine)
+
+    async with schema_engine.connect() as conn:
+        assert await conn.run_sync(schema_diff) == []
+
+
+@pytest.mark.anyio
+async def test_migrations_upgrade_unversioned_baseline(schema_engine):
+    await migrate(schema_engine, "0001")
+    async with schema_engine.begin() as conn:
+        await conn.execute(text("DROP TABLE alembic_version"))
+        await conn.execute(text("INSERT INTO users (id, api_key, name) VALUES (1, 'a', 'A'), (2, 'b', 'B')"))
+        await conn.execute(text("INSERT INTO follows (follower_id, followed_id) VALUES (1, 2), (1, 2)"))
+        await conn.execute(text("INSERT INTO medias (url) VALUES ('static/media/legacy.jpg')"))
+
+    await migrate(schema_engine)
+
+    async with schema_engine.connect() as conn:
+        assert await conn.scalar(text("SELECT version_num FROM alembic_version")) == "0010"
+        assert await conn.scalar(text("SELECT count(*) FROM follows")) == 1
+        assert await conn.scalar(text("SELECT count(*) FROM medias WHERE created_at IS NULL")) == 0
+        assert await conn.run_sync(schema_diff) == []
+
+
+@pytest.mark.anyio
+async def test_concurrent_workers_migrate_once(schema_engine):
+    workers = [
+        create_async_engine(TEST_DB_URL, connect_args={"server_settings": {"search_path": SCHEMA}})
+        for _ in range(3)
+    ]
+    try:
+        # Without the advisory lock the workers run the same DDL at once and block each other
+        await asyncio.wait_for(asyncio.gather(*[migrate(worker) for worker in workers]), timeout=60)
+    finally:
+        for worker in workers:
+            await worker.dispose()
+
+    async with schema_engine.connect() as conn:
+        assert await conn.run_sync(lambda sync: is_current(sync, alembic_config(sync)))
+        assert await conn.scalar(text("SELECT count(*) FROM alembic_version")) == 1
@@ -0,0 +1,139 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, follows, models, tags, timeline
+from app.database import Base
+
+
+def full_scans(plan: dict, leading_columns: dict) -> list:
+    found = []
+    index_name = plan.get("Index Name")
+    index_cond = plan.get("Index Cond", "")
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan["Relation Name"])
+    elif index_name and (
+        (plan.get("Filter") and not index_cond)
+        or (index_cond and leading_columns[index_name] not in index_cond)
+    ):
+        # Walking a whole index to filter it is a sequential scan in disguise
+        found.append(index_name)
+    for child in plan.get("Plans", []):
+        found.extend(full_scans(child, leading_columns))
+    return found
+
+
+@pytest.fixture
+async def seeded(db_session: AsyncSession):
+    users = [models.User(name=f"User {i}", api_key=f"plan_key_{i}") for i in range(20)]
+    db_session.add_all(users)
+    await db_session.flush()
+    tweets = [
+        models.Tweet(tweet_data=f"Tweet {i}", author=users[i % len(users)])
+        for i in range(200)
+    ]
+    db_session.add_all(tweets)
+    await db_session.flush()
+    db_session.add_all(
+        [models.Like(user=users[i % len(users)], tweet=tweet) for i, tweet in enumerate(tweets)]
+        + [models.Media(url=f"static/media/{tweet.id}.jpg", tweet=tweet) for tweet in tweets[:50]]
+        + [
+            models.Follow(follower_id=follower.id, followed_id=followed.id)
+            for follower in users for followed in users[:5] if follower is not followed
+        ]
+    )
+    await db_session.commit()
+    await db_session.execute(models.TimelineEntry.__table__.insert().from_select(
+        ["user_id", "tweet_id", "author_id", "created_at"],
+        models.Tweet.__table__.select().with_only_columns(
+            models.Tweet.author_id, models.Tweet.id, models.Tweet.author_id, models.Tweet.created_at
+        )
+    ))
+    await db_session.commit()
+    await tags.index_tweets(db_session, [(t.id, f"#tag{t.id % 5}", t.created_at) for t in tweets])
+    db_session.add_all([models.Mention(tweet_id=t.id, user_id=users[0].id, created_at=t.created_at) for t in tweets])
+    await db_session.commit()
+    return users
+
+
+async def explain_reads(engine, db_session: AsyncSession, read) -> dict:
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        await read()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", on_execute)
+
+    plans = {}
+    connection = await db_session.connection()
+    result = await connection.exec_driver_sql(
+        "SELECT c.relname, a.attname FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]"
+    )
+    leading_columns = dict(result.all())
+    # Tables are tiny here, so forbid seq scans and see whether an index can serve the query
+    await connection.exec_driver_sql("SET enable_seqscan = off")
+    try:
+        for statement, parameters in statements:
+            result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plans[statement] = full_scans(result.scalar()[0]["Plan"], leading_columns)
+    finally:
+        await connection.exec_driver_sql("RESET enable_seqscan")
+    return plans
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("read", [
+    "feed", "feed_page", "timeline", "profile", "principal", "tag", "mentions", "followers", "following",
+])
+async def test_reads_use_indexes(engine, db_session: AsyncSession, seeded, read):
+    user = seeded[0]
+    _, cursor = await crud.get_tweets(db_session, limit=10)
+    _, followers_cursor = await follows.get_followers_page(db_session, user.id, 5)
+
+    async def profile():
+        return await crud.get_user_response(db_session, await crud.get_user(db_session, id=user.id))
+
+    reads = {
+        "feed": lambda: crud.get_tweets(db_session, limit=50),
+        "feed_page": lambda: crud.get_tweets(db_session, limit=50, cursor=cursor),
+        "timeline": lambda: timeline.get_timeline_page(db_session, user.id, 50),
+        "profile": profile,
+        "principal": lambda: crud.get_principal(db_session, user.api_key),
+        "tag": lambda: tags.get_tag_page(db_session, "tag1", 50),
+        "mentions": lambda: tags.get_mentions_page(db_session, user.id, 50),
+        "followers": lambda: follows.get_followers_page(db_session, user.id, 5, followers_cursor),
+        "following": lambda: follows.get_following_page(db_session, seeded[-1].id, 50),
+    }
+    crud.clear_principals()
+
+    plans = await explain_reads(engine, db_session, reads[read])
+
+    assert plans
+    assert {statement: scans for statement, scans in plans.items() if scans} == {}
+
+
+@pytest.mark.anyio
+async def test_cascading_foreign_keys_are_indexed(db_session: AsyncSession):
+    # EXPLAIN of the parent DELETE does not show cascades, so check the referencing columns directly
+    connection = await db_session.connection()
+    result = await connection.exec_driver_sql(
+        "SELECT t.relname, a.attname FROM pg_index i "
+        "JOIN pg_class t ON t.oid = i.indrelid "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]"
+    )
+    leading_columns = set(result.all())
+    cascading = {
+        (table.name, foreign_key.parent.name)
+        for table in Base.metadata.sorted_tables
+        for foreign_key in table.foreign_keys
+        if foreign_key.ondelete == "CASCADE"
+    }
+
+    assert cascading - leading_columns == set()
@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import seed
+from app.migrate import migrate
+from .conftest import TEST_DB_URL
+
+SCHEMA = "seed_check"
+
+
+@pytest.fixture
+async def schema_engine(engine):
+    # A separate schema keeps seeded rows and their statistics away from the other tests
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    isolated = create_async_engine(TEST_DB_URL, connect_args={"server_settings": {"search_path": SCHEMA}})
+    await migrate(isolated)
+    yield isolated
+    await isolated.dispose()
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+@pytest.mark.anyio
+async def test_seed_bulk_loads_skewed_data(schema_engine):
+    config = seed.SeedConfig(users=200, tweets=2000, follows=2000, likes=4000, backfill=5, workers=3, batch_size=500)
+    counts = await seed.seed(schema_engine, config)
+
+    assert counts["users"] == 200
+    assert counts["tweets"] == 2000
+    assert counts["medias"] == counts["media_blobs"] > 0
+    assert counts["follows"] > 1000
+    assert counts["timelines"] > 0
+    assert counts["tweet_hashtags"] > 0
+    assert counts["mentions"] > 0
+
+    async with schema_engine.begin() as conn:
+        top_followers = await conn.scalar(text(
+            "SELECT count(*) FROM follows GROUP BY followed_id ORDER BY count(*) DESC LIMIT 1"
+        ))
+        assert top_followers > 10 * counts["follows"] / counts["users"]
+        assert await conn.scalar(text("SELECT count(*) FROM follows WHERE follower_id = followed_id")) == 0
+
+        # Bodies cached before the reseed are not served again
+        assert await conn.scalar(text("SELECT count(DISTINCT entity) FROM cache_versions")) == 201
+
+        # Sequences continue after the copied ids
+        user_id = await conn.scalar(text("INSERT INTO users (api_key, name) VALUES ('x', 'X') RETURNING id"))
+        assert user_id == 201